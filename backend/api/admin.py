@@ -1,6 +1,6 @@
 from django.contrib import admin
 
-from .models import Balance, Currency, Deposit, Withdrawal
+from .models import Balance, Currency, Deposit, LedgerEntry, Withdrawal
 
 
 class BalanceAdmin(admin.ModelAdmin):
@@ -20,7 +20,12 @@ class WithdrawalAdmin(admin.ModelAdmin):
     fields = ('currency__symbol', 'amount', 'status', 'confirmations', 'user')
     search_fields = ('user__username', 'currency__symbol', 'status')
 
+class LedgerEntryAdmin(admin.ModelAdmin):
+    fields = ('balance', 'kind', 'amount', 'locked_amount', 'deposit', 'withdrawal', 'applied')
+    search_fields = ('balance__user__username', 'kind')
+
 admin.site.register(Balance, BalanceAdmin)
 admin.site.register(Currency, CurrencyAdmin)
 admin.site.register(Deposit, DepositAdmin)
 admin.site.register(Withdrawal, WithdrawalAdmin)
+admin.site.register(LedgerEntry, LedgerEntryAdmin)
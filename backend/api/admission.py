@@ -0,0 +1,136 @@
+"""
+Admission control in front of the wallet. Deposit and withdrawal start/finish
+requests take a slot of the global and of the user's concurrency limit, which
+are shared by all workers through redis. A request which doesn't get a slot is
+rejected right away with 429 instead of queueing up at the wallet.
+"""
+from django.conf import settings
+from rest_framework.exceptions import Throttled
+from .helpers import get_redis_connection
+
+import functools
+import time
+import uuid
+
+GLOBAL_KEY = 'admission:global'
+USER_KEY = 'admission:user:{}'
+ADMITTED_KEY = 'admission:admitted'
+REJECTED_KEY = 'admission:rejected:{}'
+
+# slots are sorted set members scored by their expiry time, slots of crashed
+# workers expire by themselves. Returns 0 if admitted, otherwise the name of
+# the limit which was reached
+ACQUIRE_SCRIPT = '''
+local now = tonumber(ARGV[1])
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', now)
+redis.call('ZREMRANGEBYSCORE', KEYS[2], '-inf', now)
+if redis.call('ZCARD', KEYS[2]) >= tonumber(ARGV[5]) then
+    redis.call('INCR', KEYS[4])
+    return 'user'
+end
+if redis.call('ZCARD', KEYS[1]) >= tonumber(ARGV[4]) then
+    redis.call('INCR', KEYS[5])
+    return 'global'
+end
+redis.call('ZADD', KEYS[1], ARGV[2], ARGV[3])
+redis.call('ZADD', KEYS[2], ARGV[2], ARGV[3])
+redis.call('EXPIRE', KEYS[2], ARGV[6])
+redis.call('INCR', KEYS[3])
+return 0
+'''
+
+_acquire_script = None
+
+
+def get_acquire_script():
+    global _acquire_script
+    if _acquire_script is None:
+        _acquire_script = get_redis_connection().register_script(
+            ACQUIRE_SCRIPT)
+    return _acquire_script
+
+
+class AdmissionRejected(Exception):
+    """No free slot, the client should retry after retry_after seconds."""
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.retry_after = settings.ADMISSION['RETRY_AFTER_SECONDS']
+        super().__init__('Too many {} requests in progress, retry later'.format(
+            'of your' if limit == 'user' else 'wallet'))
+
+
+class Slot:
+    """Slot of the global and of the user's concurrency limit."""
+
+    def __init__(self, user):
+        self.user_key = USER_KEY.format(user.pk)
+        self.token = uuid.uuid4().hex
+
+    def acquire(self):
+        """Takes the slot or raises AdmissionRejected."""
+        lease_seconds = settings.ADMISSION['LEASE_SECONDS']
+        now = time.time()
+        limit = get_acquire_script()(
+            keys=[
+                GLOBAL_KEY,
+                self.user_key,
+                ADMITTED_KEY,
+                REJECTED_KEY.format('user'),
+                REJECTED_KEY.format('global'),
+            ],
+            args=[
+                now,
+                now + lease_seconds,
+                self.token,
+                settings.ADMISSION['GLOBAL_LIMIT'],
+                settings.ADMISSION['USER_LIMIT'],
+                lease_seconds,
+            ],
+        )
+        if limit != 0:
+            raise AdmissionRejected(
+                limit.decode() if isinstance(limit, bytes) else limit)
+
+    def release(self):
+        pipeline = get_redis_connection().pipeline()
+        pipeline.zrem(GLOBAL_KEY, self.token)
+        pipeline.zrem(self.user_key, self.token)
+        pipeline.execute()
+
+
+def admitted(func):
+    """Runs a DRF action only if it gets a slot, raises Throttled otherwise."""
+    @functools.wraps(func)
+    def wrapper(self, request, *args, **kwargs):
+        slot = Slot(request.user)
+        try:
+            slot.acquire()
+        except AdmissionRejected as e:
+            raise Throttled(wait=e.retry_after, detail=str(e))
+        try:
+            return func(self, request, *args, **kwargs)
+        finally:
+            slot.release()
+    return wrapper
+
+
+def get_metrics():
+    """Requests in flight (the wallet's queue depth) and admission counters."""
+    connection = get_redis_connection()
+    pipeline = connection.pipeline()
+    pipeline.zcount(GLOBAL_KEY, time.time(), '+inf')
+    pipeline.get(ADMITTED_KEY)
+    pipeline.get(REJECTED_KEY.format('global'))
+    pipeline.get(REJECTED_KEY.format('user'))
+    in_flight, admitted_count, rejected_global, rejected_user = pipeline.execute()
+    return {
+        'in_flight': in_flight,
+        'global_limit': settings.ADMISSION['GLOBAL_LIMIT'],
+        'user_limit': settings.ADMISSION['USER_LIMIT'],
+        'admitted': int(admitted_count or 0),
+        'rejected': {
+            'global': int(rejected_global or 0),
+            'user': int(rejected_user or 0),
+        },
+    }
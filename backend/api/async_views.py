@@ -0,0 +1,224 @@
+"""
+Async versions of the deposit and withdrawal start/finish actions, routed
+instead of the DRF actions when ASYNC_TRANSFER_VIEWS is set and served by
+backend/asgi.py. Wallet calls are awaited, so a slow wallet doesn't hold a
+worker, database work runs in a thread through sync_to_async.
+"""
+from asgiref.sync import sync_to_async
+from django.db import transaction
+from django.http import HttpResponseNotAllowed, JsonResponse
+from django.urls import reverse
+from rest_framework import status
+from rest_framework.exceptions import (
+    APIException,
+    NotAuthenticated,
+    PermissionDenied,
+)
+from rest_framework.request import Request
+from rest_framework.settings import api_settings
+
+from .admission import AdmissionRejected, Slot
+from .helpers import format_grin
+from .idempotency import (
+    IdempotencyError,
+    IdempotentRequest,
+    get_idempotency_key,
+)
+from .models import Deposit, Withdrawal
+from .permissions import ObjectPermissions
+from .transfers import (
+    TransferError,
+    begin_finalization,
+    check_available_amount,
+    contract_error,
+    create_step1_transfer,
+    invoice_tx_args,
+    parse_finish_data,
+    parse_start_data,
+    send_tx_args,
+)
+from .wallet import AsyncWalletV3, WalletError
+
+import functools
+import json
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def error_response(error, status_code=status.HTTP_400_BAD_REQUEST):
+    return JsonResponse({'detail': str(error)}, status=status_code)
+
+
+@sync_to_async
+def authenticate(request, model):
+    """
+    Returns (user, data) of the request, authenticated, authorized and parsed
+    the same way as in DRF views. Raises APIException if it's not
+    authenticated, the user lacks the model permissions which DRF actions
+    require for POST or the body can't be parsed.
+    """
+    drf_request = Request(
+        request,
+        parsers=[parser() for parser in api_settings.DEFAULT_PARSER_CLASSES],
+        authenticators=[
+            authenticator() for authenticator
+            in api_settings.DEFAULT_AUTHENTICATION_CLASSES
+        ],
+    )
+    if not drf_request.user.is_authenticated:
+        raise NotAuthenticated()
+    perms = ObjectPermissions().get_required_permissions('POST', model)
+    if not drf_request.user.has_perms(perms):
+        raise PermissionDenied()
+    return drf_request.user, drf_request.data
+
+
+def transfer_view(model):
+    """
+    Authenticates and authorizes the POST request to create a transfer of the
+    given model, checks that the currency is grin, handles its Idempotency-Key
+    and admission control.
+    """
+    return functools.partial(wrap_transfer_view, model=model)
+
+
+def wrap_transfer_view(view, model):
+    # django's view decorators would hide that the view is async
+    @functools.wraps(view)
+    async def wrapper(request):
+        if request.method != 'POST':
+            return HttpResponseNotAllowed(['POST'])
+        try:
+            user, data = await authenticate(request, model)
+            key = get_idempotency_key(request)
+        except APIException as e:
+            return error_response(e.detail, e.status_code)
+        except IdempotencyError as e:
+            return error_response(e, e.status_code)
+        if key is None:
+            return await run_view(view, request, user, data)
+        idempotent_request = IdempotentRequest(user, request.path, key, data)
+        # redis calls don't need the thread of the database connection
+        try:
+            stored = await sync_to_async(
+                idempotent_request.begin, thread_sensitive=False)()
+        except IdempotencyError as e:
+            return error_response(e, e.status_code)
+        if stored is not None:
+            return replay_response(stored)
+        try:
+            response = await run_view(view, request, user, data)
+        except Exception:
+            await sync_to_async(
+                idempotent_request.abort, thread_sensitive=False)()
+            raise
+        headers = {}
+        if 'Location' in response:
+            headers['Location'] = response['Location']
+        # database work of the view is already committed
+        await sync_to_async(idempotent_request.finish, thread_sensitive=False)(
+            response.status_code, json.loads(response.content), headers)
+        return response
+    # like DRF views, csrf is checked only by session authentication
+    wrapper.csrf_exempt = True
+    # database work is done in short transactions of its own, requests can't
+    # be atomic as a whole
+    return transaction.non_atomic_requests(wrapper)
+
+
+async def run_view(view, request, user, data):
+    if str(data.get('symbol', '')).lower() != 'grin':
+        return error_response('Not supported')
+    slot = Slot(user)
+    try:
+        await sync_to_async(slot.acquire, thread_sensitive=False)()
+    except AdmissionRejected as e:
+        response = error_response(e, status.HTTP_429_TOO_MANY_REQUESTS)
+        response['Retry-After'] = str(e.retry_after)
+        return response
+    try:
+        return await view(request, user, data)
+    except TransferError as e:
+        return error_response(e)
+    finally:
+        await sync_to_async(slot.release, thread_sensitive=False)()
+
+
+def replay_response(stored):
+    response = JsonResponse(
+        stored['data'], status=stored['status'], safe=False)
+    for header, value in stored['headers'].items():
+        response[header] = value
+    response['Idempotent-Replayed'] = 'true'
+    return response
+
+
+def job_response(job, request):
+    response = JsonResponse(job, status=status.HTTP_202_ACCEPTED)
+    response['Location'] = request.build_absolute_uri(
+        reverse('job-detail', args=[job['id']]))
+    return response
+
+
+@sync_to_async
+def atomic_begin_finalization(model, user, slate):
+    with transaction.atomic():
+        return begin_finalization(model, user, slate)
+
+
+async def finish_transfer(request, model, user, data):
+    slatepack_msg = parse_finish_data(data)
+    wallet_api = await AsyncWalletV3.get_wallet_api()
+    try:
+        slate = await wallet_api.slate_from_slatepack_message(
+            slatepack_msg, [0])
+    except Exception:
+        raise contract_error(model)
+    job = await atomic_begin_finalization(model, user, slate)
+    return job_response(job, request)
+
+
+@transfer_view(Deposit)
+async def start_deposit(request, user, data):
+    user_wallet_address, amount = parse_start_data(data)
+    wallet_api = await AsyncWalletV3.get_wallet_api()
+    try:
+        versioned_slate = await wallet_api.issue_invoice_tx(
+            invoice_tx_args(amount))
+    except WalletError:
+        logger.error('issue_invoice_tx failed, user: {}, amount: {}'.format(
+            user.username, format_grin(amount)))
+        return error_response(
+            'Failed to create an invoice',
+            status.HTTP_500_INTERNAL_SERVER_ERROR
+        )
+    await sync_to_async(create_step1_transfer)(
+        Deposit, user, amount, versioned_slate['id'])
+    slatepack_message = await wallet_api.create_slatepack_message(
+        versioned_slate, [user_wallet_address], sender_index=0)
+    return JsonResponse(slatepack_message, safe=False)
+
+
+@transfer_view(Deposit)
+async def finish_deposit(request, user, data):
+    return await finish_transfer(request, Deposit, user, data)
+
+
+@transfer_view(Withdrawal)
+async def start_withdrawal(request, user, data):
+    user_wallet_address, amount = parse_start_data(data)
+    await sync_to_async(check_available_amount)(user, amount)
+    wallet_api = await AsyncWalletV3.get_wallet_api()
+    versioned_slate = await wallet_api.init_send_tx(
+        send_tx_args(amount, user_wallet_address))
+    await sync_to_async(create_step1_transfer)(
+        Withdrawal, user, amount, versioned_slate['id'])
+    slatepack_message = await wallet_api.create_slatepack_message(
+        versioned_slate, [user_wallet_address], sender_index=0)
+    return JsonResponse(slatepack_message, safe=False)
+
+
+@transfer_view(Withdrawal)
+async def finish_withdrawal(request, user, data):
+    return await finish_transfer(request, Withdrawal, user, data)
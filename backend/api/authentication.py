@@ -0,0 +1,196 @@
+"""
+Authentication which doesn't hit the database on every request.
+
+JWTs carry the claims needed to build request.user (username, staff flags and
+model permissions), revoked tokens are kept in redis. API keys are checked
+against the HMAC of their secret, which is cached in redis with the claims of
+the key's user.
+"""
+from django.conf import settings
+from django.contrib.auth.models import User
+from rest_framework import authentication, exceptions
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.exceptions import InvalidToken
+from rest_framework_simplejwt.settings import api_settings as jwt_settings
+from .helpers import get_redis_connection
+from .models import ApiKey
+
+import hashlib
+import hmac
+import json
+import secrets
+import time
+
+REVOKED_TOKEN_KEY = 'revoked:token:{}'
+REVOKED_USER_KEY = 'revoked:user:{}'
+API_KEY_KEY = 'apikey:{}'
+
+
+def user_claims(user):
+    """Claims of a user which are added to its tokens and cached API keys."""
+    return {
+        'username': user.username,
+        'is_staff': user.is_staff,
+        'is_superuser': user.is_superuser,
+        # model permissions, default ones are assigned to every user
+        'perms': sorted(user.get_all_permissions()),
+    }
+
+
+def read_only_save(*args, **kwargs):
+    raise TypeError("User built from claims can't be saved")
+
+
+def user_from_claims(user_id, claims):
+    """
+    Returns an active user built from claims without a database query. Its
+    related managers (eg. user.balances) work, it can't be saved.
+    """
+    user = User(
+        id=user_id,
+        username=claims['username'],
+        is_staff=claims['is_staff'],
+        is_superuser=claims['is_superuser'],
+        is_active=True,
+    )
+    user._state.adding = False
+    user._state.db = 'default'
+    # ModelBackend uses the cache instead of querying the permissions
+    user._perm_cache = set(claims['perms'])
+    user.save = read_only_save
+    return user
+
+
+def revoke_token(token):
+    """Revokes the given token until it expires."""
+    ttl = int(token['exp'] - time.time())
+    if ttl > 0:
+        get_redis_connection().set(
+            REVOKED_TOKEN_KEY.format(token[jwt_settings.JTI_CLAIM]), 1, ex=ttl)
+
+
+def revoke_user_tokens(user_id):
+    """
+    Revokes all tokens of the user issued until now and drops the cached
+    claims of the user's API keys.
+    """
+    connection = get_redis_connection()
+    # tokens issued before this are expired by the time the key expires. Sub
+    # second precision, a token issued right after the change is valid
+    connection.set(
+        REVOKED_USER_KEY.format(user_id),
+        repr(time.time()),
+        ex=int(jwt_settings.REFRESH_TOKEN_LIFETIME.total_seconds()),
+    )
+    key_ids = ApiKey.objects.filter(
+        user_id=user_id).values_list('key_id', flat=True)
+    if key_ids:
+        connection.delete(*[API_KEY_KEY.format(key_id) for key_id in key_ids])
+
+
+def is_revoked(token):
+    """True if the token or all tokens of its user issued before it were revoked."""
+    revoked_token, revoked_before = get_redis_connection().mget(
+        REVOKED_TOKEN_KEY.format(token[jwt_settings.JTI_CLAIM]),
+        REVOKED_USER_KEY.format(token[jwt_settings.USER_ID_CLAIM]),
+    )
+    if revoked_token is not None:
+        return True
+    # tokens without iat were issued before revocation by user existed
+    return (
+        revoked_before is not None and
+        token.get('iat', 0) <= float(revoked_before)
+    )
+
+
+class ClaimsJWTAuthentication(JWTAuthentication):
+    """
+    JWT authentication which trusts the token's claims instead of loading the
+    user, only the revocation list in redis is checked.
+    """
+
+    def get_user(self, validated_token):
+        if jwt_settings.USER_ID_CLAIM not in validated_token:
+            raise InvalidToken('Token contained no recognizable user identification')
+        if is_revoked(validated_token):
+            raise exceptions.AuthenticationFailed(
+                'Token is revoked', code='token_not_valid')
+        if 'perms' not in validated_token:
+            # issued before claims were added
+            return super().get_user(validated_token)
+        return user_from_claims(
+            validated_token[jwt_settings.USER_ID_CLAIM], validated_token)
+
+
+def hash_secret(secret):
+    """HMAC of an API key secret, secrets are random so no key stretching."""
+    return hmac.new(
+        settings.SECRET_KEY.encode(), secret.encode(), hashlib.sha256
+    ).hexdigest()
+
+
+def create_api_key(user, name=''):
+    """Creates an API key and returns it with the full key (shown only once)."""
+    key_id = secrets.token_hex(8)
+    secret = secrets.token_urlsafe(32)
+    api_key = ApiKey.objects.create(
+        user=user,
+        name=name,
+        key_id=key_id,
+        digest=hash_secret(secret),
+    )
+    return api_key, '{}.{}'.format(key_id, secret)
+
+
+def get_api_key_entry(key_id):
+    """
+    Returns the cached {'digest', 'user_id', 'claims'} of the API key or None
+    if it doesn't exist or its user is inactive.
+    """
+    connection = get_redis_connection()
+    cache_key = API_KEY_KEY.format(key_id)
+    cached = connection.get(cache_key)
+    if cached is not None:
+        return json.loads(cached)
+    api_key = ApiKey.objects.select_related('user').filter(
+        key_id=key_id, user__is_active=True).first()
+    if api_key is None:
+        return None
+    entry = {
+        'digest': api_key.digest,
+        'user_id': api_key.user_id,
+        'claims': user_claims(api_key.user),
+    }
+    connection.set(
+        cache_key, json.dumps(entry),
+        ex=settings.API_KEYS['CACHE_SECONDS'])
+    return entry
+
+
+def forget_api_key(key_id):
+    get_redis_connection().delete(API_KEY_KEY.format(key_id))
+
+
+class ApiKeyAuthentication(authentication.BaseAuthentication):
+    """API key authentication, 'Authorization: Api-Key <key_id>.<secret>'."""
+    keyword = 'Api-Key'
+
+    def authenticate(self, request):
+        auth = authentication.get_authorization_header(request).split()
+        if not auth or auth[0].lower() != self.keyword.lower().encode():
+            return None
+        if len(auth) != 2:
+            raise exceptions.AuthenticationFailed('Invalid API key header')
+        try:
+            key_id, secret = auth[1].decode().split('.', 1)
+        except (UnicodeError, ValueError):
+            raise exceptions.AuthenticationFailed('Invalid API key')
+        entry = get_api_key_entry(key_id)
+        # compared in constant time so that the digest can't be guessed
+        if entry is None or not hmac.compare_digest(
+                entry['digest'], hash_secret(secret)):
+            raise exceptions.AuthenticationFailed('Invalid API key')
+        return user_from_claims(entry['user_id'], entry['claims']), key_id
+
+    def authenticate_header(self, request):
+        return self.keyword
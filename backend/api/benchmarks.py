@@ -0,0 +1,524 @@
+"""
+Benchmarks which can be run with `python manage.py benchmark <name>`. They
+don't need a running node or wallet, the apis are replaced by local stand-ins.
+"""
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+
+import asyncio
+import base64
+import json
+import os
+import requests
+import threading
+import time
+
+
+class JsonRpcHandler(BaseHTTPRequestHandler):
+    """Answers every JSON-RPC call (or batch of calls) with an empty Ok."""
+    # HTTP/1.1 so that the client can keep the connection alive
+    protocol_version = 'HTTP/1.1'
+    # headers and body are written separately, without this the keep-alive
+    # client would wait for a delayed ACK on every response
+    disable_nagle_algorithm = True
+    # seconds to sleep before answering, simulates a slow api
+    delay = 0
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        if self.delay:
+            time.sleep(self.delay)
+        if isinstance(body, list):
+            response = [self.respond(call) for call in body]
+        else:
+            response = self.respond(body)
+        data = json.dumps(response).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def respond(self, call):
+        return {'jsonrpc': '2.0', 'id': call['id'], 'result': {'Ok': None}}
+
+    def log_message(self, *args):
+        pass
+
+
+class JsonRpcServer(ThreadingHTTPServer):
+    daemon_threads = True
+    # many clients connect at once in the concurrency benchmarks
+    request_queue_size = 128
+
+
+@contextmanager
+def json_rpc_server(handler_class=JsonRpcHandler):
+    """Runs a local stand-in JSON-RPC server, yields its url."""
+    server = JsonRpcServer(('127.0.0.1', 0), handler_class)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield 'http://127.0.0.1:{}/'.format(server.server_address[1])
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def measure(func, iterations):
+    """Returns calls per second."""
+    start = time.perf_counter()
+    for _ in range(iterations):
+        func()
+    return iterations / (time.perf_counter() - start)
+
+
+def benchmark_transport(stdout, iterations=2000):
+    """RPCs per second without (requests.post) and with the pooled transport."""
+    from .transport import JsonRpcTransport
+
+    payload = {'jsonrpc': '2.0', 'id': 1, 'method': 'get_tip', 'params': []}
+    with json_rpc_server() as url:
+        auth = ('grin', 'secret')
+        transport = JsonRpcTransport(url, auth)
+        results = {
+            'requests.post (new connection per call)': measure(
+                lambda: requests.post(url, json=payload, auth=auth), iterations),
+            'pooled keep-alive transport': measure(
+                lambda: transport.post(payload, 'get_tip'), iterations),
+        }
+        transport.close()
+    for name, rate in results.items():
+        stdout.write('{}: {:.0f} RPC/s'.format(name, rate))
+
+
+class StandInNode:
+    """
+    In-memory stand-in for NodeV2API. Block at height h has kernels
+    'kernel-<h>-<i>'. Every request (a batch counts as one) sleeps latency
+    seconds to simulate a round trip.
+    """
+
+    def __init__(self, height, kernels_per_block=10, latency=0.001):
+        self.height = height
+        self.kernels_per_block = kernels_per_block
+        self.latency = latency
+        self.requests = 0
+
+    def request(self):
+        self.requests += 1
+        time.sleep(self.latency)
+
+    def header(self, height):
+        return {
+            'height': height,
+            'hash': 'hash-{}'.format(height),
+            'previous': 'hash-{}'.format(height - 1),
+        }
+
+    def block(self, height):
+        return {
+            'header': self.header(height),
+            'kernels': [
+                {'excess': 'kernel-{}-{}'.format(height, i)}
+                for i in range(self.kernels_per_block)
+            ],
+        }
+
+    def find_kernel(self, excess, min_height):
+        _, height, _ = excess.split('-')
+        height = int(height)
+        if min_height is not None and height < min_height or height > self.height:
+            return None
+        return {'height': height}
+
+    def get_tip(self):
+        self.request()
+        return {'height': self.height, 'last_block_pushed': 'hash-{}'.format(self.height)}
+
+    def get_header(self, height):
+        self.request()
+        return self.header(height)
+
+    def get_kernel(self, excess, min_height=None, max_height=None):
+        self.request()
+        return self.find_kernel(excess, min_height)
+
+    def get_kernels(self, excesses, min_height=None, max_height=None):
+        self.request()
+        return [self.find_kernel(excess, min_height) for excess in excesses]
+
+    def get_blocks(self, heights):
+        self.request()
+        return [self.block(height) for height in heights]
+
+
+def benchmark_confirmations(stdout, iterations=20, pending=500):
+    """
+    Node requests and time needed to follow `iterations` new blocks with
+    `pending` transfers awaiting confirmation, one search per transfer (the
+    old approach) vs the block follower.
+    """
+    from .follower import scan_blocks
+
+    start_height = 100000
+    # transfers whose kernels will be mined in the benchmarked blocks
+    transfers = [
+        SimpleNamespace(
+            kernel_excess='kernel-{}-0'.format(start_height + 1 + i % iterations),
+            broadcast_height=start_height,
+            kernel_height=None,
+        )
+        for i in range(pending)
+    ]
+
+    node = StandInNode(start_height)
+    start = time.perf_counter()
+    for _ in range(iterations):
+        node.height += 1
+        current_height = node.get_tip()['height']
+        for transfer in transfers:
+            kernel = node.get_kernel(
+                transfer.kernel_excess, current_height - 60*24*7)
+            if kernel is not None:
+                transfer.kernel_height = kernel['height']
+    per_transfer = (node.requests, time.perf_counter() - start)
+
+    for transfer in transfers:
+        transfer.kernel_height = None
+    index = {transfer.kernel_excess: transfer for transfer in transfers}
+    node = StandInNode(start_height)
+    height, block_hash = start_height, 'hash-{}'.format(start_height)
+    start = time.perf_counter()
+    for _ in range(iterations):
+        node.height += 1
+        tip_height = node.get_tip()['height']
+        height, block_hash, matched = scan_blocks(
+            node, height + 1, tip_height, block_hash, index)
+        for transfer in matched:
+            del index[transfer.kernel_excess]
+    follower = (node.requests, time.perf_counter() - start)
+    assert not index, 'follower missed some kernels'
+
+    for name, (requests_made, elapsed) in (
+        ('per-transfer kernel search', per_transfer),
+        ('block follower', follower),
+    ):
+        stdout.write('{}: {} node requests, {:.3f}s for {} blocks and {} pending transfers'.format(
+            name, requests_made, elapsed, iterations, pending))
+
+
+def benchmark_amounts(stdout, iterations=200, entries=1000):
+    """
+    Summing `entries` ledger amounts (as done when materializing balances) and
+    serializing them, Decimal grin amounts vs integer nanogrin.
+    """
+    from decimal import Decimal
+    from rest_framework import serializers
+    from .helpers import format_grin
+    from .serializers import GrinAmountField
+
+    decimal_amounts = [Decimal('1.000000001') * i for i in range(entries)]
+    nanogrin_amounts = [1000000001 * i for i in range(entries)]
+    assert [format_grin(amount) for amount in nanogrin_amounts] == [
+        '{:.9f}'.format(amount) for amount in decimal_amounts]
+
+    decimal_field = serializers.DecimalField(max_digits=30, decimal_places=9)
+    grin_field = GrinAmountField()
+    for name, amounts, field in (
+        ('decimal', decimal_amounts, decimal_field),
+        ('nanogrin', nanogrin_amounts, grin_field),
+    ):
+        aggregation = measure(lambda: sum(amounts), iterations)
+        serialization = measure(
+            lambda: [field.to_representation(amount) for amount in amounts],
+            iterations)
+        stdout.write(
+            '{}: aggregation {:.0f} amounts/s, serialization {:.0f} amounts/s'
+            .format(
+                name,
+                entries * aggregation,
+                entries * serialization,
+            ))
+
+
+def create_users(count):
+    """
+    Creates `count` users with a balance in a new benchmark currency, returns
+    the users and their balance ids. Run it in a transaction which is rolled
+    back.
+    """
+    from django.contrib.auth.models import User
+    from .models import Balance, Currency
+
+    currency = Currency.objects.create(name='Benchmark', symbol='bench')
+    # bulk_create doesn't send post_save, balances are created here
+    User.objects.bulk_create([
+        User(username='benchmark-{}'.format(i)) for i in range(count)])
+    users = list(User.objects.filter(
+        username__startswith='benchmark-').order_by('pk'))
+    Balance.objects.bulk_create([
+        Balance(currency=currency, user=user) for user in users])
+    balance_ids = list(Balance.objects.filter(
+        currency=currency).order_by('pk').values_list('pk', flat=True))
+    return users, balance_ids
+
+
+def create_transfers(model, balance_ids, count, statuses=('finished',)):
+    """
+    Creates `count` deposits or withdrawals spread over the given balances,
+    statuses are repeated in the given order.
+    """
+    model.objects.bulk_create(
+        (
+            model(
+                balance_id=balance_ids[i % len(balance_ids)],
+                amount=1,
+                status=statuses[i % len(statuses)],
+                tx_slate_id='benchmark-{}-{}'.format(model.__name__, i),
+            )
+            for i in range(count)
+        ),
+        batch_size=10000,
+    )
+
+
+def benchmark_ownership(stdout, iterations=20, users=100, transfers=1000000):
+    """
+    Latency of listing one user's deposits (first page and count) among
+    `transfers` deposits, filtered by per-object permissions (the old approach)
+    vs by ownership. Data is created in a transaction which is rolled back.
+    """
+    from django.contrib.auth.models import Permission
+    from django.contrib.contenttypes.models import ContentType
+    from django.db import transaction
+    from guardian.models import UserObjectPermission
+    from rest_framework_guardian.filters import ObjectPermissionsFilter
+    from .mixins import OwnershipFilter
+    from .models import Deposit
+
+    batch_size = 10000
+    with transaction.atomic():
+        bench_users, balance_ids = create_users(users)
+        create_transfers(Deposit, balance_ids, transfers)
+        content_type = ContentType.objects.get_for_model(Deposit)
+        permission = Permission.objects.get(
+            content_type=content_type, codename='view_deposit')
+        UserObjectPermission.objects.bulk_create(
+            (
+                UserObjectPermission(
+                    permission=permission,
+                    content_type=content_type,
+                    object_pk=str(pk),
+                    user_id=user_id,
+                )
+                for pk, user_id in Deposit.objects.filter(
+                    balance__in=balance_ids
+                ).values_list('pk', 'balance__user_id').iterator()
+            ),
+            batch_size=batch_size,
+        )
+
+        request = SimpleNamespace(user=bench_users[0])
+        view = SimpleNamespace(owner_field='balance__user')
+        for name, filter_backend in (
+            ('per-object permissions', ObjectPermissionsFilter()),
+            ('ownership', OwnershipFilter()),
+        ):
+            def list_deposits():
+                queryset = filter_backend.filter_queryset(
+                    request, Deposit.objects.all(), view)
+                queryset.count()
+                list(queryset[:50])
+
+            rate = measure(list_deposits, iterations)
+            stdout.write('{}: {:.1f}ms per list of {} deposits'.format(
+                name, 1000 / rate, transfers))
+        transaction.set_rollback(True)
+
+
+def benchmark_serialization(stdout, iterations=5, rows=10000):
+    """
+    Rows per second of listing `rows` deposits with DepositSerializer vs the
+    values() path of the list endpoints. Data is created in a transaction
+    which is rolled back.
+    """
+    from django.contrib.auth.models import User
+    from django.db import transaction
+    from .models import Currency, Deposit
+    from .serializers import DepositSerializer, get_values_mapper
+
+    with transaction.atomic():
+        currency = Currency.objects.create(name='Benchmark', symbol='bench')
+        user = User.objects.create(username='benchmark')
+        balance = user.balances.get(currency=currency)
+        Deposit.objects.bulk_create(
+            (
+                Deposit(
+                    balance=balance,
+                    amount=i,
+                    status='finished',
+                    tx_slate_id='benchmark-{}'.format(i),
+                )
+                for i in range(rows)
+            ),
+            batch_size=10000,
+        )
+        queryset = Deposit.objects.filter(balance=balance)
+        mapper = get_values_mapper(DepositSerializer)
+        assert mapper.map(queryset.values(*mapper.paths)) == DepositSerializer(
+            queryset.select_related('balance__currency'), many=True).data
+
+        for name, list_deposits in (
+            ('serializer', lambda: DepositSerializer(
+                queryset.select_related('balance__currency'), many=True).data),
+            ('values', lambda: mapper.map(queryset.values(*mapper.paths))),
+        ):
+            rate = measure(list_deposits, iterations)
+            stdout.write('{}: {:.0f} rows/s'.format(name, rows * rate))
+        transaction.set_rollback(True)
+
+
+class StandInWalletHandler(JsonRpcHandler):
+    """
+    Stand-in owner api, does the ECDH handshake and answers encrypted calls
+    the way the wallet does. Every call sleeps `delay` seconds.
+    """
+    delay = 0.1
+
+    def respond(self, call):
+        from ecdsa import ECDH, SECP256k1
+        from .wallet import decrypt, encrypt
+
+        if call['method'] == 'init_secure_api':
+            ecdh = ECDH(curve=SECP256k1)
+            public_key = ecdh.generate_private_key().to_string('compressed')
+            ecdh.load_received_public_key_bytes(
+                bytes.fromhex(call['params']['ecdh_pubkey']))
+            # one client at a time, it's kept on the server
+            self.server.shared_secret = ecdh.generate_sharedsecret_bytes().hex()
+            return {'jsonrpc': '2.0', 'id': call['id'], 'result': {'Ok': public_key.hex()}}
+        secret = self.server.shared_secret
+        request = json.loads(decrypt(
+            secret,
+            call['params']['body_enc'],
+            bytes.fromhex(call['params']['nonce']),
+        ))
+        response = {
+            'jsonrpc': '2.0',
+            'id': request['id'],
+            'result': {'Ok': self.result(request['method'], request['params'])},
+        }
+        nonce = os.urandom(12)
+        body_enc = encrypt(secret, json.dumps(response), nonce)
+        return {
+            'jsonrpc': '2.0',
+            'id': call['id'],
+            'result': {'Ok': {'nonce': nonce.hex(), 'body_enc': body_enc}},
+        }
+
+
+    def result(self, method, params):
+        """Result of the decrypted call."""
+        if method == 'open_wallet':
+            return 'token'
+        if method == 'retrieve_txs':
+            return [False, [{'kernel_excess': 'kernel'}]]
+        return None
+
+
+def benchmark_async_wallet(stdout, calls=50, threads=10, delay=0.1):
+    """
+    Time one process needs for `calls` concurrent encrypted wallet calls which
+    each take `delay` seconds, the sync stack (a single sync worker, and a
+    worker with `threads` threads) vs the async stack (one event loop).
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    from django.conf import settings
+    from django.test import override_settings
+    from .wallet import AsyncWalletV3, WalletV3
+
+    class SlowWalletHandler(StandInWalletHandler):
+        pass
+
+    SlowWalletHandler.delay = delay
+
+    def wallet_call(wallet_api):
+        return wallet_api.retrieve_txs(tx_slate_id='benchmark', refresh=False)
+
+    async def async_calls():
+        wallet_api = await AsyncWalletV3.get_wallet_api()
+        start = time.perf_counter()
+        await asyncio.gather(*(
+            wallet_call(wallet_api) for _ in range(calls)))
+        return time.perf_counter() - start
+
+    with json_rpc_server(SlowWalletHandler) as url:
+        with override_settings(WALLET_API=dict(settings.WALLET_API, URL=url)):
+            results = []
+            for workers in (1, threads):
+                # handshake is done once per process, not measured
+                wallet_api = WalletV3.get_wallet_api()
+                with ThreadPoolExecutor(workers) as executor:
+                    start = time.perf_counter()
+                    list(executor.map(
+                        lambda _: wallet_call(wallet_api), range(calls)))
+                    results.append((
+                        'sync, {} thread(s)'.format(workers),
+                        time.perf_counter() - start,
+                    ))
+            results.append(('async, one event loop', asyncio.run(async_calls())))
+    for name, elapsed in results:
+        stdout.write('{}: {:.2f}s for {} concurrent {}s wallet calls, {:.0f} calls/s'.format(
+            name, elapsed, calls, delay, calls / elapsed))
+
+
+def benchmark_authentication(stdout, iterations=100):
+    """
+    Authenticated requests per second of one worker with basic authentication
+    (password hashing), JWT with a user lookup, JWT claims and API keys. Only
+    authentication is measured. The user is created in a transaction which is
+    rolled back.
+    """
+    from django.contrib.auth.models import User
+    from django.db import transaction
+    from django.test import RequestFactory
+    from rest_framework.authentication import BasicAuthentication
+    from rest_framework.request import Request
+    from rest_framework_simplejwt.authentication import JWTAuthentication
+    from .authentication import (
+        ApiKeyAuthentication,
+        ClaimsJWTAuthentication,
+        create_api_key,
+    )
+    from .serializers import ClaimsTokenObtainPairSerializer
+
+    factory = RequestFactory()
+    with transaction.atomic():
+        user = User.objects.create_user('benchmark', password='benchmark')
+        token = ClaimsTokenObtainPairSerializer.get_token(user).access_token
+        _, key = create_api_key(user)
+        basic = base64.b64encode(b'benchmark:benchmark').decode()
+        for name, authenticator, header in (
+            ('basic', BasicAuthentication(), 'Basic {}'.format(basic)),
+            ('jwt with user lookup', JWTAuthentication(), 'Bearer {}'.format(token)),
+            ('jwt claims', ClaimsJWTAuthentication(), 'Bearer {}'.format(token)),
+            ('api key', ApiKeyAuthentication(), 'Api-Key {}'.format(key)),
+        ):
+            request = Request(factory.get('/', HTTP_AUTHORIZATION=header))
+            assert authenticator.authenticate(request)[0].pk == user.pk
+            rate = measure(lambda: authenticator.authenticate(request), iterations)
+            stdout.write('{}: {:.0f} requests/s'.format(name, rate))
+        transaction.set_rollback(True)
+
+
+BENCHMARKS = {
+    'transport': benchmark_transport,
+    'confirmations': benchmark_confirmations,
+    'amounts': benchmark_amounts,
+    'ownership': benchmark_ownership,
+    'serialization': benchmark_serialization,
+    'async_wallet': benchmark_async_wallet,
+    'authentication': benchmark_authentication,
+}
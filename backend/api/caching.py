@@ -0,0 +1,150 @@
+"""
+Read-through cache of API responses in redis: currencies are cached for
+everyone, balance lists per user. Models invalidate the entries they change
+when their transaction commits.
+
+Every entry has a version which invalidation increments. A response loaded
+from the db is cached only if the version didn't change meanwhile, so a
+request which read the db before a commit can't cache the old rows after the
+commit invalidated them. If redis fails, responses are loaded from the db.
+"""
+from django.conf import settings
+from django.db import transaction
+from .helpers import get_redis_connection
+
+import json
+import logging
+import redis
+
+logger = logging.getLogger(__name__)
+
+KEY = 'cache:{}:{}'
+VERSION_KEY = 'cache:{}:{}:version'
+HITS_KEY = 'cache:hits:{}'
+MISSES_KEY = 'cache:misses:{}'
+
+# returns [cached value or false, version]
+READ_SCRIPT = '''
+local value = redis.call('GET', KEYS[1])
+if value then
+    redis.call('INCR', KEYS[3])
+else
+    redis.call('INCR', KEYS[4])
+end
+return {value, redis.call('GET', KEYS[2]) or '0'}
+'''
+
+# caches the value only if its version is still the one it was loaded with
+WRITE_SCRIPT = '''
+if (redis.call('GET', KEYS[2]) or '0') == ARGV[2] then
+    redis.call('SET', KEYS[1], ARGV[1], 'EX', ARGV[3])
+end
+'''
+
+_scripts = {}
+
+
+def get_script(script):
+    if script not in _scripts:
+        _scripts[script] = get_redis_connection().register_script(script)
+    return _scripts[script]
+
+
+class ReadThroughCache:
+    """Cached values of one kind, eg. balance lists, by their key."""
+
+    def __init__(self, name, ttl_setting):
+        self.name = name
+        self.ttl_setting = ttl_setting
+
+    @property
+    def enabled(self):
+        return settings.READ_CACHE['ENABLED']
+
+    def get(self, key, load):
+        """Returns the cached value of the key, calls load() on a miss."""
+        if not self.enabled:
+            return load()
+        keys = [
+            KEY.format(self.name, key),
+            VERSION_KEY.format(self.name, key),
+        ]
+        try:
+            value, version = get_script(READ_SCRIPT)(
+                keys=keys + [HITS_KEY.format(self.name), MISSES_KEY.format(self.name)])
+        except redis.RedisError:
+            logger.exception('Failed to read {} from cache'.format(keys[0]))
+            return load()
+        if value is not None:
+            return json.loads(value)
+        value = load()
+        try:
+            get_script(WRITE_SCRIPT)(keys=keys, args=[
+                json.dumps(value),
+                version,
+                settings.READ_CACHE[self.ttl_setting],
+            ])
+        except redis.RedisError:
+            logger.exception('Failed to cache {}'.format(keys[0]))
+        return value
+
+    def invalidate(self, keys):
+        """Invalidates the given keys when the current transaction commits."""
+        keys = set(keys)
+        if keys and self.enabled:
+            transaction.on_commit(lambda: self.delete(keys))
+
+    def invalidate_all(self):
+        """Invalidates all cached keys when the current transaction commits."""
+        if self.enabled:
+            transaction.on_commit(self.delete_all)
+
+    def delete(self, keys):
+        try:
+            pipeline = get_redis_connection().pipeline(transaction=False)
+            for key in keys:
+                version_key = VERSION_KEY.format(self.name, key)
+                pipeline.incr(version_key)
+                # only needs to outlive the requests which are loading it
+                pipeline.expire(version_key, settings.READ_CACHE[self.ttl_setting])
+                pipeline.delete(KEY.format(self.name, key))
+            pipeline.execute()
+        except redis.RedisError:
+            # entries expire after their ttl
+            logger.exception('Failed to invalidate {} {}'.format(self.name, keys))
+
+    def delete_all(self):
+        # for rare changes, eg. of currencies, which invalidate every entry
+        prefix = KEY.format(self.name, '')
+        try:
+            keys = {
+                key.decode()[len(prefix):].split(':')[0]
+                for key in get_redis_connection().scan_iter(
+                    match=prefix + '*', count=1000)
+            }
+        except redis.RedisError:
+            logger.exception('Failed to invalidate {}'.format(self.name))
+            return
+        self.delete(keys)
+
+    def get_metrics(self):
+        hits, misses = get_redis_connection().mget(
+            HITS_KEY.format(self.name), MISSES_KEY.format(self.name))
+        hits, misses = int(hits or 0), int(misses or 0)
+        return {
+            'hits': hits,
+            'misses': misses,
+            'hit_rate': hits / (hits + misses) if hits + misses else None,
+        }
+
+
+currency_cache = ReadThroughCache('currencies', 'CURRENCIES_SECONDS')
+# list of user's balances by user id
+balance_cache = ReadThroughCache('balances', 'BALANCES_SECONDS')
+
+
+def get_metrics():
+    return {
+        cache.name: cache.get_metrics()
+        for cache in (currency_cache, balance_cache)
+    }
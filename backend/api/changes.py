@@ -0,0 +1,168 @@
+"""
+Delta sync of user's balances, deposits and withdrawals. A client keeps the
+cursor of its last sync and gets only the rows modified after it, see
+get_changes.
+
+Rows are selected by `modified`, which is set before the transaction commits,
+so a row can become visible with a `modified` older than rows which were
+already synced. The cursor therefore doesn't move past now - SETTLE_SECONDS,
+rows modified in the settle window are sent again by the next sync.
+
+A deposit or withdrawal leaves the synced rows when it's aborted back to
+step-1, after which the reaper can delete it. Such transfers are recorded as
+RemovedTransfer rows and their ids are sent as removed.
+"""
+from datetime import datetime, timedelta, timezone as dt_timezone
+from django.conf import settings
+from django.db.models import Q
+from django.utils import timezone
+from rest_framework.fields import DateTimeField
+from .helpers import format_grin
+from .models import Balance, Deposit, RemovedTransfer, Withdrawal
+
+EPOCH = datetime(1970, 1, 1, tzinfo=dt_timezone.utc)
+
+# rows are sent as lists of these fields, in this order
+BALANCE_FIELDS = ('id', 'currency__symbol', 'amount', 'locked_amount')
+TRANSFER_FIELDS = (
+    'id', 'balance', 'amount', 'status', 'confirmations', 'created')
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+def parse_cursor(cursor):
+    """Cursor is the number of microseconds since the epoch."""
+    if not cursor:
+        return EPOCH
+    try:
+        microseconds = int(cursor)
+    except ValueError:
+        raise InvalidCursor('Invalid cursor')
+    if microseconds < 0:
+        raise InvalidCursor('Invalid cursor')
+    try:
+        return EPOCH + timedelta(microseconds=microseconds)
+    except OverflowError:
+        raise InvalidCursor('Invalid cursor')
+
+
+def format_cursor(moment):
+    return str((moment - EPOCH) // timedelta(microseconds=1))
+
+
+def change_sets(user):
+    """
+    (name, queryset, fields, converters, removals) of the rows which are
+    synced, removals is None for rows which can't be removed.
+    """
+    datetime_field = DateTimeField()
+    balance_ids = list(user.balances.values_list('pk', flat=True))
+    transfer_converters = (
+        None, None, format_grin, None, None, datetime_field.to_representation)
+    # unfinished step-1 transfers are not shown to the user
+    listed = ~Q(status='awaiting transaction signature')
+    return (
+        (
+            'balances',
+            Balance.objects.filter(user=user),
+            BALANCE_FIELDS,
+            (None, None, format_grin, format_grin),
+            None,
+        ),
+        (
+            'deposits',
+            Deposit.objects.filter(listed, balance_id__in=balance_ids),
+            TRANSFER_FIELDS,
+            transfer_converters,
+            RemovedTransfer.objects.filter(
+                kind='deposit', balance_id__in=balance_ids),
+        ),
+        (
+            'withdrawals',
+            Withdrawal.objects.filter(listed, balance_id__in=balance_ids),
+            TRANSFER_FIELDS,
+            transfer_converters,
+            RemovedTransfer.objects.filter(
+                kind='withdrawal', balance_id__in=balance_ids),
+        ),
+    )
+
+
+def changed_rows(queryset, fields, since, page_size):
+    """
+    Returns up to about page_size (modified, *fields) rows modified after since
+    in the order of modification and whether there are more of them. Rows
+    modified at the same moment are never split between pages.
+    """
+    queryset = queryset.order_by('modified', 'id')
+    rows = list(queryset.filter(modified__gt=since).values_list(
+        'modified', *fields)[:page_size])
+    if len(rows) < page_size:
+        return rows, False
+    last = rows[-1][0]
+    rows = [row for row in rows if row[0] != last]
+    rows.extend(queryset.filter(modified=last).values_list('modified', *fields))
+    return rows, True
+
+
+def removed_ids(removals, queryset, since, until):
+    """
+    Ids of transfers removed after since and up to until (if set), except
+    those which were listed again meanwhile, they are sent as changed rows.
+    """
+    removals = removals.filter(modified__gt=since)
+    if until is not None:
+        removals = removals.filter(modified__lte=until)
+    ids = set(removals.values_list('transfer_id', flat=True))
+    if ids:
+        ids -= set(queryset.filter(pk__in=ids).values_list('pk', flat=True))
+    return sorted(ids)
+
+
+def get_changes(user, since):
+    """
+    Returns the compact changes of user's rows modified after the since cursor,
+    eg. {'cursor': '...', 'more': False, 'deposits': {'fields': [...],
+    'rows': [[...], ...], 'removed': [...]}}. Types without changes are left
+    out, as are removed lists which are empty. While more is
+    true the client should sync again right away with the returned cursor.
+    """
+    since = parse_cursor(since)
+    page_size = settings.CHANGES['PAGE_SIZE']
+    horizon = timezone.now() - timedelta(seconds=settings.CHANGES['SETTLE_SECONDS'])
+    pages = []
+    boundary = None
+    for name, queryset, fields, converters, removals in change_sets(user):
+        rows, more = changed_rows(queryset, fields, since, page_size)
+        if more:
+            last = rows[-1][0]
+            boundary = last if boundary is None else min(boundary, last)
+        pages.append((name, queryset, rows, fields, converters, removals))
+    if boundary is None:
+        cursor = max(since, horizon)
+    else:
+        # other types continue from the same cursor on the next page
+        cursor = boundary
+    changes = {'cursor': format_cursor(cursor), 'more': boundary is not None}
+    for name, queryset, rows, fields, converters, removals in pages:
+        rows = [
+            [
+                value if convert is None or value is None else convert(value)
+                for convert, value in zip(converters, row[1:])
+            ]
+            for row in rows
+            if boundary is None or row[0] <= boundary
+        ]
+        # removals are few, they are not paged but follow the same boundary
+        removed = [] if removals is None else removed_ids(
+            removals, queryset, since, boundary)
+        if rows or removed:
+            changes[name] = {
+                'fields': [field.split('__')[0] for field in fields],
+                'rows': rows,
+            }
+        if removed:
+            changes[name]['removed'] = removed
+    return changes
@@ -0,0 +1,57 @@
+"""
+Conditional GET of list endpoints. Validators are computed from the number of
+listed rows and their latest `modified` in a single aggregate query, a client
+whose ETag or Last-Modified still matches gets 304 Not Modified without the
+rows being loaded or serialized.
+
+`modified` is set before commit, so a row committed late can carry an older
+`modified` than the latest one and leave the validators unchanged. Validators
+are therefore used only once the latest change is older than
+CHANGES['SETTLE_SECONDS'], see api/changes.py.
+"""
+from django.conf import settings
+from django.db.models import Count, Max
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import http_date
+
+import time
+
+
+def get_validators(queryset):
+    """Returns (weak etag, last modified timestamp or None) of the queryset."""
+    stats = queryset.order_by().aggregate(count=Count('pk'), latest=Max('modified'))
+    latest = stats['latest']
+    if latest is None:
+        return 'W/"0"', None
+    return (
+        'W/"{}-{}"'.format(stats['count'], int(latest.timestamp() * 10**6)),
+        int(latest.timestamp()),
+    )
+
+
+def is_settled(last_modified):
+    return (
+        last_modified is None or
+        last_modified < time.time() - settings.CHANGES['SETTLE_SECONDS']
+    )
+
+
+def not_modified(request, etag, last_modified):
+    """Returns a 304 response if the request's validators match or None."""
+    if not is_settled(last_modified):
+        return None
+    response = get_conditional_response(
+        request, etag=etag, last_modified=last_modified)
+    if response is not None:
+        set_validators(response, etag, last_modified)
+    return response
+
+
+def set_validators(response, etag, last_modified):
+    # without no-cache browsers could reuse the response without asking
+    patch_cache_control(response, private=True, no_cache=True)
+    if is_settled(last_modified):
+        response['ETag'] = etag
+        if last_modified is not None:
+            response['Last-Modified'] = http_date(last_modified)
+    return response
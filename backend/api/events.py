@@ -0,0 +1,55 @@
+"""
+Per-user events about deposits, withdrawals and balances, published to redis
+when the transaction which changed them commits. Clients receive them through
+the event stream, see sse.py.
+"""
+from django.db import transaction
+from .helpers import format_grin, get_redis_connection
+
+import json
+import logging
+
+logger = logging.getLogger(__name__)
+
+CHANNEL = 'events:user:{}'
+CHANNEL_PATTERN = 'events:user:*'
+
+
+def transfer_event(transfer):
+    """Event of a deposit or withdrawal, status or confirmations changed."""
+    return {
+        'type': transfer._meta.model_name,
+        'data': {
+            'id': transfer.pk,
+            'status': transfer.status,
+            'confirmations': transfer.confirmations,
+        },
+    }
+
+
+def balance_event(balance):
+    return {
+        'type': 'balance',
+        'data': {
+            'id': balance.pk,
+            'amount': format_grin(balance.amount),
+            'locked_amount': format_grin(balance.locked_amount),
+        },
+    }
+
+
+def send_events(events):
+    try:
+        pipeline = get_redis_connection().pipeline(transaction=False)
+        for user_id, event in events:
+            pipeline.publish(CHANNEL.format(user_id), json.dumps(event))
+        pipeline.execute()
+    except Exception:
+        # events only save clients a refresh, they must not fail the caller
+        logger.exception('Failed to publish {} events'.format(len(events)))
+
+
+def publish_events(events):
+    """Publishes (user id, event) pairs once the current transaction commits."""
+    if events:
+        transaction.on_commit(lambda: send_events(events))
@@ -0,0 +1,174 @@
+from datetime import timedelta
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+from .models import Balance, Deposit, Withdrawal
+from .node import NodeV2API, NodeError
+from .serializers import DepositSerializer, WithdrawalSerializer
+from .wallet import WalletV3
+
+import logging
+import requests
+
+logger = logging.getLogger(__name__)
+
+SERIALIZERS = {
+    Deposit: DepositSerializer,
+    Withdrawal: WithdrawalSerializer,
+}
+
+
+class FinalizationError(Exception):
+    """Signed transaction could not be finalized, message is for the user."""
+    pass
+
+
+def get_chain_height():
+    """Returns the height of the chain tip or None if the node is unreachable."""
+    try:
+        return NodeV2API().get_tip()['height']
+    except (NodeError, requests.RequestException):
+        logger.warning('Failed to get the chain height from the node')
+        return None
+
+
+@transaction.atomic
+def abort_finalization(model, transfer_id, unclaimed=False):
+    """
+    Moves the transfer back to step-1 so that the user can sign it again. With
+    unclaimed, only if no finish job started posting it. Returns whether the
+    transfer was aborted.
+    """
+    transfers = model.objects.select_for_update(of=('self',)).filter(
+        pk=transfer_id, status='finalizing')
+    if unclaimed:
+        transfers = transfers.filter(post_started=None)
+    transfer = transfers.first()
+    if transfer is None:
+        return False
+    transfer.status = 'awaiting transaction signature'
+    transfer.post_started = None
+    transfer.save()
+    return True
+
+
+@transaction.atomic
+def confirm_posted(model, transfer_id, kernel_excess):
+    """
+    Moves a finalizing transfer whose transaction was posted to awaiting
+    confirmation. Returns the transfer or None if it's no longer finalizing.
+    """
+    transfer = model.objects.select_for_update(of=('self',)).filter(
+        pk=transfer_id, status='finalizing').first()
+    if transfer is not None:
+        transfer.status = 'awaiting confirmation'
+        transfer.kernel_excess = kernel_excess
+        transfer.save()
+    return transfer
+
+
+def finalize_transfer(model, transfer_id, slate):
+    """
+    Finalizes and posts the signed slate of a finalizing deposit or withdrawal
+    and moves it to awaiting confirmation. The wallet is called outside of a
+    database transaction, so a slow wallet doesn't hold any locks. Returns the
+    serialized transfer.
+
+    Once the transaction might have been posted, the transfer never goes back
+    to step-1 from here. If posting or the lookup of the posted transaction
+    fails, the transfer is left to recover_finalizing.
+    """
+    wallet_api = WalletV3.get_wallet_api()
+    # the kernel can't be in a block below the current tip, confirmations
+    # task starts searching for it there
+    broadcast_height = get_chain_height()
+    # claim the transfer, the sweeper might have aborted it while the job was
+    # queued and then it must not be posted
+    claimed = model.objects.filter(
+        pk=transfer_id, status='finalizing', post_started=None
+    ).update(post_started=timezone.now(), broadcast_height=broadcast_height)
+    if not claimed:
+        logger.warning('{} {} is no longer finalizing'.format(
+            model._meta.verbose_name, transfer_id))
+        raise FinalizationError('Transaction finalization failed')
+    try:
+        final_slate = wallet_api.finalize_tx(slate)
+    except Exception:
+        # nothing was posted yet
+        logger.exception('Failed to finalize the transaction')
+        abort_finalization(model, transfer_id)
+        raise FinalizationError('Transaction finalization failed')
+    try:
+        wallet_api.post_tx(final_slate)
+        tx = wallet_api.retrieve_txs(
+            tx_slate_id=final_slate['id'], refresh=False)[0]
+    except Exception:
+        # eg. a timeout after the node accepted the transaction, so it must
+        # not go back to step-1 where it could be canceled
+        logger.exception('Failed to post or retrieve transaction {}'.format(
+            final_slate['id']))
+        raise FinalizationError('Something went wrong')
+    with transaction.atomic():
+        transfer = confirm_posted(model, transfer_id, tx['kernel_excess'])
+        if transfer is None:
+            # recover_finalizing confirmed it meanwhile
+            transfer = model.objects.get(pk=transfer_id)
+        # show the newly locked amount in the result
+        transfer.balance = Balance.materialize(
+            [transfer.balance_id])[transfer.balance_id]
+        return SERIALIZERS[model](transfer).data
+
+
+def repost(wallet_api, tx_slate_id):
+    """Posts the stored transaction again, the node ignores a known one."""
+    try:
+        wallet_api.post_tx(wallet_api.get_stored_tx(slate_id=tx_slate_id))
+    except Exception:
+        # eg. it's already in a block
+        logger.warning('Failed to repost transaction {}'.format(tx_slate_id))
+
+
+def recover_finalizing(wallet_api):
+    """
+    Resumes finalizations which were interrupted, eg. by a failed post_tx or
+    a dead worker. Stale transfers which no finish job claimed are aborted.
+    For claimed ones the wallet decides: a transaction which was never
+    finalized couldn't have been posted, so the transfer is aborted, otherwise
+    it's posted again and moved to awaiting confirmation. Returns the number
+    of recovered transfers.
+    """
+    cutoff = timezone.now() - timedelta(
+        minutes=settings.FINALIZE_SWEEPER['STALE_MINUTES'])
+    recovered = 0
+    for model in (Deposit, Withdrawal):
+        stale = model.objects.filter(status='finalizing').filter(
+            Q(post_started=None, modified__lt=cutoff) |
+            Q(post_started__lt=cutoff)
+        ).order_by('pk').values_list('pk', 'tx_slate_id', 'post_started')
+        for transfer_id, tx_slate_id, post_started in stale:
+            if post_started is None:
+                # the finish job is stuck in the queue or died, if it runs
+                # later its claim fails
+                if abort_finalization(model, transfer_id, unclaimed=True):
+                    logger.warning('Aborted stale finalizing {} {}'.format(
+                        model._meta.verbose_name, transfer_id))
+                continue
+            try:
+                txs = wallet_api.retrieve_txs(
+                    tx_slate_id=tx_slate_id, refresh=False)
+            except Exception:
+                # tried again on the next run
+                logger.exception('Failed to retrieve transaction {}'.format(
+                    tx_slate_id))
+                continue
+            kernel_excess = txs[0].get('kernel_excess') if txs else None
+            if kernel_excess is None:
+                logger.warning('Aborted finalizing {} {}, it was not finalized'.format(
+                    model._meta.verbose_name, transfer_id))
+                abort_finalization(model, transfer_id)
+                continue
+            repost(wallet_api, tx_slate_id)
+            if confirm_posted(model, transfer_id, kernel_excess) is not None:
+                recovered += 1
+    return recovered
@@ -0,0 +1,219 @@
+from datetime import timedelta
+from django.conf import settings
+from django.db import transaction
+from .models import Deposit, Withdrawal, ScanCheckpoint
+from .node import NodeError
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def get_pending_transfers():
+    """Deposits and withdrawals which still need confirmations."""
+    # no ordering, so that the partial index of pending transfers is used
+    deposits = list(Deposit.objects.filter(
+        confirmations__lt=settings.REQUIRED_CONFIRMATIONS,
+        status="awaiting confirmation"
+    ).order_by())
+    withdrawals = list(Withdrawal.objects.filter(
+        confirmations__lt=settings.REQUIRED_CONFIRMATIONS,
+        status="awaiting confirmation"
+    ).order_by())
+    return deposits + withdrawals
+
+
+def lookup_kernel_heights(node_api, transfers, current_height):
+    """
+    Searches for kernels of the given transfers and sets kernel_height on the
+    ones which were found. Lookups are done in batches, one request per batch.
+    Returns the transfers whose kernel was found.
+    """
+    found = []
+    batch_size = settings.NODE_API['BATCH_SIZE']
+    for i in range(0, len(transfers), batch_size):
+        batch = transfers[i:i + batch_size]
+        # kernel can't be in a block older than the one at which the tx was
+        # broadcasted. Transfers without broadcast height are searched one
+        # week back max, that speeds the search
+        min_height = min(
+            transfer.broadcast_height or current_height - 60*24*7
+            for transfer in batch
+        )
+        kernels = node_api.get_kernels(
+            [transfer.kernel_excess for transfer in batch], min_height)
+        for transfer, kernel in zip(batch, kernels):
+            if isinstance(kernel, NodeError):
+                logger.warning('Kernel lookup failed: {}'.format(kernel))
+            elif kernel is not None:
+                transfer.kernel_height = kernel['height']
+                found.append(transfer)
+    return found
+
+
+def scan_blocks(node_api, start_height, end_height, previous_hash, index):
+    """
+    Fetches blocks from start_height to end_height (inclusive) and sets
+    kernel_height on the transfers from index (kernel excess -> transfer)
+    whose kernel is in one of them. Stops early if a block doesn't build on
+    the previous one (reorg).
+
+    Returns (last processed height, its hash, matched transfers).
+    """
+    batch_size = settings.NODE_API['BATCH_SIZE']
+    height = start_height - 1
+    matched = []
+    for batch_start in range(start_height, end_height + 1, batch_size):
+        heights = list(range(
+            batch_start, min(batch_start + batch_size, end_height + 1)))
+        for block in node_api.get_blocks(heights):
+            header = block['header']
+            if previous_hash is not None and header['previous'] != previous_hash:
+                logger.warning('Block {} does not build on {}, reorg'.format(
+                    header['hash'], previous_hash))
+                return height, previous_hash, matched
+            for kernel in block['kernels']:
+                transfer = index.get(kernel['excess'])
+                if transfer is not None:
+                    transfer.kernel_height = header['height']
+                    matched.append(transfer)
+            height = header['height']
+            previous_hash = header['hash']
+    return height, previous_hash, matched
+
+
+def update_confirmations(transfers, current_height, changed):
+    """
+    Computes confirmations from the kernel heights and saves transfers which
+    have new confirmations or are in changed (eg. newly found kernel height).
+    Saving is done in bulk, see bulk_update_confirmations.
+    """
+    to_update = []
+    for deposit_or_withdrawal in transfers:
+        kernel_height = deposit_or_withdrawal.kernel_height
+        if kernel_height is None:
+            # kernel is not yet on the chain. It could be that it was just
+            # created and has not been mined yet or transaction broadcast
+            # didn't go through for some reason.
+            if deposit_or_withdrawal in changed:
+                to_update.append(deposit_or_withdrawal)
+            continue
+        if kernel_height > current_height:
+            # race condition, new block came between node calls, pretend you
+            # fetched before we got this new block, otherwise number of
+            # confirmations from different txs might not make sense
+            continue
+        new_confirmations = min(
+            current_height - kernel_height + 1,
+            settings.REQUIRED_CONFIRMATIONS
+        )
+        if (
+            new_confirmations == deposit_or_withdrawal.confirmations and
+            deposit_or_withdrawal not in changed
+        ):
+            # nothing changed
+            continue
+        deposit_or_withdrawal.confirmations = new_confirmations
+        to_update.append(deposit_or_withdrawal)
+    Deposit.bulk_update_confirmations(
+        [transfer for transfer in to_update if isinstance(transfer, Deposit)])
+    Withdrawal.bulk_update_confirmations(
+        [transfer for transfer in to_update if isinstance(transfer, Withdrawal)])
+
+
+class BlockFollower:
+    """
+    Updates confirmations of pending deposits and withdrawals by following the
+    chain. Every run fetches only blocks which were added since the last run
+    and matches their kernels against the kernels of pending transfers, so the
+    cost depends on the number of new blocks, not on the number of pending
+    transfers. The last processed block is stored in a ScanCheckpoint so that
+    a restart resumes where it stopped.
+    """
+    CHECKPOINT_NAME = 'confirmations'
+    # transfers modified within this period before the last run might have
+    # not been committed yet when that run scanned its blocks, their kernels
+    # are looked up directly
+    LATE_TRANSFER_PERIOD = timedelta(minutes=10)
+
+    def __init__(self, node_api):
+        self.node_api = node_api
+        follower_settings = settings.BLOCK_FOLLOWER
+        self.max_blocks = follower_settings['MAX_BLOCKS_PER_RUN']
+        self.reorg_depth = follower_settings['REORG_DEPTH']
+
+    @transaction.atomic
+    def run(self):
+        tip = self.node_api.get_tip()
+        tip_height = tip['height']
+        # the lock makes sure only one run at a time moves the checkpoint
+        checkpoint = ScanCheckpoint.objects.select_for_update().filter(
+            name=self.CHECKPOINT_NAME).first()
+        transfers = get_pending_transfers()
+        # index of kernels we are still looking for
+        index = {
+            transfer.kernel_excess: transfer for transfer in transfers
+            if transfer.kernel_height is None and transfer.kernel_excess
+        }
+        changed = set()
+        if checkpoint is None:
+            # first run, there are no scanned blocks yet so we look up all
+            # pending kernels directly and start following from the tip
+            changed.update(lookup_kernel_heights(
+                self.node_api, list(index.values()), tip_height))
+            checkpoint = ScanCheckpoint(
+                name=self.CHECKPOINT_NAME,
+                height=tip_height,
+                block_hash=tip['last_block_pushed']
+            )
+        else:
+            late_since = checkpoint.modified - self.LATE_TRANSFER_PERIOD
+            late = [
+                transfer for transfer in index.values()
+                if transfer.modified >= late_since
+            ]
+            changed.update(lookup_kernel_heights(
+                self.node_api, late, checkpoint.height))
+            if tip_height < checkpoint.height:
+                # the chain got shorter, rescan the last few blocks
+                self.rewind(checkpoint, tip_height, transfers, changed)
+            end_height = min(tip_height, checkpoint.height + self.max_blocks)
+            if end_height > checkpoint.height:
+                index = {
+                    excess: transfer for excess, transfer in index.items()
+                    if transfer.kernel_height is None
+                }
+                height, block_hash, matched = scan_blocks(
+                    self.node_api,
+                    checkpoint.height + 1,
+                    end_height,
+                    checkpoint.block_hash,
+                    index
+                )
+                changed.update(matched)
+                if height == checkpoint.height:
+                    # the first new block doesn't build on the checkpoint
+                    self.rewind(
+                        checkpoint, checkpoint.height - self.reorg_depth,
+                        transfers, changed)
+                else:
+                    checkpoint.height = height
+                    checkpoint.block_hash = block_hash
+            # confirmations can't go beyond what we've processed
+            tip_height = min(tip_height, checkpoint.height)
+        update_confirmations(transfers, tip_height, changed)
+        checkpoint.save()
+
+    def rewind(self, checkpoint, height, transfers, changed):
+        """
+        Moves the checkpoint back to the given height and forgets kernel
+        heights above it, they will be matched again when blocks are rescanned.
+        """
+        height = max(height, 0)
+        checkpoint.height = height
+        checkpoint.block_hash = self.node_api.get_header(height)['hash']
+        for transfer in transfers:
+            if transfer.kernel_height is not None and transfer.kernel_height > height:
+                transfer.kernel_height = None
+                transfer.confirmations = 0
+                changed.add(transfer)
@@ -1,5 +1,39 @@
+from django.conf import settings
 from guardian.shortcuts import assign_perm
 
+from decimal import Decimal, ROUND_DOWN
+
+import redis
+import threading
+
+# number of nanogrin in one grin, amounts are stored in nanogrin
+NANOGRIN = 10**9
+
+_redis_connection = None
+_redis_connection_lock = threading.Lock()
+
+
+def get_redis_connection():
+    """Returns the process-wide redis client for REDIS_LOCATION."""
+    global _redis_connection
+    with _redis_connection_lock:
+        if _redis_connection is None:
+            _redis_connection = redis.Redis.from_url(settings.REDIS_LOCATION)
+        return _redis_connection
+
+
+def grin_to_nanogrin(amount):
+    """Converts grin amount (str, int or Decimal) to integer nanogrin."""
+    nanogrin = Decimal(str(amount)) * NANOGRIN
+    return int(nanogrin.to_integral_value(rounding=ROUND_DOWN))
+
+
+def format_grin(nanogrin):
+    """Formats nanogrin as grin with all 9 decimal places, eg. '1.500000000'."""
+    sign = '-' if nanogrin < 0 else ''
+    whole, fraction = divmod(abs(nanogrin), NANOGRIN)
+    return '{}{}.{:09d}'.format(sign, whole, fraction)
+
 
 def assign_default_model_permissions(user):
     default_model_perms = [
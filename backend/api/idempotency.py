@@ -0,0 +1,158 @@
+"""
+Idempotency-Key support for the deposit and withdrawal start/finish actions.
+A successful response is kept in redis for IDEMPOTENCY['TTL_SECONDS'] under
+user's key, a retried request with the same key gets it back without calling
+the wallet again. Failed requests are not kept, they can be retried.
+"""
+from django.conf import settings
+from django.db import transaction
+from rest_framework import status
+from rest_framework.response import Response
+from .helpers import get_redis_connection
+
+import functools
+import hashlib
+import json
+
+HEADER = 'HTTP_IDEMPOTENCY_KEY'
+KEY = 'idempotency:{}:{}:{}'
+
+
+class IdempotencyError(Exception):
+    """Request can't be run with the given key, message is for the user."""
+
+    def __init__(self, detail, status_code):
+        self.status_code = status_code
+        super().__init__(detail)
+
+
+def get_idempotency_key(request):
+    """Returns the Idempotency-Key of the request or None."""
+    key = request.META.get(HEADER)
+    if not key:
+        return None
+    if len(key) > settings.IDEMPOTENCY['MAX_KEY_LENGTH']:
+        raise IdempotencyError(
+            'Idempotency-Key is too long', status.HTTP_400_BAD_REQUEST)
+    return key
+
+
+def fingerprint(data):
+    """Hash of the request data, a key can't be reused for another request."""
+    return hashlib.sha256(
+        json.dumps(data, sort_keys=True, default=str).encode()).hexdigest()
+
+
+class IdempotentRequest:
+    """Request with an Idempotency-Key, scope is eg. the action's path."""
+
+    def __init__(self, user, scope, key, data):
+        self.redis_key = KEY.format(user.pk, scope, key)
+        self.fingerprint = fingerprint(data)
+
+    def begin(self):
+        """
+        Reserves the key and returns None if the request should run, returns
+        the kept response (dict with status, data and headers) if it already
+        ran. Raises IdempotencyError if the key is used by another request or
+        a request with it is still running.
+        """
+        connection = get_redis_connection()
+        reserved = connection.set(
+            self.redis_key,
+            json.dumps({'fingerprint': self.fingerprint, 'response': None}),
+            nx=True,
+            # a crashed worker can't keep the key reserved forever
+            ex=settings.IDEMPOTENCY['LOCK_SECONDS'],
+        )
+        if reserved:
+            return None
+        stored = connection.get(self.redis_key)
+        if stored is None:
+            # expired meanwhile, the client can retry
+            raise IdempotencyError(
+                'A request with this Idempotency-Key is in progress',
+                status.HTTP_409_CONFLICT)
+        stored = json.loads(stored)
+        if stored['fingerprint'] != self.fingerprint:
+            raise IdempotencyError(
+                'Idempotency-Key was already used for a different request',
+                status.HTTP_422_UNPROCESSABLE_ENTITY)
+        if stored['response'] is None:
+            raise IdempotencyError(
+                'A request with this Idempotency-Key is in progress',
+                status.HTTP_409_CONFLICT)
+        return stored['response']
+
+    def finish(self, status_code, data, headers):
+        """Keeps a successful response, frees the key otherwise."""
+        if not 200 <= status_code < 300:
+            self.abort()
+            return
+        get_redis_connection().set(
+            self.redis_key,
+            json.dumps({
+                'fingerprint': self.fingerprint,
+                'response': {
+                    'status': status_code,
+                    'data': data,
+                    'headers': headers,
+                },
+            }),
+            ex=settings.IDEMPOTENCY['TTL_SECONDS'],
+        )
+
+    def abort(self):
+        get_redis_connection().delete(self.redis_key)
+
+
+def error_response(error):
+    return Response(data={'detail': str(error)}, status=error.status_code)
+
+
+def replay_response(stored):
+    response = Response(
+        data=stored['data'], status=stored['status'], headers=stored['headers'])
+    response['Idempotent-Replayed'] = 'true'
+    return response
+
+
+def idempotent(func):
+    """
+    Makes a DRF action idempotent for requests with an Idempotency-Key. The
+    response is kept only when the transaction commits, a rolled back request
+    frees the key.
+    """
+    @functools.wraps(func)
+    def wrapper(self, request, *args, **kwargs):
+        try:
+            key = get_idempotency_key(request)
+        except IdempotencyError as e:
+            return error_response(e)
+        if key is None:
+            return func(self, request, *args, **kwargs)
+        idempotent_request = IdempotentRequest(
+            request.user, request.path, key, request.data)
+        try:
+            stored = idempotent_request.begin()
+        except IdempotencyError as e:
+            return error_response(e)
+        if stored is not None:
+            return replay_response(stored)
+        try:
+            response = func(self, request, *args, **kwargs)
+        except Exception:
+            idempotent_request.abort()
+            raise
+        headers = {}
+        if 'Location' in response:
+            headers['Location'] = response['Location']
+        if 200 <= response.status_code < 300:
+            # if the transaction rolls back the key stays reserved only until
+            # LOCK_SECONDS pass, then the request can be retried
+            transaction.on_commit(lambda: idempotent_request.finish(
+                response.status_code, response.data, headers))
+        else:
+            idempotent_request.abort()
+        return response
+    return wrapper
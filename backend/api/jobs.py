@@ -0,0 +1,60 @@
+"""
+Status of background jobs started by a request, eg. finishing a deposit. Jobs
+are kept in redis for FINISH_JOBS['TTL_SECONDS'] so that the client can poll
+for the result.
+"""
+from django.conf import settings
+from .helpers import get_redis_connection
+
+import json
+import uuid
+
+JOB_KEY = 'job:{}'
+
+PENDING = 'pending'
+DONE = 'done'
+FAILED = 'failed'
+
+
+def save_job(job):
+    get_redis_connection().set(
+        JOB_KEY.format(job['id']),
+        json.dumps(job),
+        ex=settings.FINISH_JOBS['TTL_SECONDS'],
+    )
+
+
+def create_job(user, kind):
+    """Creates a pending job of the given user and returns it."""
+    job = {
+        'id': uuid.uuid4().hex,
+        'kind': kind,
+        'user': user.pk,
+        'status': PENDING,
+        'result': None,
+        'detail': None,
+    }
+    save_job(job)
+    return job
+
+
+def get_job(job_id):
+    """Returns the job or None if it doesn't exist (anymore)."""
+    data = get_redis_connection().get(JOB_KEY.format(job_id))
+    if data is None:
+        return None
+    return json.loads(data)
+
+
+def complete_job(job_id, result):
+    job = get_job(job_id)
+    if job is not None:
+        job.update(status=DONE, result=result)
+        save_job(job)
+
+
+def fail_job(job_id, detail):
+    job = get_job(job_id)
+    if job is not None:
+        job.update(status=FAILED, detail=detail)
+        save_job(job)
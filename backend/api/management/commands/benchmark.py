@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand
+from backend.api.benchmarks import BENCHMARKS
+
+
+class Command(BaseCommand):
+    help = 'Run a benchmark, see backend/api/benchmarks.py'
+
+    def add_arguments(self, parser):
+        parser.add_argument('name', choices=sorted(BENCHMARKS))
+        parser.add_argument(
+            '--iterations',
+            type=int,
+            help='Override the default number of iterations',
+        )
+
+    def handle(self, *args, **kwargs):
+        benchmark = BENCHMARKS[kwargs['name']]
+        options = {}
+        if kwargs['iterations']:
+            options['iterations'] = kwargs['iterations']
+        self.stdout.write(self.style.NOTICE(
+            'Running benchmark {}'.format(kwargs['name'])))
+        benchmark(self.stdout, **options)
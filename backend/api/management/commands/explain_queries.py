@@ -0,0 +1,83 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.db.models import Q
+from backend.api.benchmarks import create_transfers, create_users
+from backend.api.models import Deposit, Withdrawal
+
+# mostly settled history with a few pending transfers
+STATUSES = (
+    ('awaiting transaction signature',) +
+    ('awaiting confirmation',) * 2 +
+    ('canceled',) * 7 +
+    ('finished',) * 90
+)
+
+
+def hot_queries(model, user):
+    """(description, queryset) pairs of the hot queries on the given model."""
+    name = model._meta.verbose_name_plural
+    return (
+        ('{} awaiting confirmations'.format(name), model.objects.filter(
+            confirmations__lt=settings.REQUIRED_CONFIRMATIONS,
+            status='awaiting confirmation',
+        ).order_by()),
+        ("user's step-1 {}".format(name), model.objects.filter(
+            status='awaiting transaction signature',
+            balance__currency__symbol='bench',
+            balance__user=user,
+        )),
+        ("first page of user's {} history".format(name), model.objects.filter(
+            ~Q(status='awaiting transaction signature'),
+            balance__user=user,
+        ).order_by(
+            '-created', '-id'
+        )[:settings.HISTORY_PAGINATION['PAGE_SIZE']]),
+    )
+
+
+class Command(BaseCommand):
+    help = (
+        'Print EXPLAIN plans of the hot deposit and withdrawal queries on a '
+        'generated dataset, nothing is saved'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--transfers',
+            type=int,
+            default=100000,
+            help='Number of generated deposits and of generated withdrawals',
+        )
+        parser.add_argument(
+            '--users',
+            type=int,
+            default=1000,
+            help='Number of users the transfers are spread over',
+        )
+        parser.add_argument(
+            '--analyze',
+            action='store_true',
+            help='Run the queries and show actual times (PostgreSQL only)',
+        )
+
+    def handle(self, *args, **kwargs):
+        options = {}
+        if kwargs['analyze']:
+            options['analyze'] = True
+        with transaction.atomic():
+            users, balance_ids = create_users(kwargs['users'])
+            for model in (Deposit, Withdrawal):
+                create_transfers(
+                    model, balance_ids, kwargs['transfers'], STATUSES)
+            if connection.vendor == 'postgresql':
+                # fresh statistics, otherwise the planner doesn't know the
+                # tables grew
+                with connection.cursor() as cursor:
+                    cursor.execute('ANALYZE')
+            for model in (Deposit, Withdrawal):
+                for description, queryset in hot_queries(model, users[0]):
+                    self.stdout.write(self.style.NOTICE(description))
+                    self.stdout.write(queryset.explain(**options))
+                    self.stdout.write('')
+            transaction.set_rollback(True)
@@ -0,0 +1,82 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models import BigIntegerField, F, OuterRef, Subquery, Sum, Value
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+from backend.api.caching import balance_cache
+from backend.api.models import Balance, LedgerEntry
+
+
+def ledger_total(field, entries):
+    """Subquery summing the given field of entries per balance."""
+    return Coalesce(
+        Subquery(
+            entries.filter(balance=OuterRef('pk'))
+            .order_by()
+            .values('balance')
+            .annotate(total=Sum(field))
+            .values('total')
+        ),
+        Value(0),
+        output_field=BigIntegerField(),
+    )
+
+
+class Command(BaseCommand):
+    help = 'Rebuild balance amounts from the ledger or check that they match it'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--check',
+            action='store_true',
+            help='Only report balances which differ from their applied entries',
+        )
+
+    def handle(self, *args, **kwargs):
+        if kwargs['check']:
+            self.check_balances()
+        else:
+            self.rebuild_balances()
+
+    def check_balances(self):
+        applied = LedgerEntry.objects.filter(applied=True)
+        mismatched = Balance.objects.annotate(
+            ledger_amount=ledger_total('amount', applied),
+            ledger_locked_amount=ledger_total('locked_amount', applied),
+        ).exclude(
+            amount=F('ledger_amount'),
+            locked_amount=F('ledger_locked_amount'),
+        )
+        count = 0
+        for balance in mismatched.values(
+            'pk', 'amount', 'locked_amount', 'ledger_amount', 'ledger_locked_amount'
+        ).iterator():
+            count += 1
+            self.stdout.write(self.style.ERROR(
+                'Balance {pk}: amount {amount} (ledger {ledger_amount}), '
+                'locked {locked_amount} (ledger {ledger_locked_amount})'
+                .format(**balance)
+            ))
+        if count:
+            raise CommandError('{} balances differ from the ledger'.format(count))
+        self.stdout.write(self.style.SUCCESS('All balances match the ledger'))
+
+    @transaction.atomic
+    def rebuild_balances(self):
+        # same lock order as Balance.materialize, balances first
+        list(Balance.objects.select_for_update().order_by('pk').values_list('pk'))
+        # entries committed after this point stay pending and are applied by
+        # the next materialization
+        pending_ids = list(LedgerEntry.objects.filter(
+            applied=False).values_list('pk', flat=True))
+        LedgerEntry.objects.filter(pk__in=pending_ids).update(applied=True)
+        applied = LedgerEntry.objects.filter(applied=True)
+        updated = Balance.objects.update(
+            amount=ledger_total('amount', applied),
+            locked_amount=ledger_total('locked_amount', applied),
+            modified=timezone.now(),
+        )
+        balance_cache.invalidate_all()
+        self.stdout.write(self.style.SUCCESS(
+            'Rebuilt {} balances, applied {} pending entries'.format(
+                updated, len(pending_ids))))
@@ -1,6 +1,13 @@
 from apscheduler.schedulers.background import BlockingScheduler
+from django.conf import settings
 from django.core.management.base import BaseCommand, CommandError
-from backend.api.periodic_tasks import periodically_run_job
+from backend.api.periodic_tasks import (
+    periodically_materialize_balances,
+    periodically_reap_abandoned_transfers,
+    periodically_recover_finalizing_transfers,
+    periodically_run_job,
+    watch_tip,
+)
 from pytz import UTC
 
 
@@ -10,6 +17,38 @@ class Command(BaseCommand):
     def handle(self, *args, **kwargs):
         self.stdout.write(self.style.NOTICE('Preparing scheduler'))
         scheduler = BlockingScheduler(timezone=UTC)
-        scheduler.add_job(periodically_run_job, 'interval', minutes=1)
+        # confirmations are updated when a new block arrives
+        scheduler.add_job(
+            watch_tip,
+            'interval',
+            seconds=settings.TIP_WATCHER['INTERVAL_SECONDS'],
+            max_instances=1,
+            coalesce=True,
+        )
+        # fallback in case the watcher misses a tip change (eg. redis flush)
+        scheduler.add_job(
+            periodically_run_job,
+            'interval',
+            minutes=settings.TIP_WATCHER['FALLBACK_INTERVAL_MINUTES'],
+        )
+        # balances are also brought up to date on demand, this just keeps the
+        # number of pending ledger entries low
+        scheduler.add_job(
+            periodically_materialize_balances,
+            'interval',
+            seconds=settings.LEDGER['MATERIALIZE_INTERVAL_SECONDS'],
+        )
+        # abandoned step-1 transfers are cleaned up outside of user requests
+        scheduler.add_job(
+            periodically_reap_abandoned_transfers,
+            'interval',
+            minutes=settings.STEP1_REAPER['INTERVAL_MINUTES'],
+        )
+        # finalizations interrupted by a failed wallet call or a dead worker
+        scheduler.add_job(
+            periodically_recover_finalizing_transfers,
+            'interval',
+            minutes=settings.FINALIZE_SWEEPER['INTERVAL_MINUTES'],
+        )
         self.stdout.write(self.style.NOTICE('Start scheduler'))
         scheduler.start()
@@ -0,0 +1,60 @@
+# Generated by Django 3.1.5 on 2026-10-18 07:51
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+import model_utils.fields
+
+
+def create_opening_entries(apps, schema_editor):
+    """Balances from before the ledger get an entry with their amounts."""
+    Balance = apps.get_model('api', 'Balance')
+    LedgerEntry = apps.get_model('api', 'LedgerEntry')
+    LedgerEntry.objects.bulk_create(
+        [
+            LedgerEntry(
+                balance_id=balance_id,
+                kind='opening',
+                amount=amount,
+                locked_amount=locked_amount,
+                applied=True,
+            )
+            for balance_id, amount, locked_amount in Balance.objects.exclude(
+                amount=0, locked_amount=0
+            ).values_list('pk', 'amount', 'locked_amount').iterator()
+        ],
+        batch_size=1000,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0003_scancheckpoint'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LedgerEntry',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created', model_utils.fields.AutoCreatedField(default=django.utils.timezone.now, editable=False, verbose_name='created')),
+                ('modified', model_utils.fields.AutoLastModifiedField(default=django.utils.timezone.now, editable=False, verbose_name='modified')),
+                ('kind', models.CharField(choices=[('credit', 'credit'), ('debit', 'debit'), ('lock', 'lock'), ('unlock', 'unlock'), ('opening', 'opening')], max_length=255)),
+                ('amount', models.DecimalField(decimal_places=9, default=0, max_digits=30)),
+                ('locked_amount', models.DecimalField(decimal_places=9, default=0, max_digits=30)),
+                ('applied', models.BooleanField(default=False)),
+                ('balance', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='ledger_entries', to='api.balance')),
+                ('deposit', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='ledger_entries', to='api.deposit')),
+                ('withdrawal', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='ledger_entries', to='api.withdrawal')),
+            ],
+            options={
+                'verbose_name_plural': 'ledger entries',
+            },
+        ),
+        migrations.AddIndex(
+            model_name='ledgerentry',
+            index=models.Index(condition=models.Q(applied=False), fields=['balance'], name='ledger_entry_pending_idx'),
+        ),
+        migrations.RunPython(create_opening_entries, migrations.RunPython.noop),
+    ]
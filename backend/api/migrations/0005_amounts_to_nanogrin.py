@@ -0,0 +1,39 @@
+from django.db import migrations
+from django.db.models import F
+
+NANOGRIN = 10**9
+
+# model name -> amount fields
+AMOUNT_FIELDS = {
+    'Balance': ('amount', 'locked_amount'),
+    'Deposit': ('amount',),
+    'Withdrawal': ('amount',),
+    'LedgerEntry': ('amount', 'locked_amount'),
+}
+
+
+def to_nanogrin(apps, schema_editor):
+    """
+    Amounts are still decimal grin here, we convert them to nanogrin so that
+    the next migration can change the columns to integers.
+    """
+    for model_name, fields in AMOUNT_FIELDS.items():
+        model = apps.get_model('api', model_name)
+        model.objects.update(**{field: F(field) * NANOGRIN for field in fields})
+
+
+def to_grin(apps, schema_editor):
+    for model_name, fields in AMOUNT_FIELDS.items():
+        model = apps.get_model('api', model_name)
+        model.objects.update(**{field: F(field) / NANOGRIN for field in fields})
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0004_ledgerentry'),
+    ]
+
+    operations = [
+        migrations.RunPython(to_nanogrin, to_grin),
+    ]
@@ -0,0 +1,44 @@
+# Generated by Django 3.1.5 on 2026-10-18 07:53
+
+import django.core.validators
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0005_amounts_to_nanogrin'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='balance',
+            name='amount',
+            field=models.BigIntegerField(default=0, validators=[django.core.validators.MinValueValidator(0), django.core.validators.MaxValueValidator(9223372036854775807)]),
+        ),
+        migrations.AlterField(
+            model_name='balance',
+            name='locked_amount',
+            field=models.BigIntegerField(default=0, validators=[django.core.validators.MinValueValidator(0), django.core.validators.MaxValueValidator(9223372036854775807)]),
+        ),
+        migrations.AlterField(
+            model_name='deposit',
+            name='amount',
+            field=models.BigIntegerField(default=0, validators=[django.core.validators.MinValueValidator(0), django.core.validators.MaxValueValidator(9223372036854775807)]),
+        ),
+        migrations.AlterField(
+            model_name='ledgerentry',
+            name='amount',
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.AlterField(
+            model_name='ledgerentry',
+            name='locked_amount',
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.AlterField(
+            model_name='withdrawal',
+            name='amount',
+            field=models.BigIntegerField(default=0, validators=[django.core.validators.MinValueValidator(0), django.core.validators.MaxValueValidator(9223372036854775807)]),
+        ),
+    ]
@@ -0,0 +1,64 @@
+# Generated by Django 3.1.5 on 2026-10-18 12:10
+
+from django.db import migrations
+
+# (model, lookup to the owner's id)
+OWNED_MODELS = (
+    ('balance', 'user_id'),
+    ('deposit', 'balance__user_id'),
+    ('withdrawal', 'balance__user_id'),
+)
+
+
+def delete_object_permissions(apps, schema_editor):
+    """Access is decided by ownership, per-object permissions are not used."""
+    ContentType = apps.get_model('contenttypes', 'ContentType')
+    UserObjectPermission = apps.get_model('guardian', 'UserObjectPermission')
+    UserObjectPermission.objects.filter(
+        content_type__in=ContentType.objects.filter(
+            app_label='api',
+            model__in=[model for model, _ in OWNED_MODELS],
+        )
+    ).delete()
+
+
+def create_object_permissions(apps, schema_editor):
+    """Gives owners view permission on their objects again."""
+    ContentType = apps.get_model('contenttypes', 'ContentType')
+    Permission = apps.get_model('auth', 'Permission')
+    UserObjectPermission = apps.get_model('guardian', 'UserObjectPermission')
+    for model_name, owner_field in OWNED_MODELS:
+        model = apps.get_model('api', model_name)
+        content_type, _ = ContentType.objects.get_or_create(
+            app_label='api', model=model_name)
+        permission, _ = Permission.objects.get_or_create(
+            content_type=content_type,
+            codename='view_{}'.format(model_name),
+            defaults={'name': 'Can view {}'.format(model_name)},
+        )
+        UserObjectPermission.objects.bulk_create(
+            [
+                UserObjectPermission(
+                    permission=permission,
+                    content_type=content_type,
+                    object_pk=str(pk),
+                    user_id=user_id,
+                )
+                for pk, user_id in model.objects.values_list(
+                    'pk', owner_field).iterator()
+            ],
+            batch_size=1000,
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0006_integer_amounts'),
+        ('contenttypes', '0002_remove_content_type_name'),
+        ('guardian', '0002_generic_permissions_index'),
+    ]
+
+    operations = [
+        migrations.RunPython(delete_object_permissions, create_object_permissions),
+    ]
@@ -0,0 +1,45 @@
+# Generated by Django 3.1.5 on 2026-10-18 08:06
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0008_history_indexes'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='deposit',
+            name='deposit_history_idx',
+        ),
+        migrations.RemoveIndex(
+            model_name='withdrawal',
+            name='withdrawal_history_idx',
+        ),
+        migrations.AddIndex(
+            model_name='deposit',
+            index=models.Index(condition=models.Q(_negated=True, status='awaiting transaction signature'), fields=['balance', 'created', 'id'], name='deposit_history_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='deposit',
+            index=models.Index(condition=models.Q(status='awaiting transaction signature'), fields=['balance'], name='deposit_step1_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='deposit',
+            index=models.Index(condition=models.Q(status='awaiting confirmation'), fields=['confirmations'], name='deposit_unconfirmed_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='withdrawal',
+            index=models.Index(condition=models.Q(_negated=True, status='awaiting transaction signature'), fields=['balance', 'created', 'id'], name='withdrawal_history_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='withdrawal',
+            index=models.Index(condition=models.Q(status='awaiting transaction signature'), fields=['balance'], name='withdrawal_step1_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='withdrawal',
+            index=models.Index(condition=models.Q(status='awaiting confirmation'), fields=['confirmations'], name='withdrawal_unconfirmed_idx'),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 3.1.5 on 2026-10-18 08:08
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0009_pending_transfer_indexes'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='deposit',
+            name='status',
+            field=models.CharField(choices=[('awaiting transaction signature', 'awaiting transaction signature'), ('finalizing', 'finalizing'), ('awaiting confirmation', 'awaiting confirmation'), ('finished', 'finished'), ('canceled', 'canceled')], max_length=255),
+        ),
+        migrations.AlterField(
+            model_name='withdrawal',
+            name='status',
+            field=models.CharField(choices=[('awaiting transaction signature', 'awaiting transaction signature'), ('finalizing', 'finalizing'), ('awaiting confirmation', 'awaiting confirmation'), ('finished', 'finished'), ('canceled', 'canceled')], max_length=255),
+        ),
+    ]
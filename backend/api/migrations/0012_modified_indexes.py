@@ -0,0 +1,25 @@
+# Generated by Django 3.1.5 on 2026-10-18 08:26
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0011_api_keys'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='balance',
+            index=models.Index(fields=['user', 'modified', 'id'], name='balance_modified_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='deposit',
+            index=models.Index(condition=models.Q(_negated=True, status='awaiting transaction signature'), fields=['balance', 'modified', 'id'], name='deposit_modified_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='withdrawal',
+            index=models.Index(condition=models.Q(_negated=True, status='awaiting transaction signature'), fields=['balance', 'modified', 'id'], name='withdrawal_modified_idx'),
+        ),
+    ]
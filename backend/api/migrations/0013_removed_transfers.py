@@ -0,0 +1,31 @@
+# Generated by Django 3.1.5 on 2026-10-18 08:49
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+import model_utils.fields
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0012_modified_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RemovedTransfer',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created', model_utils.fields.AutoCreatedField(default=django.utils.timezone.now, editable=False, verbose_name='created')),
+                ('modified', model_utils.fields.AutoLastModifiedField(default=django.utils.timezone.now, editable=False, verbose_name='modified')),
+                ('kind', models.CharField(choices=[('deposit', 'deposit'), ('withdrawal', 'withdrawal')], max_length=255)),
+                ('transfer_id', models.PositiveIntegerField()),
+                ('balance', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='removed_transfers', to='api.balance')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='removedtransfer',
+            index=models.Index(fields=['balance', 'kind', 'modified'], name='removed_transfer_modified_idx'),
+        ),
+    ]
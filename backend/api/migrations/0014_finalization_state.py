@@ -0,0 +1,33 @@
+# Generated by Django 3.1.5 on 2026-10-18 08:51
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0013_removed_transfers'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='deposit',
+            name='final_slate_id',
+            field=models.CharField(blank=True, max_length=255, null=True),
+        ),
+        migrations.AddField(
+            model_name='deposit',
+            name='posted',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddField(
+            model_name='withdrawal',
+            name='final_slate_id',
+            field=models.CharField(blank=True, max_length=255, null=True),
+        ),
+        migrations.AddField(
+            model_name='withdrawal',
+            name='posted',
+            field=models.BooleanField(default=False),
+        ),
+    ]
@@ -0,0 +1,52 @@
+# Generated by Django 3.1.5 on 2026-10-18 08:59
+
+from django.db import migrations, models
+from django.utils import timezone
+
+
+def claim_finalizing(apps, schema_editor):
+    """
+    Transactions of transfers which are finalizing now might have been posted,
+    so they are checked with the wallet instead of being aborted.
+    """
+    for model_name in ('Deposit', 'Withdrawal'):
+        model = apps.get_model('api', model_name)
+        model.objects.filter(status='finalizing').update(
+            post_started=timezone.now())
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0014_finalization_state'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='deposit',
+            name='post_started',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='withdrawal',
+            name='post_started',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.RunPython(claim_finalizing, migrations.RunPython.noop),
+        migrations.RemoveField(
+            model_name='deposit',
+            name='final_slate_id',
+        ),
+        migrations.RemoveField(
+            model_name='deposit',
+            name='posted',
+        ),
+        migrations.RemoveField(
+            model_name='withdrawal',
+            name='final_slate_id',
+        ),
+        migrations.RemoveField(
+            model_name='withdrawal',
+            name='posted',
+        ),
+    ]
@@ -1,8 +1,24 @@
 from django_filters import rest_framework as additional_filters
 from rest_framework import authentication, filters, permissions, viewsets
-from rest_framework_guardian import filters as drf_guardian_filters
-from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework.response import Response
+from .authentication import ApiKeyAuthentication, ClaimsJWTAuthentication
+from .conditional import get_validators, not_modified, set_validators
 from .permissions import ObjectPermissions
+from .serializers import get_values_mapper
+
+
+class OwnershipFilter(filters.BaseFilterBackend):
+    """
+    Filters queryset to objects owned by the user, see view's `owner_field`.
+    Superusers see all objects, like with guardian's get_objects_for_user,
+    views without `owner_field` are not filtered.
+    """
+
+    def filter_queryset(self, request, queryset, view):
+        owner_field = getattr(view, 'owner_field', None)
+        if owner_field is None or request.user.is_superuser:
+            return queryset
+        return queryset.filter(**{owner_field: request.user})
 
 
 class DefaultMixin(object):
@@ -10,25 +26,27 @@ class DefaultMixin(object):
     Default settings for authentication, authorization and filtering. We support
     3 types of authentication:
 
-    1. Session authentication
-    2. Basic authentication sending username/password in every request
-    3. JWT authentication
+    1. JWT authentication, the user is built from the token's claims
+    2. API key authentication
+    3. Session authentication
+
+    Objects are scoped to their owner, `owner_field` is the lookup from the
+    model to the user who owns it.
     """
 
-    paginate_by = 50
-    paginate_by_param = 'page_size'
+    owner_field = None
 
     authentication_classes = (
+        ClaimsJWTAuthentication,
+        ApiKeyAuthentication,
         authentication.SessionAuthentication,
-        authentication.BasicAuthentication,
-        JWTAuthentication,
     )
 
     filter_backends = (
         additional_filters.DjangoFilterBackend,
         filters.SearchFilter,
         filters.OrderingFilter,
-        drf_guardian_filters.ObjectPermissionsFilter,
+        OwnershipFilter,
     )
     permission_classes = [
         permissions.IsAuthenticated,
@@ -44,6 +62,40 @@ class CustomModelViewSet(
     pass
 
 
+class ValuesListMixin():
+    """
+    List action builds the response from values() rows instead of serializing
+    model instances, see ValuesMapper. The output is the same as the one of
+    the viewset's serializer. It must be listed before the ModelViewSet.
+    """
+
+    def list(self, request, *args, **kwargs):
+        queryset = self.filter_queryset(self.get_queryset())
+        mapper = get_values_mapper(self.get_serializer_class())
+        queryset = queryset.values(*mapper.paths)
+        page = self.paginate_queryset(queryset)
+        if page is not None:
+            return self.get_paginated_response(mapper.map(page))
+        return Response(mapper.map(queryset))
+
+
+class ConditionalListMixin():
+    """
+    List answers 304 Not Modified when the client's ETag or Last-Modified
+    still match, see conditional.py. It must be listed before the
+    ValuesListMixin.
+    """
+
+    def list(self, request, *args, **kwargs):
+        # validators are computed before the rows are read, a change in
+        # between makes them older than the rows, never newer
+        etag, last_modified = get_validators(
+            self.filter_queryset(self.get_queryset()))
+        response = not_modified(request, etag, last_modified)
+        if response is None:
+            response = super().list(request, *args, **kwargs)
+        return set_validators(response, etag, last_modified)
+
 
 class AllowAnyRetrieveAndListMixin():
     """It must be listed before the ModelViewSet."""
@@ -57,11 +109,11 @@ class AllowAnyRetrieveAndListMixin():
         """
         permission_classes = [permissions.IsAuthenticated]
         if self.action in ['retrieve', 'list']:
-            # need to remove ObjectPermissionsFilter because it filters
-            # queryset results by <app>.view_<model> permission
+            # need to remove OwnershipFilter because it filters queryset
+            # results by owner
             self.filter_backends = [
                 filter_backend for filter_backend in self.filter_backends
-                if filter_backend != drf_guardian_filters.ObjectPermissionsFilter
+                if filter_backend != OwnershipFilter
             ]
         else:
             permission_classes.append(ObjectPermissions)
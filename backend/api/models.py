@@ -1,9 +1,17 @@
 from django.conf import settings
 from django.contrib.auth.models import User
+from django.core.exceptions import ValidationError
 from django.core.validators import MinValueValidator, MaxValueValidator
 from django.db import models, transaction
-from guardian.shortcuts import assign_perm
+from django.db.models import Q, Sum
+from django.utils import timezone
 from model_utils.models import TimeStampedModel
+from .caching import balance_cache
+from .events import balance_event, publish_events, transfer_event
+from .helpers import format_grin
+
+# amounts are stored in nanogrin (1 grin = 10^9 nanogrin) as 64-bit integers
+MAX_NANOGRIN = 2**63 - 1
 
 
 class Currency(TimeStampedModel):
@@ -30,24 +38,27 @@ class Balance(TimeStampedModel):
         related_name='balances',
         on_delete=models.CASCADE,
     )
-    amount = models.DecimalField(
-        max_digits=30,
-        decimal_places=9,
-        default=0.0,
-        validators=[MinValueValidator(0), MaxValueValidator(2**64)]
+    amount = models.BigIntegerField(
+        default=0,
+        validators=[MinValueValidator(0), MaxValueValidator(MAX_NANOGRIN)]
     )
-    locked_amount = models.DecimalField(
-        max_digits=30,
-        decimal_places=9,
-        default=0.0,
-        validators=[MinValueValidator(0), MaxValueValidator(2**64)]
+    locked_amount = models.BigIntegerField(
+        default=0,
+        validators=[MinValueValidator(0), MaxValueValidator(MAX_NANOGRIN)]
     )
 
+    class Meta:
+        indexes = [
+            # user's changed balances, see api/changes.py
+            models.Index(
+                fields=['user', 'modified', 'id'], name='balance_modified_idx'),
+        ]
+
     def __str__(self):
         return '{}, total: {}, locked: {}, user: {}'.format(
             self.currency.symbol,
-            self.amount,
-            self.locked_amount,
+            format_grin(self.amount),
+            format_grin(self.locked_amount),
             self.user.username
         )
     @transaction.atomic
@@ -55,13 +66,143 @@ class Balance(TimeStampedModel):
         """Needed to manually run validators on amounts."""
         # full_clean runs validators
         self.full_clean()
-        return super().save(*args, **kwargs)
+        res = super().save(*args, **kwargs)
+        publish_events([(self.user_id, balance_event(self))])
+        balance_cache.invalidate([self.user_id])
+        return res
+
+    @classmethod
+    @transaction.atomic
+    def materialize(cls, balance_ids=None):
+        """
+        Applies ledger entries which are not yet reflected in the amounts of
+        the given balances (or of any balances with pending entries, up to
+        LEDGER['MATERIALIZE_BATCH_SIZE'] of them). Balances are locked for the
+        rest of the transaction. Returns a dict of updated balances by id.
+        """
+        if balance_ids is None:
+            balance_ids = (
+                LedgerEntry.objects.filter(applied=False)
+                .order_by()
+                .values_list('balance_id', flat=True)
+                .distinct()[:settings.LEDGER['MATERIALIZE_BATCH_SIZE']]
+            )
+        # balances are always locked before their entries are read and in the
+        # same order, so concurrent materializations can't deadlock
+        balances = cls.objects.select_for_update().filter(
+            pk__in=list(balance_ids)).order_by('pk').in_bulk()
+        entries = list(
+            LedgerEntry.objects.filter(applied=False, balance_id__in=balances)
+            .values_list('pk', 'balance_id', 'amount', 'locked_amount')
+        )
+        if not entries:
+            return balances
+        now = timezone.now()
+        for _, balance_id, amount, locked_amount in entries:
+            balance = balances[balance_id]
+            balance.amount = balance.amount + amount
+            balance.locked_amount = balance.locked_amount + locked_amount
+            balance.modified = now
+        cls.objects.bulk_update(
+            balances.values(), ['amount', 'locked_amount', 'modified'])
+        LedgerEntry.objects.filter(
+            pk__in=[entry[0] for entry in entries]).update(applied=True)
+        updated_ids = {entry[1] for entry in entries}
+        publish_events([
+            (balances[balance_id].user_id, balance_event(balances[balance_id]))
+            for balance_id in updated_ids
+        ])
+        balance_cache.invalidate(
+            balances[balance_id].user_id for balance_id in updated_ids)
+        return balances
+
+    def with_pending(self):
+        """
+        Returns (amount, locked_amount) including ledger entries which are not
+        materialized yet, without locking anything.
+        """
+        totals = self.ledger_entries.filter(applied=False).aggregate(
+            amount=Sum('amount'), locked_amount=Sum('locked_amount'))
+        return (
+            self.amount + (totals['amount'] or 0),
+            self.locked_amount + (totals['locked_amount'] or 0),
+        )
+
+
+class TransferStatusMixin:
+    """
+    Remembers the status a transfer had in the db, so that save can detect
+    status transitions without fetching the transfer again.
+    """
+    # None for transfers which are not in the db yet
+    _db_status = None
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # status might be deferred, we don't want to load it just for this
+        instance._db_status = instance.__dict__.get('status')
+        return instance
+
+    def record_removal(self):
+        """Records that a listed transfer moved back to step-1, see changes."""
+        if (
+            self._db_status not in (None, 'awaiting transaction signature') and
+            self.status == 'awaiting transaction signature'
+        ):
+            RemovedTransfer.objects.create(
+                balance_id=self.balance_id,
+                kind=self._meta.model_name,
+                transfer_id=self.pk,
+            )
 
+    def publish_event(self):
+        # unfinished step-1 transfers are not shown to the user
+        if self.status != 'awaiting transaction signature':
+            publish_events([(self.balance.user_id, transfer_event(self))])
 
-class Deposit(TimeStampedModel):
+
+def bulk_save_confirmations(model, transfers):
+    """
+    Saves confirmations and kernel heights of the given transfers in a single
+    query. Returns ids of transfers which reached the required confirmations
+    and need to be settled, their status is set to finished in memory.
+    """
+    now = timezone.now()
+    finished_ids = []
+    for transfer in transfers:
+        # bulk_update doesn't go through save so we need to set it ourselves
+        transfer.modified = now
+        if (
+            transfer.status == 'awaiting confirmation' and
+            transfer.confirmations == settings.REQUIRED_CONFIRMATIONS
+        ):
+            transfer.status = 'finished'
+            finished_ids.append(transfer.pk)
+    model.objects.bulk_update(
+        transfers, ['confirmations', 'kernel_height', 'modified'])
+    user_ids = dict(Balance.objects.filter(
+        pk__in={transfer.balance_id for transfer in transfers}
+    ).values_list('pk', 'user_id'))
+    publish_events([
+        (user_ids[transfer.balance_id], transfer_event(transfer))
+        for transfer in transfers
+    ])
+    # finished transfers record ledger entries, the listed balances include
+    # them once they are materialized
+    finished = set(finished_ids)
+    balance_cache.invalidate(
+        user_ids[transfer.balance_id] for transfer in transfers
+        if transfer.pk in finished)
+    return finished_ids
+
+
+class Deposit(TransferStatusMixin, TimeStampedModel):
 
     STATUSES = (
         ('awaiting transaction signature', 'awaiting transaction signature'),
+        # signed transaction is being finalized and posted by a finish job
+        ('finalizing', 'finalizing'),
         ('awaiting confirmation', 'awaiting confirmation'),
         ('finished', 'finished'),
         ('canceled', 'canceled'),
@@ -71,11 +212,9 @@ class Deposit(TimeStampedModel):
         related_name='deposits',
         on_delete=models.CASCADE,
     )
-    amount = models.DecimalField(
-        max_digits=30,
-        decimal_places=9,
-        default=0.0,
-        validators=[MinValueValidator(0), MaxValueValidator(2**64)]
+    amount = models.BigIntegerField(
+        default=0,
+        validators=[MinValueValidator(0), MaxValueValidator(MAX_NANOGRIN)]
     )
     status = models.CharField(max_length=255, choices=STATUSES)
     confirmations = models.IntegerField(
@@ -88,14 +227,51 @@ class Deposit(TimeStampedModel):
     # we store kernel excess to update number of confirmations
     kernel_excess = models.CharField(
         unique=True, null=True, blank=True, max_length=255)
+    # chain height when the transaction was broadcasted, kernel search starts
+    # there since the kernel can't be in an older block
+    broadcast_height = models.PositiveIntegerField(null=True, blank=True)
+    # height of the block which includes the kernel, once we know it the
+    # confirmations can be computed from the chain tip alone
+    kernel_height = models.PositiveIntegerField(null=True, blank=True)
+    # when a finish job claimed the finalizing transfer, from then on its
+    # transaction might be posted, see recover_finalizing
+    post_started = models.DateTimeField(null=True, blank=True)
 
     class Meta:
         ordering = ['created']
+        indexes = [
+            # keyset pagination of user's history, see HistoryCursorPagination.
+            # Unfinished step-1 transfers are never listed
+            models.Index(
+                fields=['balance', 'created', 'id'],
+                name='deposit_history_idx',
+                condition=~Q(status='awaiting transaction signature'),
+            ),
+            models.Index(fields=['created', 'id'], name='deposit_created_idx'),
+            # changed transfers of user's balances, see api/changes.py
+            models.Index(
+                fields=['balance', 'modified', 'id'],
+                name='deposit_modified_idx',
+                condition=~Q(status='awaiting transaction signature'),
+            ),
+            # pending states are a small part of the table, partial indexes
+            # keep their lookups small too
+            models.Index(
+                fields=['balance'],
+                name='deposit_step1_idx',
+                condition=Q(status='awaiting transaction signature'),
+            ),
+            models.Index(
+                fields=['confirmations'],
+                name='deposit_unconfirmed_idx',
+                condition=Q(status='awaiting confirmation'),
+            ),
+        ]
 
     def __str__(self):
         return '{}, amount: {}, status: {}, user:{}'.format(
             self.balance.currency.symbol,
-            self.amount,
+            format_grin(self.amount),
             self.status,
             self.balance.user.username
         )
@@ -105,32 +281,27 @@ class Deposit(TimeStampedModel):
         """On deposit create set permissions"""
         created = self.pk is None
         if not created:
-            current_deposit = Deposit.objects.get(pk=self.pk)
             if (
-                current_deposit.status == 'awaiting transaction signature' and
+                self._db_status in ('awaiting transaction signature', 'finalizing') and
                 self.status == 'awaiting confirmation'
             ):
                 # finished the transaction, lock amount in balance
-                balance = self.balance
-                balance.locked_amount = balance.locked_amount + self.amount
-                balance.save()
+                LedgerEntry.record(self, 'lock', locked_amount=self.amount)
             elif (
                 self.status == 'awaiting confirmation' and
                 self.confirmations == settings.REQUIRED_CONFIRMATIONS
             ):
                 self.status = 'finished'
                 # deposit completed, transfer locked amount to available amount
-                balance = self.balance
-                balance.locked_amount = balance.locked_amount - self.amount
-                balance.amount = balance.amount + self.amount
-                balance.save()
+                LedgerEntry.record(
+                    self, 'credit', amount=self.amount, locked_amount=-self.amount)
 
         # full_clean runs validators
         self.full_clean()
         res = super().save(*args, **kwargs)
-        if created:
-            assign_perm('api.view_deposit', self.balance.user, self)
-
+        self.record_removal()
+        self._db_status = self.status
+        self.publish_event()
         return res
 
     @transaction.atomic
@@ -141,19 +312,48 @@ class Deposit(TimeStampedModel):
         if self.status == 'awaiting confirmation':
             # it means it's still waiting signature or confirmations in which
             # case deposit's amount is locked in its balance
-            balance = self.balance
-            balance.locked_amount = balance.locked_amount - self.amount
-            balance.save()
+            LedgerEntry.record(self, 'unlock', locked_amount=-self.amount)
             # NOTE: we should cancel tx here, but it's more explicit to do it
             # in the view. The downside is that when we delete it through a
             # shell we need to manually cancel the transaction
         return super().delete(**kwargs)
 
+    @classmethod
+    @transaction.atomic
+    def bulk_update_confirmations(cls, deposits):
+        """
+        Bulk version of setting confirmations and saving each deposit. The
+        number of queries doesn't depend on the number of deposits. Finished
+        deposits move their amounts from locked to available balance with
+        ledger entries created in a single insert.
+        """
+        if not deposits:
+            return
+        finished_ids = bulk_save_confirmations(cls, deposits)
+        if not finished_ids:
+            return
+        finished = cls.objects.filter(
+            pk__in=finished_ids, status='awaiting confirmation')
+        LedgerEntry.objects.bulk_create([
+            LedgerEntry(
+                balance_id=balance_id,
+                kind='credit',
+                amount=amount,
+                locked_amount=-amount,
+                deposit_id=deposit_id,
+            )
+            for deposit_id, balance_id, amount in
+            finished.select_for_update().values_list('pk', 'balance_id', 'amount')
+        ])
+        finished.update(status='finished', modified=timezone.now())
+
 
-class Withdrawal(TimeStampedModel):
+class Withdrawal(TransferStatusMixin, TimeStampedModel):
 
     STATUSES = (
         ('awaiting transaction signature', 'awaiting transaction signature'),
+        # signed transaction is being finalized and posted by a finish job
+        ('finalizing', 'finalizing'),
         ('awaiting confirmation', 'awaiting confirmation'),
         ('finished', 'finished'),
         ('canceled', 'canceled'),
@@ -163,11 +363,9 @@ class Withdrawal(TimeStampedModel):
         related_name='withdrawals',
         on_delete=models.CASCADE,
     )
-    amount = models.DecimalField(
-        max_digits=30,
-        decimal_places=9,
-        default=0.0,
-        validators=[MinValueValidator(0), MaxValueValidator(2**64)]
+    amount = models.BigIntegerField(
+        default=0,
+        validators=[MinValueValidator(0), MaxValueValidator(MAX_NANOGRIN)]
     )
     status = models.CharField(max_length=255, choices=STATUSES)
     confirmations = models.IntegerField(
@@ -180,14 +378,51 @@ class Withdrawal(TimeStampedModel):
     # we store kernel excess to update number of confirmations
     kernel_excess = models.CharField(
         unique=True, null=True, blank=True, max_length=255)
+    # chain height when the transaction was broadcasted, kernel search starts
+    # there since the kernel can't be in an older block
+    broadcast_height = models.PositiveIntegerField(null=True, blank=True)
+    # height of the block which includes the kernel, once we know it the
+    # confirmations can be computed from the chain tip alone
+    kernel_height = models.PositiveIntegerField(null=True, blank=True)
+    # when a finish job claimed the finalizing transfer, from then on its
+    # transaction might be posted, see recover_finalizing
+    post_started = models.DateTimeField(null=True, blank=True)
 
     class Meta:
         ordering = ['created']
+        indexes = [
+            # keyset pagination of user's history, see HistoryCursorPagination.
+            # Unfinished step-1 transfers are never listed
+            models.Index(
+                fields=['balance', 'created', 'id'],
+                name='withdrawal_history_idx',
+                condition=~Q(status='awaiting transaction signature'),
+            ),
+            models.Index(fields=['created', 'id'], name='withdrawal_created_idx'),
+            # changed transfers of user's balances, see api/changes.py
+            models.Index(
+                fields=['balance', 'modified', 'id'],
+                name='withdrawal_modified_idx',
+                condition=~Q(status='awaiting transaction signature'),
+            ),
+            # pending states are a small part of the table, partial indexes
+            # keep their lookups small too
+            models.Index(
+                fields=['balance'],
+                name='withdrawal_step1_idx',
+                condition=Q(status='awaiting transaction signature'),
+            ),
+            models.Index(
+                fields=['confirmations'],
+                name='withdrawal_unconfirmed_idx',
+                condition=Q(status='awaiting confirmation'),
+            ),
+        ]
 
     def __str__(self):
         return '{}, amount: {}, status: {}, user:{}'.format(
             self.balance.currency.symbol,
-            self.amount,
+            format_grin(self.amount),
             self.status,
             self.balance.user.username
         )
@@ -197,31 +432,39 @@ class Withdrawal(TimeStampedModel):
         """On withdrawal create set permissions"""
         created = self.pk is None
         if not created:
-            current_withdrawal = Withdrawal.objects.get(pk=self.pk)
             if (
-                current_withdrawal.status == 'awaiting transaction signature' and
-                self.status == 'awaiting confirmation'
+                self._db_status == 'awaiting transaction signature' and
+                self.status in ('finalizing', 'awaiting confirmation')
             ):
-                # finished the transaction, lock amount in balance
-                balance = self.balance
-                balance.locked_amount = balance.locked_amount + self.amount
-                balance.amount = balance.amount - self.amount
-                balance.save()
+                # finished the transaction, lock amount in balance. Balance is
+                # locked and brought up to date first so that we can check the
+                # available amount
+                balance = Balance.materialize([self.balance_id])[self.balance_id]
+                if balance.amount < self.amount:
+                    raise ValidationError(
+                        {'amount': 'Amount exceeds the available balance.'})
+                LedgerEntry.record(
+                    self, 'lock', amount=-self.amount, locked_amount=self.amount)
+            elif (
+                self._db_status == 'finalizing' and
+                self.status == 'awaiting transaction signature'
+            ):
+                # finalization failed, return the amount to available balance
+                LedgerEntry.record(
+                    self, 'unlock', amount=self.amount, locked_amount=-self.amount)
             elif (
                 self.status == 'awaiting confirmation' and
                 self.confirmations == settings.REQUIRED_CONFIRMATIONS
             ):
                 self.status = 'finished'
                 # withdrawal completed, remove locked amount
-                balance = self.balance
-                balance.locked_amount = balance.locked_amount - self.amount
-                balance.save()
+                LedgerEntry.record(self, 'debit', locked_amount=-self.amount)
         # full_clean runs validators
         self.full_clean()
         res = super().save(*args, **kwargs)
-
-        if created:
-            assign_perm('api.view_withdrawal', self.balance.user, self)
+        self.record_removal()
+        self._db_status = self.status
+        self.publish_event()
         return res
 
     @transaction.atomic
@@ -229,14 +472,184 @@ class Withdrawal(TimeStampedModel):
         # we need to remove locked amount from balance if anything is locked
         # NOTE: this can also be called on an already confirmed withdrawal in
         # which case nothing is locked
-        if self.status == 'awaiting confirmation':
+        if self.status in ('finalizing', 'awaiting confirmation'):
             # the withdrawal's amount is locked in its balance, return it to
             # the available balance
-            balance = self.balance
-            balance.locked_amount = balance.locked_amount - self.amount
-            balance.amount = balance.amount + self.amount
-            balance.save()
+            LedgerEntry.record(
+                self, 'unlock', amount=self.amount, locked_amount=-self.amount)
             # NOTE: we should cancel tx here, but it's more explicit to do it
             # in the view. The downside is that when we delete it through a
             # shell we need to manually cancel the transaction
         return super().delete(**kwargs)
+
+    @classmethod
+    @transaction.atomic
+    def bulk_update_confirmations(cls, withdrawals):
+        """
+        Bulk version of setting confirmations and saving each withdrawal. The
+        number of queries doesn't depend on the number of withdrawals.
+        Finished withdrawals remove their locked amounts with ledger entries
+        created in a single insert.
+        """
+        if not withdrawals:
+            return
+        finished_ids = bulk_save_confirmations(cls, withdrawals)
+        if not finished_ids:
+            return
+        finished = cls.objects.filter(
+            pk__in=finished_ids, status='awaiting confirmation')
+        LedgerEntry.objects.bulk_create([
+            LedgerEntry(
+                balance_id=balance_id,
+                kind='debit',
+                locked_amount=-amount,
+                withdrawal_id=withdrawal_id,
+            )
+            for withdrawal_id, balance_id, amount in
+            finished.select_for_update().values_list('pk', 'balance_id', 'amount')
+        ])
+        finished.update(status='finished', modified=timezone.now())
+
+
+class LedgerEntry(TimeStampedModel):
+    """
+    Append-only record of a balance change. Balance amounts are a snapshot of
+    the applied entries, entries are written with plain inserts and applied to
+    balances in batches or on demand, see Balance.materialize.
+    """
+
+    KINDS = (
+        # available amount increased
+        ('credit', 'credit'),
+        # locked amount left the exchange
+        ('debit', 'debit'),
+        # amount moved to locked
+        ('lock', 'lock'),
+        # locked amount released
+        ('unlock', 'unlock'),
+        # balance amounts from before the ledger existed
+        ('opening', 'opening'),
+    )
+    balance = models.ForeignKey(
+        Balance,
+        related_name='ledger_entries',
+        on_delete=models.CASCADE,
+    )
+    kind = models.CharField(max_length=255, choices=KINDS)
+    # signed changes of balance's amount and locked_amount
+    amount = models.BigIntegerField(default=0)
+    locked_amount = models.BigIntegerField(default=0)
+    deposit = models.ForeignKey(
+        Deposit,
+        related_name='ledger_entries',
+        null=True,
+        blank=True,
+        on_delete=models.SET_NULL,
+    )
+    withdrawal = models.ForeignKey(
+        Withdrawal,
+        related_name='ledger_entries',
+        null=True,
+        blank=True,
+        on_delete=models.SET_NULL,
+    )
+    # whether the entry is already included in the balance amounts
+    applied = models.BooleanField(default=False)
+
+    class Meta:
+        verbose_name_plural = "ledger entries"
+        indexes = [
+            models.Index(
+                fields=['balance'],
+                name='ledger_entry_pending_idx',
+                condition=Q(applied=False),
+            ),
+        ]
+
+    def __str__(self):
+        return '{}, amount: {}, locked: {}, balance: {}'.format(
+            self.kind,
+            format_grin(self.amount),
+            format_grin(self.locked_amount),
+            self.balance_id
+        )
+
+    @classmethod
+    def record(cls, transfer, kind, amount=0, locked_amount=0):
+        """Records a balance change made by a deposit or withdrawal."""
+        transfer_field = 'deposit' if isinstance(transfer, Deposit) else 'withdrawal'
+        # balance list applies pending entries, see BalanceViewSet
+        balance_cache.invalidate([transfer.balance.user_id])
+        return cls.objects.create(
+            balance_id=transfer.balance_id,
+            kind=kind,
+            amount=amount,
+            locked_amount=locked_amount,
+            **{transfer_field: transfer}
+        )
+
+
+class ScanCheckpoint(TimeStampedModel):
+    """Last block processed by a chain follower, so that it can resume."""
+
+    name = models.SlugField(unique=True, max_length=255)
+    height = models.PositiveIntegerField()
+    block_hash = models.CharField(max_length=64)
+
+    def __str__(self):
+        return '{}, height: {}, hash: {}'.format(
+            self.name, self.height, self.block_hash)
+
+
+class RemovedTransfer(TimeStampedModel):
+    """
+    Deposit or withdrawal which was shown to the user and moved back to
+    step-1. Delta sync reports it as removed, even after the reaper deleted
+    the transfer itself.
+    """
+    KINDS = (
+        ('deposit', 'deposit'),
+        ('withdrawal', 'withdrawal'),
+    )
+
+    balance = models.ForeignKey(
+        Balance,
+        related_name='removed_transfers',
+        on_delete=models.CASCADE,
+    )
+    kind = models.CharField(max_length=255, choices=KINDS)
+    # not a foreign key, the transfer can be deleted
+    transfer_id = models.PositiveIntegerField()
+
+    class Meta:
+        indexes = [
+            # removed transfers of user's balances, see api/changes.py
+            models.Index(
+                fields=['balance', 'kind', 'modified'],
+                name='removed_transfer_modified_idx',
+            ),
+        ]
+
+    def __str__(self):
+        return '{} {}, balance: {}'.format(
+            self.kind, self.transfer_id, self.balance_id)
+
+
+class ApiKey(TimeStampedModel):
+    """
+    API key of a user, sent as 'Authorization: Api-Key <key_id>.<secret>'.
+    Only the HMAC of the secret is stored, the secret is shown once when the
+    key is created.
+    """
+
+    user = models.ForeignKey(
+        User,
+        related_name='api_keys',
+        on_delete=models.CASCADE,
+    )
+    name = models.CharField(max_length=255, blank=True)
+    key_id = models.CharField(unique=True, max_length=16)
+    digest = models.CharField(max_length=64)
+
+    def __str__(self):
+        return '{}, user: {}'.format(self.key_id, self.user.username)
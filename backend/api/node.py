@@ -1,7 +1,7 @@
 from django.conf import settings
+from .transport import get_async_transport, get_transport
 
 import json
-import requests
 
 
 class NodeError(Exception):
@@ -16,13 +16,29 @@ class NodeError(Exception):
         return f'Calling node foreign api {self.method} with params {self.params} failed with error code {self.code} because: {self.reason}'
 
 
+def check_response(method, params, response_json):
+    """Raises NodeError if the response is an error, returns it otherwise."""
+    # https://github.com/mimblewimble/grin-rfcs/blob/master/text/0007-node-api-v2.md#errors
+    if "error" in response_json:
+        # One version of a node error
+        raise NodeError(method, params, response_json["error"]["code"], response_json["error"]["message"])
+    if "Err" in response_json:
+        # Another version of a node error
+        raise NodeError(method, params, None, response_json["result"]["Err"])
+    return response_json
+
+
 class NodeV2API:
     def __init__(self):
         node_settings = settings.NODE_API
         self.foreign_api_url = node_settings['URL']
         self.foreign_api_user = node_settings['USERNAME']
         self.foreign_api_password = node_settings['FOREIGN_API_SECRET']
-        
+        self.transport = get_transport(
+            self.foreign_api_url,
+            self.foreign_api_user,
+            self.foreign_api_password
+        )
 
     def post(self, method, params):
         payload = {
@@ -32,27 +48,151 @@ class NodeV2API:
             'params': params
         }
 
-        response = requests.post(
-                self.foreign_api_url, json=payload, 
-                auth=(self.foreign_api_user, self.foreign_api_password))
+        response = self.transport.post(payload, method)
         if response.status_code >= 300 or response.status_code < 200:
             # Requests-level error
             raise NodeError(method, params, response.status_code, response.reason)
+        return check_response(method, params, response.json())
+
+    def post_batch(self, calls):
+        """
+        Sends multiple calls in a single JSON-RPC 2.0 batch request. Calls is a
+        list of (method, params) tuples. Returns a list of the same length and
+        order where each item is either the response of that call or a
+        NodeError if that call failed.
+        """
+        if not calls:
+            return []
+        payload = [
+            {
+                'jsonrpc': '2.0',
+                # ids must be unique within the batch, we use them to match
+                # responses to calls since they can come in any order
+                'id': call_id,
+                'method': method,
+                'params': params,
+            }
+            for call_id, (method, params) in enumerate(calls)
+        ]
+        methods = {method for method, _ in calls}
+        # batch timeout is the one of its method if all calls are the same
+        timeout_method = methods.pop() if len(methods) == 1 else None
+        response = self.transport.post(payload, timeout_method)
+        if response.status_code >= 300 or response.status_code < 200:
+            # Requests-level error, the whole batch failed
+            raise NodeError('batch', payload, response.status_code, response.reason)
         response_json = response.json()
+        if not isinstance(response_json, list):
+            # the batch itself was rejected (eg. invalid request)
+            error = response_json.get('error', {})
+            raise NodeError('batch', payload, error.get('code'), error.get('message'))
 
-        # https://github.com/mimblewimble/grin-rfcs/blob/master/text/0007-node-api-v2.md#errors
-        if "error" in response_json:
-            # One version of a node error
-            raise NodeError(method, params, response_json["error"]["code"], response_json["error"]["message"])
-        if "Err" in response_json:
-            # Another version of a node error
-            raise NodeError(method, params, None, response_json["result"]["Err"])
-        return response_json
+        responses_by_id = {resp.get('id'): resp for resp in response_json}
+        results = []
+        for call_id, (method, params) in enumerate(calls):
+            resp = responses_by_id.get(call_id)
+            if resp is None:
+                results.append(NodeError(method, params, None, 'Missing response'))
+            elif "error" in resp:
+                results.append(NodeError(
+                    method, params, resp["error"]["code"], resp["error"]["message"]))
+            else:
+                results.append(resp)
+        return results
 
     def get_tip(self):
         resp = self.post('get_tip', [])
         return resp["result"]["Ok"]
+
+    def get_header(self, height=None, hash=None, commit=None):
+        resp = self.post('get_header', [height, hash, commit])
+        return resp["result"]["Ok"]
+
+    def get_block(self, height=None, hash=None, commit=None):
+        resp = self.post('get_block', [height, hash, commit])
+        return resp["result"]["Ok"]
+
+    def get_blocks(self, heights):
+        """
+        Batched get_block by height. Raises NodeError if any of the blocks
+        couldn't be fetched since callers need all of them.
+        """
+        responses = self.post_batch([
+            ('get_block', [height, None, None]) for height in heights
+        ])
+        blocks = []
+        for height, resp in zip(heights, responses):
+            if isinstance(resp, NodeError):
+                raise resp
+            if "Ok" not in resp["result"]:
+                raise NodeError(
+                    'get_block', [height, None, None], None, resp["result"]["Err"])
+            blocks.append(resp["result"]["Ok"])
+        return blocks
     
     def get_kernel(self, excess, min_height=None, max_height=None):
         resp = self.post('get_kernel', [excess, min_height, max_height])
         return resp["result"]["Ok"]
+
+    def get_kernels(self, excesses, min_height=None, max_height=None):
+        """
+        Batched get_kernel. Returns a list in the same order as excesses, each
+        item is the kernel, None if the kernel was not found or a NodeError
+        if that lookup failed.
+        """
+        responses = self.post_batch([
+            ('get_kernel', [excess, min_height, max_height])
+            for excess in excesses
+        ])
+        kernels = []
+        for resp in responses:
+            if isinstance(resp, NodeError):
+                kernels.append(resp)
+            else:
+                # {"Err": "NotFound"} when the kernel is not on the chain
+                kernels.append(resp["result"].get("Ok"))
+        return kernels
+
+
+class AsyncNodeV2API(NodeV2API):
+    """
+    Async version of NodeV2API for async views, only single (not batched)
+    calls are available.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.transport = get_async_transport(
+            self.foreign_api_url,
+            self.foreign_api_user,
+            self.foreign_api_password
+        )
+
+    async def post(self, method, params):
+        payload = {
+            'jsonrpc': '2.0',
+            'id': 1,
+            'method': method,
+            'params': params
+        }
+        response = await self.transport.post(payload, method)
+        if response.status_code >= 300 or response.status_code < 200:
+            # Requests-level error
+            raise NodeError(method, params, response.status_code, response.reason_phrase)
+        return check_response(method, params, response.json())
+
+    async def get_tip(self):
+        resp = await self.post('get_tip', [])
+        return resp["result"]["Ok"]
+
+    async def get_header(self, height=None, hash=None, commit=None):
+        resp = await self.post('get_header', [height, hash, commit])
+        return resp["result"]["Ok"]
+
+    async def get_block(self, height=None, hash=None, commit=None):
+        resp = await self.post('get_block', [height, hash, commit])
+        return resp["result"]["Ok"]
+
+    async def get_kernel(self, excess, min_height=None, max_height=None):
+        resp = await self.post('get_kernel', [excess, min_height, max_height])
+        return resp["result"]["Ok"]
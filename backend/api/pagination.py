@@ -0,0 +1,21 @@
+from django.conf import settings
+from rest_framework.pagination import CursorPagination
+
+
+class HistoryCursorPagination(CursorPagination):
+    """
+    Cursor pagination of deposit and withdrawal history, newest first. DRF's
+    cursor keeps only the `created` of the page's last row, pages are fetched
+    with a WHERE on it instead of an OFFSET over the whole history, so a page
+    deep in the history costs about the same as the first one. Rows created
+    at the same moment are skipped with an offset, id only makes their order
+    stable.
+    """
+    ordering = ('-created', '-id')
+    page_size = settings.HISTORY_PAGINATION['PAGE_SIZE']
+    page_size_query_param = 'page_size'
+    max_page_size = settings.HISTORY_PAGINATION['MAX_PAGE_SIZE']
+
+    def get_ordering(self, request, queryset, view):
+        # ordering is fixed, other orderings would not be backed by an index
+        return self.ordering
@@ -1,6 +1,55 @@
-from .tasks import update_deposits_and_withdrawals
+from .helpers import get_redis_connection
+from .node import NodeV2API, NodeError
+from .tasks import (
+    materialize_balances,
+    reap_abandoned_transfers,
+    recover_finalizing_transfers,
+    update_deposits_and_withdrawals,
+)
+
+import logging
+import requests
+
+logger = logging.getLogger(__name__)
+
+# last seen tip, shared by all schedulers through redis
+TIP_KEY = 'tip-watcher:tip'
 
 
 def periodically_run_job():
     """This task will be run by APScheduler."""
     update_deposits_and_withdrawals.send()
+
+
+def periodically_materialize_balances():
+    """This task will be run by APScheduler."""
+    materialize_balances.send()
+
+
+def periodically_reap_abandoned_transfers():
+    """This task will be run by APScheduler."""
+    reap_abandoned_transfers.send()
+
+
+def periodically_recover_finalizing_transfers():
+    """This task will be run by APScheduler."""
+    recover_finalizing_transfers.send()
+
+
+def watch_tip():
+    """
+    This task will be run by APScheduler every few seconds. It only asks the
+    node for the tip and sends update_deposits_and_withdrawals when the tip
+    has changed, so confirmations follow block arrival.
+    """
+    try:
+        tip = NodeV2API().get_tip()
+    except (NodeError, requests.RequestException):
+        logger.warning('Tip watcher failed to get the tip')
+        return
+    tip_id = '{}:{}'.format(tip['height'], tip['last_block_pushed'])
+    connection = get_redis_connection()
+    # getset is atomic, so with multiple watchers only the one which sees the
+    # change first sends the job
+    if connection.getset(TIP_KEY, tip_id) != tip_id.encode():
+        update_deposits_and_withdrawals.send()
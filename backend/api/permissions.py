@@ -1,7 +1,23 @@
 from rest_framework import permissions
 
 
-class ObjectPermissions(permissions.DjangoObjectPermissions):
+def get_owner_id(obj, owner_field):
+    """
+    Returns id of the user who owns obj, owner_field is a lookup to the owner
+    like the ones used in querysets, eg. 'balance__user'.
+    """
+    *path, field = owner_field.split('__')
+    for attr in path:
+        obj = getattr(obj, attr)
+    return getattr(obj, '{}_id'.format(field))
+
+
+class ObjectPermissions(permissions.DjangoModelPermissions):
+    """
+    Model permissions, objects are only accessible to their owners. Owner is
+    found through the view's `owner_field`, views without it only allow
+    superusers to access their objects.
+    """
 
     perms_map = {
         'GET': ['%(app_label)s.view_%(model_name)s'],
@@ -12,3 +28,11 @@ class ObjectPermissions(permissions.DjangoObjectPermissions):
         'PATCH': ['%(app_label)s.change_%(model_name)s'],
         'DELETE': ['%(app_label)s.delete_%(model_name)s'],
     }
+
+    def has_object_permission(self, request, view, obj):
+        if request.user.is_superuser:
+            return True
+        owner_field = getattr(view, 'owner_field', None)
+        if owner_field is None:
+            return False
+        return get_owner_id(obj, owner_field) == request.user.pk
@@ -0,0 +1,87 @@
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Exists, OuterRef, Q
+from django.utils import timezone
+from .models import Deposit, Withdrawal
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+STEP1_STATUS = 'awaiting transaction signature'
+
+
+def abandoned_step1(model, cutoff):
+    """
+    Step-1 transfers of the given model created before cutoff or superseded
+    by a newer step-1 transfer of the same balance.
+    """
+    newer = model.objects.filter(
+        balance=OuterRef('balance'),
+        status=STEP1_STATUS,
+        created__gt=OuterRef('created'),
+    )
+    return model.objects.filter(status=STEP1_STATUS).annotate(
+        superseded=Exists(newer)
+    ).filter(
+        Q(created__lt=cutoff) | Q(superseded=True)
+    ).order_by()
+
+
+@transaction.atomic
+def delete_batch(model, cutoff, batch_size):
+    """
+    Deletes a batch of abandoned step-1 transfers and returns their slate ids.
+    Rows being finished right now are locked and skipped. Step-1 transfers
+    have nothing locked in the balance so they are deleted without going
+    through delete().
+    """
+    rows = list(
+        abandoned_step1(model, cutoff)
+        .select_for_update(skip_locked=True)
+        .values_list('pk', 'tx_slate_id')[:batch_size]
+    )
+    if rows:
+        model.objects.filter(pk__in=[pk for pk, _ in rows]).delete()
+    return [tx_slate_id for _, tx_slate_id in rows]
+
+
+def cancel_transactions(wallet_api, tx_slate_ids, workers):
+    """Cancels wallet transactions concurrently, returns the number canceled."""
+    def cancel(tx_slate_id):
+        try:
+            return wallet_api.cancel_tx(tx_slate_id=tx_slate_id)
+        except Exception:
+            # who knows why this can fail, maybe they've manually deleted it
+            # before
+            logger.warning('cancel_tx failed, tx_slate_id: {}'.format(tx_slate_id))
+            return False
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return sum(executor.map(cancel, tx_slate_ids))
+
+
+def reap_step1_transfers(wallet_api):
+    """
+    Deletes abandoned step-1 deposits and withdrawals in batches and cancels
+    their wallet transactions. Rows are deleted before their transactions are
+    canceled, so a transaction can't be canceled while it's being finished.
+    Returns the number of deleted transfers.
+    """
+    reaper_settings = settings.STEP1_REAPER
+    cutoff = timezone.now() - timedelta(minutes=reaper_settings['TTL_MINUTES'])
+    reaped = 0
+    for model in (Deposit, Withdrawal):
+        while True:
+            tx_slate_ids = delete_batch(
+                model, cutoff, reaper_settings['BATCH_SIZE'])
+            if not tx_slate_ids:
+                break
+            canceled = cancel_transactions(
+                wallet_api, tx_slate_ids, reaper_settings['WALLET_WORKERS'])
+            reaped += len(tx_slate_ids)
+            logger.info('Reaped {} step-1 {}, canceled {} transactions'.format(
+                len(tx_slate_ids), model._meta.verbose_name_plural, canceled))
+    return reaped
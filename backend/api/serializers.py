@@ -1,7 +1,31 @@
 from django.contrib.auth.models import User
+from functools import lru_cache
 from rest_framework import serializers
 from rest_framework.validators import UniqueValidator
-from .models import Balance, Currency, Deposit, Withdrawal
+from rest_framework_simplejwt.exceptions import InvalidToken
+from rest_framework_simplejwt.serializers import (
+    TokenObtainPairSerializer,
+    TokenRefreshSerializer,
+)
+from rest_framework_simplejwt.tokens import RefreshToken
+from .authentication import is_revoked, user_claims
+from .helpers import format_grin, grin_to_nanogrin
+from .models import ApiKey, Balance, Currency, Deposit, Withdrawal
+
+import time
+
+
+class GrinAmountField(serializers.Field):
+    """Amount stored in nanogrin, represented in grin as a decimal string."""
+
+    def to_representation(self, value):
+        return format_grin(value)
+
+    def to_internal_value(self, data):
+        try:
+            return grin_to_nanogrin(data)
+        except (ArithmeticError, ValueError, TypeError):
+            raise serializers.ValidationError('A valid number is required.')
 
 
 class UserSerializer(serializers.ModelSerializer):
@@ -24,6 +48,37 @@ class UserSerializer(serializers.ModelSerializer):
         return user
 
 
+class ClaimsTokenObtainPairSerializer(TokenObtainPairSerializer):
+    """Tokens carry user's claims, see ClaimsJWTAuthentication."""
+
+    @classmethod
+    def get_token(cls, user):
+        token = super().get_token(user)
+        # issue time is needed to revoke all tokens of a user, it's as precise
+        # as the revocation time (NumericDate can have a fraction)
+        token['iat'] = time.time()
+        for claim, value in user_claims(user).items():
+            token[claim] = value
+        return token
+
+
+class CheckedTokenRefreshSerializer(TokenRefreshSerializer):
+    """Revoked refresh tokens can't be refreshed."""
+
+    def validate(self, attrs):
+        if is_revoked(RefreshToken(attrs['refresh'])):
+            raise InvalidToken('Token is revoked')
+        return super().validate(attrs)
+
+
+class ApiKeySerializer(serializers.ModelSerializer):
+
+    class Meta:
+        model = ApiKey
+        fields = ('id', 'name', 'key_id', 'created')
+        read_only_fields = ('key_id', 'created')
+
+
 class CurrencySerializer(serializers.ModelSerializer):
 
     class Meta:
@@ -33,23 +88,84 @@ class CurrencySerializer(serializers.ModelSerializer):
 
 class BalanceSerializer(serializers.ModelSerializer):
     currency = CurrencySerializer()
+    amount = GrinAmountField()
+    locked_amount = GrinAmountField()
 
     class Meta:
         model = Balance
-        fields = ('currency', 'amount', 'locked_amount', 'user')
+        fields = ('id', 'currency', 'amount', 'locked_amount', 'user')
 
 
 class DepositSerializer(serializers.ModelSerializer):
     balance = BalanceSerializer()
+    amount = GrinAmountField()
 
     class Meta:
         model = Deposit
-        fields = ('balance', 'amount', 'status', 'confirmations', 'created')
+        fields = ('id', 'balance', 'amount', 'status', 'confirmations', 'created')
 
 
 class WithdrawalSerializer(serializers.ModelSerializer):
     balance = BalanceSerializer()
+    amount = GrinAmountField()
 
     class Meta:
         model = Withdrawal
-        fields = ('balance', 'amount', 'status', 'confirmations', 'created')
+        fields = ('id', 'balance', 'amount', 'status', 'confirmations', 'created')
+
+
+class ValuesMapper:
+    """
+    Builds the output of a read-only serializer straight from values() rows,
+    without creating model instances. Fields are compiled once into
+    (name, values path, converter) triples, nested serializers become nested
+    builders. Nested relations must not be null.
+    """
+    # converters which give the same result as the field's to_representation
+    FAST_CONVERTERS = {
+        GrinAmountField: format_grin,
+        serializers.CharField: str,
+        serializers.IntegerField: int,
+        # values() gives the related pk directly
+        serializers.PrimaryKeyRelatedField: lambda pk: pk,
+    }
+
+    def __init__(self, serializer_class):
+        self.paths = []
+        self.build = self.compile(serializer_class(), '')
+
+    def compile(self, serializer, prefix):
+        builders = []
+        for name, field in serializer.fields.items():
+            if field.write_only:
+                continue
+            path = prefix + '__'.join(field.source_attrs)
+            if isinstance(field, serializers.BaseSerializer):
+                builders.append((name, None, self.compile(field, path + '__')))
+            else:
+                self.paths.append(path)
+                builders.append((name, path, self.converter(field)))
+
+        def build(row):
+            data = {}
+            for name, path, convert in builders:
+                if path is None:
+                    data[name] = convert(row)
+                else:
+                    value = row[path]
+                    data[name] = None if value is None else convert(value)
+            return data
+        return build
+
+    def converter(self, field):
+        return self.FAST_CONVERTERS.get(type(field), field.to_representation)
+
+    def map(self, rows):
+        build = self.build
+        return [build(row) for row in rows]
+
+
+@lru_cache(maxsize=None)
+def get_values_mapper(serializer_class):
+    """Returns the (cached) ValuesMapper for the given serializer class."""
+    return ValuesMapper(serializer_class)
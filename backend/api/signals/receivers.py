@@ -1,32 +1,37 @@
-from django.contrib.auth.models import User
-from django.db.models.signals import post_save
+from django.contrib.auth.models import Group, User
+from django.db import transaction
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_save
 from django.dispatch import receiver
+from backend.api.authentication import revoke_user_tokens
+from backend.api.caching import balance_cache, currency_cache
 from backend.api.models import Currency, Balance
 from backend.api.helpers import assign_default_model_permissions
-from decimal import Decimal
-from guardian.shortcuts import assign_perm
+
+# user fields which are in tokens' claims or make the tokens invalid
+TOKEN_FIELDS = ('username', 'password', 'is_active', 'is_staff', 'is_superuser')
+# m2m_changed actions which change permissions, clear is handled before it
+# runs so that the cleared relations can still be read
+M2M_CHANGES = ('post_add', 'post_remove', 'pre_clear')
 
 
 def create_balances_for_user(user):
     for currency in Currency.objects.all():
-        balance = Balance.objects.create(
+        Balance.objects.create(
             currency=currency,
             user=user,
-            amount=Decimal(0),
-            locked_amount=Decimal(0)
+            amount=0,
+            locked_amount=0
         )
-        assign_perm('api.view_balance', user, balance)
 
 
 def create_balances_for_currency(currency):
     for user in User.objects.all():
-        balance = Balance.objects.create(
+        Balance.objects.create(
             currency=currency,
             user=user,
-            amount=Decimal(0),
-            locked_amount=Decimal(0)
+            amount=0,
+            locked_amount=0
         )
-        assign_perm('api.view_balance', user, balance)
 
 
 @receiver(
@@ -42,6 +47,76 @@ def on_user_create(sender, instance, created, **kwargs):
         create_balances_for_user(instance)
 
 
+@receiver(
+    pre_save,
+    sender=User,
+    dispatch_uid="revoke_tokens_of_changed_user",
+)
+def on_user_change(sender, instance, **kwargs):
+    # tokens and cached API keys carry user's claims, they are revoked when
+    # the claims change or the user is deactivated. Permission changes are
+    # handled by on_permissions_change
+    if instance.pk is None:
+        return
+    old = User.objects.filter(pk=instance.pk).values(*TOKEN_FIELDS).first()
+    if old is not None and any(
+            old[field] != getattr(instance, field) for field in TOKEN_FIELDS):
+        revoke_user_tokens(instance.pk)
+
+
+def revoke_tokens_on_commit(user_ids):
+    user_ids = set(user_ids)
+
+    def revoke():
+        for user_id in user_ids:
+            revoke_user_tokens(user_id)
+    if user_ids:
+        transaction.on_commit(revoke)
+
+
+@receiver(
+    m2m_changed,
+    sender=User.user_permissions.through,
+    dispatch_uid="revoke_tokens_of_user_with_changed_permissions",
+)
+@receiver(
+    m2m_changed,
+    sender=User.groups.through,
+    dispatch_uid="revoke_tokens_of_user_with_changed_groups",
+)
+def on_permissions_change(sender, instance, action, reverse, pk_set, **kwargs):
+    # perms claim of the tokens is copied to refreshed access tokens, so the
+    # tokens are revoked instead of waiting for the refresh token to expire
+    if action not in M2M_CHANGES or (action != 'pre_clear' and not pk_set):
+        return
+    if not reverse:
+        user_ids = [instance.pk]
+    elif action == 'pre_clear':
+        # instance is the permission or group
+        user_ids = instance.user_set.values_list('pk', flat=True)
+    else:
+        user_ids = pk_set
+    revoke_tokens_on_commit(user_ids)
+
+
+@receiver(
+    m2m_changed,
+    sender=Group.permissions.through,
+    dispatch_uid="revoke_tokens_of_group_with_changed_permissions",
+)
+def on_group_permissions_change(sender, instance, action, reverse, pk_set, **kwargs):
+    if action not in M2M_CHANGES or (action != 'pre_clear' and not pk_set):
+        return
+    if not reverse:
+        users = User.objects.filter(groups=instance)
+    elif action == 'pre_clear':
+        # instance is the permission, all of its groups lose it
+        users = User.objects.filter(groups__permissions=instance)
+    else:
+        users = User.objects.filter(groups__in=pk_set)
+    revoke_tokens_on_commit(users.values_list('pk', flat=True))
+
+
 @receiver(
     post_save,
     sender=Currency,
@@ -50,3 +125,14 @@ def on_user_create(sender, instance, created, **kwargs):
 def on_currency_create(sender, instance, created, **kwargs):
     if created:
         create_balances_for_currency(instance)
+
+
+@receiver(
+    [post_save, post_delete],
+    sender=Currency,
+    dispatch_uid="invalidate_cached_currencies",
+)
+def on_currency_change(sender, instance, **kwargs):
+    currency_cache.invalidate(['list', instance.pk])
+    # listed balances include their currency, new currency adds balances
+    balance_cache.invalidate_all()
@@ -0,0 +1,160 @@
+"""
+Server-sent event stream of user's events (see events.py) at /api/events/,
+served by backend/asgi.py. Django 3.1 can't stream from async code, so this
+is a plain ASGI app. Every process has one redis pub/sub connection which
+receives the events of all users and hands them to the connected clients.
+
+EventSource can't send headers, the access token is given as ?token=.
+"""
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from rest_framework_simplejwt.exceptions import TokenError
+from rest_framework_simplejwt.settings import api_settings as jwt_settings
+from rest_framework_simplejwt.tokens import AccessToken
+from urllib.parse import parse_qs
+from .authentication import is_revoked
+from .events import CHANNEL_PATTERN
+
+import asyncio
+import logging
+import redis.asyncio
+
+logger = logging.getLogger(__name__)
+
+PATH = '/api/events/'
+
+
+class EventHub:
+    """Forwards events from redis to the queues of the connected clients."""
+
+    def __init__(self):
+        # user id -> set of client queues
+        self.clients = {}
+        self.task = None
+
+    def connect(self, user_id):
+        queue = asyncio.Queue(maxsize=settings.EVENT_STREAM['QUEUE_SIZE'])
+        self.clients.setdefault(user_id, set()).add(queue)
+        if self.task is None or self.task.done():
+            self.task = asyncio.ensure_future(self.listen())
+        return queue
+
+    def disconnect(self, user_id, queue):
+        queues = self.clients.get(user_id, set())
+        queues.discard(queue)
+        if not queues:
+            self.clients.pop(user_id, None)
+
+    async def listen(self):
+        # runs as long as the process, events published while it reconnects
+        # are lost
+        while True:
+            connection = redis.asyncio.Redis.from_url(settings.REDIS_LOCATION)
+            pubsub = connection.pubsub()
+            try:
+                await pubsub.psubscribe(CHANNEL_PATTERN)
+                while True:
+                    message = await pubsub.get_message(
+                        ignore_subscribe_messages=True, timeout=1)
+                    if message is not None:
+                        self.dispatch(message['channel'], message['data'])
+            except Exception:
+                logger.exception('Event stream lost the redis connection')
+            finally:
+                await pubsub.close()
+                await connection.close()
+            await asyncio.sleep(1)
+
+    def dispatch(self, channel, data):
+        user_id = int(channel.rsplit(b':', 1)[1])
+        for queue in self.clients.get(user_id, ()):
+            try:
+                queue.put_nowait(data)
+            except asyncio.QueueFull:
+                # slow client, it refreshes its data when it reconnects
+                logger.warning('Dropped an event of user {}'.format(user_id))
+
+
+_hub = None
+
+
+def get_hub():
+    global _hub
+    if _hub is None:
+        _hub = EventHub()
+    return _hub
+
+
+async def authenticate(scope):
+    """Returns user id of the access token in the query string or None."""
+    query = parse_qs(scope['query_string'].decode())
+    try:
+        token = AccessToken(query.get('token', [''])[0])
+    except TokenError:
+        return None
+    if await sync_to_async(is_revoked, thread_sensitive=False)(token):
+        return None
+    return token.get(jwt_settings.USER_ID_CLAIM)
+
+
+def cors_headers(scope):
+    origin = dict(scope['headers']).get(b'origin', b'').decode()
+    if origin in settings.CORS_ORIGIN_WHITELIST:
+        return [(b'access-control-allow-origin', origin.encode())]
+    return []
+
+
+async def wait_for_disconnect(receive):
+    while (await receive())['type'] != 'http.disconnect':
+        pass
+
+
+async def event_stream(scope, receive, send):
+    user_id = await authenticate(scope)
+    if user_id is None:
+        await send({
+            'type': 'http.response.start',
+            'status': 401,
+            'headers': cors_headers(scope),
+        })
+        await send({'type': 'http.response.body', 'body': b''})
+        return
+    await send({
+        'type': 'http.response.start',
+        'status': 200,
+        'headers': [
+            (b'content-type', b'text/event-stream'),
+            (b'cache-control', b'no-cache'),
+            # nginx must not buffer the stream
+            (b'x-accel-buffering', b'no'),
+        ] + cors_headers(scope),
+    })
+    hub = get_hub()
+    queue = hub.connect(user_id)
+    disconnected = asyncio.ensure_future(wait_for_disconnect(receive))
+    try:
+        while not disconnected.done():
+            try:
+                data = await asyncio.wait_for(
+                    queue.get(), settings.EVENT_STREAM['HEARTBEAT_SECONDS'])
+                body = b'data: ' + data + b'\n\n'
+            except asyncio.TimeoutError:
+                # keeps proxies from closing an idle connection
+                body = b': heartbeat\n\n'
+            await send({
+                'type': 'http.response.body',
+                'body': body,
+                'more_body': True,
+            })
+    finally:
+        disconnected.cancel()
+        hub.disconnect(user_id, queue)
+
+
+def with_event_stream(application):
+    """ASGI app which serves the event stream and passes the rest on."""
+    async def app(scope, receive, send):
+        if scope['type'] == 'http' and scope['path'] == PATH:
+            return await event_stream(scope, receive, send)
+        return await application(scope, receive, send)
+    return app
@@ -1,46 +1,61 @@
-from datetime import datetime, timedelta, timezone
-from django.conf import settings
-from .models import Deposit, Withdrawal
+from .finalize import FinalizationError, finalize_transfer, recover_finalizing
+from .follower import BlockFollower
+from .jobs import complete_job, fail_job
+from .models import Balance, Deposit, Withdrawal
 from .node import NodeV2API
-from .wallet import WalletV3, WalletError
+from .reaper import reap_step1_transfers
+from .wallet import WalletV3
 
 import dramatiq
+import logging
+
+logger = logging.getLogger(__name__)
+
+FINISH_MODELS = {
+    'deposit': Deposit,
+    'withdrawal': Withdrawal,
+}
 
 
 # NOTE: django-dramatiq auto-discovers tasks in app/tasks.py
 @dramatiq.actor
 def update_deposits_and_withdrawals():
-    node_api = NodeV2API()
-    current_height = node_api.get_tip()['height']
-    deposits = list(Deposit.objects.filter(
-        confirmations__lt=settings.REQUIRED_CONFIRMATIONS,
-        status="awaiting confirmation"
-    ))
-    withdrawals = list(Withdrawal.objects.filter(
-        confirmations__lt=settings.REQUIRED_CONFIRMATIONS,
-        status="awaiting confirmation"
-    ))
-    # we initialize it here, just so that we don't need to set it multiple times
-    # later if it turns out that multiple transactions need to be re-broadcasted
-    wallet_api = None
-    for deposit_or_withdrawal in deposits + withdrawals:
-        try:
-            kernel_excess_height = node_api.get_kernel(
-                deposit_or_withdrawal.kernel_excess,
-                current_height - 60*24*7  # one week old max, speeds the search
-            )['height']
-        except KeyError:
-            # kernel is not yet on the chain. It could be that it was just
-            # created and has not been mined yet or transaction broadcast didn't
-            # go through for some reason.
-            continue
-        if kernel_excess_height > current_height:
-            # race condition, new block came between node calls, pretend you
-            # fetched before we got this new block, otherwise number of
-            # confirmations from different txs might not make sense
-            continue
-        else:
-            new_confirmations = min(
-                current_height - kernel_excess_height + 1, 10)
-        deposit_or_withdrawal.confirmations = new_confirmations
-        deposit_or_withdrawal.save()
+    # only new blocks are fetched and matched against the pending kernels,
+    # see BlockFollower
+    BlockFollower(NodeV2API()).run()
+    # settled transfers only wrote ledger entries, apply them to balances
+    materialize_balances.send()
+
+
+@dramatiq.actor
+def materialize_balances():
+    """Applies pending ledger entries to balances in batches."""
+    while Balance.materialize():
+        pass
+
+
+@dramatiq.actor
+def reap_abandoned_transfers():
+    """Deletes unfinished step-1 transfers and cancels their transactions."""
+    reap_step1_transfers(WalletV3.get_wallet_api())
+
+
+@dramatiq.actor
+def recover_finalizing_transfers():
+    """Resumes or aborts finalizing transfers whose finish job died."""
+    recover_finalizing(WalletV3.get_wallet_api())
+
+
+# not retried, a retry could post the transaction again
+@dramatiq.actor(max_retries=0)
+def finish_transfer(job_id, model_name, transfer_id, slate):
+    """Finalizes and posts a signed deposit or withdrawal, see finish views."""
+    try:
+        result = finalize_transfer(FINISH_MODELS[model_name], transfer_id, slate)
+    except FinalizationError as e:
+        fail_job(job_id, str(e))
+    except Exception:
+        logger.exception('Finish job {} failed'.format(job_id))
+        fail_job(job_id, 'Something went wrong')
+    else:
+        complete_job(job_id, result)
@@ -1,3 +1,814 @@
-from django.test import TestCase
+from asgiref.sync import async_to_sync
+from apscheduler.schedulers.background import BlockingScheduler
+from django.conf import settings
+from django.contrib.auth.models import Group, Permission, User
+from django.core.management import call_command
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from guardian.shortcuts import remove_perm
+from rest_framework.test import APIClient, APIRequestFactory, force_authenticate
+from datetime import timedelta
+from ecdsa import ECDH, SECP256k1
+from unittest import mock
 
-# Create your tests here.
+from . import async_views
+from .authentication import is_revoked, revoke_user_tokens
+from .benchmarks import StandInNode
+from .caching import balance_cache
+from .finalize import (
+    FinalizationError,
+    abort_finalization,
+    finalize_transfer,
+    recover_finalizing,
+)
+from .follower import BlockFollower
+from .helpers import format_grin
+from .models import (
+    Balance,
+    Currency,
+    Deposit,
+    LedgerEntry,
+    ScanCheckpoint,
+    Withdrawal,
+)
+from .serializers import (
+    BalanceSerializer,
+    ClaimsTokenObtainPairSerializer,
+    DepositSerializer,
+)
+from .wallet import (
+    AsyncWalletSession,
+    AsyncWalletV3,
+    WalletError,
+    WalletSession,
+    WalletV3,
+    check_response,
+    decrypt,
+    encrypt,
+)
+
+import json
+import os
+
+
+class ConfirmationsQueryCountTest(TestCase):
+    """Number of queries of a confirmations run must not grow with transfers."""
+
+    start_height = 1000
+
+    def setUp(self):
+        Currency.objects.create(name='Grin', symbol='GRIN')
+        self.user = User.objects.create(username='alice')
+        self.balance = self.user.balances.get(currency__symbol='GRIN')
+        ScanCheckpoint.objects.create(
+            name=BlockFollower.CHECKPOINT_NAME,
+            height=self.start_height,
+            block_hash='hash-{}'.format(self.start_height),
+        )
+
+    def create_transfers(self, count):
+        # kernels are mined in the block after the checkpoint
+        kernel_height = self.start_height + 1
+        for i in range(count):
+            for model, kernel_index in ((Deposit, i), (Withdrawal, count + i)):
+                model.objects.create(
+                    balance=self.balance,
+                    amount=10**9,
+                    status='awaiting confirmation',
+                    tx_slate_id='{}-{}'.format(count, kernel_index),
+                    kernel_excess='kernel-{}-{}'.format(kernel_height, kernel_index),
+                    broadcast_height=self.start_height,
+                )
+        # transfers are older than the last run, so they are only matched by
+        # scanning blocks
+        long_ago = timezone.now() - timedelta(days=1)
+        Deposit.objects.update(modified=long_ago)
+        Withdrawal.objects.update(modified=long_ago)
+        # both deposits and withdrawals are locked
+        Balance.objects.filter(pk=self.balance.pk).update(
+            amount=100 * 10**9, locked_amount=2 * count * 10**9)
+
+    def run_follower(self, transfers):
+        self.create_transfers(transfers)
+        node = StandInNode(
+            self.start_height, kernels_per_block=2 * transfers, latency=0)
+        node.height += 1
+        with CaptureQueriesContext(connection) as first_block:
+            BlockFollower(node).run()
+        # the rest of the required confirmations, all transfers are settled
+        node.height += 9
+        with CaptureQueriesContext(connection) as settlement:
+            BlockFollower(node).run()
+        return len(first_block), len(settlement)
+
+    def test_query_count_is_constant(self):
+        few = self.run_follower(1)
+        Deposit.objects.all().delete()
+        Withdrawal.objects.all().delete()
+        ScanCheckpoint.objects.update(
+            height=self.start_height,
+            block_hash='hash-{}'.format(self.start_height),
+        )
+        many = self.run_follower(20)
+        self.assertEqual(few, many)
+
+    def test_settlement_updates_balance(self):
+        self.run_follower(3)
+        self.assertFalse(
+            Deposit.objects.exclude(status='finished').exists())
+        self.assertFalse(
+            Withdrawal.objects.exclude(status='finished').exists())
+        balance = Balance.materialize([self.balance.pk])[self.balance.pk]
+        # deposits were credited, withdrawals were already taken from amount
+        self.assertEqual(balance.amount, 103 * 10**9)
+        self.assertEqual(balance.locked_amount, 0)
+
+
+# cached lists would hide the queries, entries of other tests could be served
+@override_settings(READ_CACHE=dict(settings.READ_CACHE, ENABLED=False))
+class ListQueryCountTest(TestCase):
+    """Number of queries of a list endpoint must not grow with listed rows."""
+
+    def setUp(self):
+        self.user = User.objects.create(username='alice')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def create_rows(self, count):
+        start = Currency.objects.count()
+        for i in range(start, start + count):
+            currency = Currency.objects.create(
+                name='Coin {}'.format(i), symbol='coin-{}'.format(i))
+            balance = self.user.balances.get(currency=currency)
+            for model in (Deposit, Withdrawal):
+                model.objects.create(
+                    balance=balance,
+                    amount=10**9,
+                    status='canceled',
+                    tx_slate_id='{}-{}'.format(model.__name__, i),
+                )
+
+    def count_queries(self, url, rows):
+        self.create_rows(rows)
+        # first request fills the permission and content type caches
+        self.client.get(url)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return len(queries)
+
+    def assert_constant(self, url):
+        few = self.count_queries(url, 1)
+        many = self.count_queries(url, 10)
+        self.assertEqual(few, many)
+
+    def test_balances(self):
+        self.assert_constant('/api/balances/')
+
+    def test_deposits(self):
+        self.assert_constant('/api/deposits/')
+
+    def test_withdrawals(self):
+        self.assert_constant('/api/withdrawals/')
+
+
+# cached lists would hide the queries, entries of other tests could be served
+@override_settings(READ_CACHE=dict(settings.READ_CACHE, ENABLED=False))
+class OwnershipTest(TestCase):
+    """Users see only their own transfers, only superusers see all of them."""
+
+    def setUp(self):
+        Currency.objects.create(name='Grin', symbol='GRIN')
+        self.deposits = [
+            Deposit.objects.create(
+                balance=User.objects.create(username=name).balances.get(),
+                amount=10**9,
+                status='canceled',
+                tx_slate_id=name,
+            )
+            for name in ('alice', 'bob')
+        ]
+
+    def get(self, user, url):
+        client = APIClient()
+        client.force_authenticate(user)
+        return client.get(url)
+
+    def listed_ids(self, user):
+        response = self.get(user, '/api/deposits/')
+        self.assertEqual(response.status_code, 200)
+        return sorted(row['id'] for row in response.json()['results'])
+
+    def test_owner(self):
+        alice = User.objects.get(username='alice')
+        self.assertEqual(self.listed_ids(alice), [self.deposits[0].pk])
+        response = self.get(alice, '/api/deposits/{}/'.format(self.deposits[1].pk))
+        self.assertEqual(response.status_code, 404)
+
+    def test_staff(self):
+        staff = User.objects.create(username='carol', is_staff=True)
+        self.assertEqual(self.listed_ids(staff), [])
+        response = self.get(staff, '/api/deposits/{}/'.format(self.deposits[0].pk))
+        self.assertEqual(response.status_code, 404)
+
+    def test_superuser(self):
+        superuser = User.objects.create(username='dave', is_superuser=True)
+        self.assertEqual(
+            self.listed_ids(superuser), [deposit.pk for deposit in self.deposits])
+
+
+class ValuesListTest(TestCase):
+    """List endpoints built from values() must match the serializers."""
+
+    def setUp(self):
+        Currency.objects.create(name='Grin', symbol='GRIN')
+        self.user = User.objects.create(username='alice')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        balance = self.user.balances.get()
+        for i in range(3):
+            Deposit.objects.create(
+                balance=balance,
+                amount=i * 10**9 + 1,
+                status='canceled',
+                tx_slate_id=str(i),
+            )
+
+    def test_balances(self):
+        response = self.client.get('/api/balances/')
+        expected = BalanceSerializer(self.user.balances.all(), many=True).data
+        self.assertEqual(response.json(), expected)
+
+    def test_deposits(self):
+        response = self.client.get('/api/deposits/?page_size=2')
+        newest = Deposit.objects.order_by('-created', '-id')
+        self.assertEqual(
+            response.json()['results'],
+            DepositSerializer(newest[:2], many=True).data,
+        )
+        response = self.client.get(response.json()['next'])
+        self.assertEqual(
+            response.json()['results'],
+            DepositSerializer(newest[2:], many=True).data,
+        )
+
+
+class ChangesTest(TestCase):
+    """Delta sync returns only user's rows changed since the cursor."""
+
+    def setUp(self):
+        Currency.objects.create(name='Grin', symbol='GRIN')
+        self.user = User.objects.create(username='alice')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.balance = self.user.balances.get()
+        other = User.objects.create(username='bob').balances.get()
+        Deposit.objects.create(
+            balance=other, amount=1, status='canceled', tx_slate_id='other')
+
+    def sync(self, cursor=''):
+        response = self.client.get('/api/changes/', {'since': cursor})
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def create_deposit(self, slate_id, status='canceled'):
+        return Deposit.objects.create(
+            balance=self.balance,
+            amount=10**9,
+            status=status,
+            tx_slate_id=slate_id,
+        )
+
+    def settle(self):
+        # rows modified before the settle window
+        old = timezone.now() - timedelta(days=1)
+        Balance.objects.update(modified=old)
+        Deposit.objects.update(modified=old)
+
+    def test_changes_since_cursor(self):
+        deposit = self.create_deposit('a')
+        self.create_deposit('step-1', status='awaiting transaction signature')
+        self.settle()
+        changes = self.sync()
+        self.assertFalse(changes['more'])
+        self.assertEqual(changes['balances']['rows'], [
+            [self.balance.pk, 'GRIN', format_grin(0), format_grin(0)]])
+        self.assertEqual(
+            changes['deposits']['fields'],
+            ['id', 'balance', 'amount', 'status', 'confirmations', 'created'])
+        self.assertEqual(
+            [row[0] for row in changes['deposits']['rows']], [deposit.pk])
+        self.assertNotIn('withdrawals', changes)
+        # nothing changed since
+        self.assertEqual(set(self.sync(changes['cursor'])), {'cursor', 'more'})
+        deposit.confirmations = 3
+        deposit.save()
+        rows = self.sync(changes['cursor'])['deposits']['rows']
+        self.assertEqual([(row[0], row[4]) for row in rows], [(deposit.pk, 3)])
+
+    def test_settle_window(self):
+        self.create_deposit('a')
+        changes = self.sync()
+        # recent rows are sent again, they might have been committed late
+        self.assertIn('deposits', self.sync(changes['cursor']))
+
+    def test_pages(self):
+        with self.settings(CHANGES={'PAGE_SIZE': 2, 'SETTLE_SECONDS': 0}):
+            for i in range(5):
+                self.create_deposit(str(i))
+            self.create_deposit('tie-1')
+            tie = self.create_deposit('tie-2')
+            Deposit.objects.filter(tx_slate_id__startswith='tie').update(
+                modified=tie.modified)
+            seen = []
+            changes = {'cursor': '', 'more': True}
+            while changes['more']:
+                changes = self.sync(changes['cursor'])
+                seen.extend(
+                    row[0] for row in changes.get('deposits', {'rows': []})['rows'])
+        self.assertEqual(
+            sorted(seen),
+            list(self.balance.deposits.order_by('pk').values_list('pk', flat=True)))
+
+    def test_aborted_transfer_is_removed(self):
+        deposit = self.create_deposit('a', status='finalizing')
+        self.settle()
+        changes = self.sync()
+        self.assertEqual(
+            [row[0] for row in changes['deposits']['rows']], [deposit.pk])
+        abort_finalization(Deposit, deposit.pk)
+        aborted = self.sync(changes['cursor'])
+        self.assertEqual(aborted['deposits']['rows'], [])
+        self.assertEqual(aborted['deposits']['removed'], [deposit.pk])
+        # still reported after the reaper deleted it
+        Deposit.objects.filter(pk=deposit.pk).delete()
+        self.assertEqual(
+            self.sync(changes['cursor'])['deposits']['removed'], [deposit.pk])
+
+    def test_invalid_cursor(self):
+        response = self.client.get('/api/changes/', {'since': 'yesterday'})
+        self.assertEqual(response.status_code, 400)
+
+
+class RecoverFinalizingTest(TestCase):
+    """
+    Interrupted finalizations are resumed or aborted by the sweeper, a
+    transaction which might have been posted never goes back to step-1.
+    """
+
+    def setUp(self):
+        Currency.objects.create(name='Grin', symbol='GRIN')
+        self.balance = User.objects.create(username='alice').balances.get()
+        self.wallet = mock.Mock()
+        self.wallet.finalize_tx.return_value = {'id': 'a'}
+        self.wallet.retrieve_txs.return_value = [{'kernel_excess': '08ab'}]
+        self.wallet.get_stored_tx.return_value = {'id': 'a', 'sta': 'S3'}
+
+    def create_withdrawal(self, **kwargs):
+        return Withdrawal.objects.create(
+            balance=self.balance,
+            amount=10**9,
+            status='finalizing',
+            tx_slate_id='a',
+            **kwargs
+        )
+
+    def make_stale(self):
+        old = timezone.now() - timedelta(days=1)
+        Withdrawal.objects.update(modified=old)
+        Withdrawal.objects.exclude(post_started=None).update(post_started=old)
+
+    def finish(self, withdrawal):
+        with mock.patch('backend.api.finalize.WalletV3.get_wallet_api',
+                        return_value=self.wallet), \
+                mock.patch('backend.api.finalize.get_chain_height',
+                           return_value=1000):
+            return finalize_transfer(Withdrawal, withdrawal.pk, {'id': 'a'})
+
+    def assert_status(self, withdrawal, status):
+        withdrawal.refresh_from_db()
+        self.assertEqual(withdrawal.status, status)
+
+    def assert_not_unlocked(self):
+        self.assertFalse(LedgerEntry.objects.filter(kind='unlock').exists())
+
+    def test_finish(self):
+        withdrawal = self.create_withdrawal()
+        self.assertEqual(self.finish(withdrawal)['status'], 'awaiting confirmation')
+        self.wallet.post_tx.assert_called_once_with({'id': 'a'})
+        withdrawal.refresh_from_db()
+        self.assertEqual(withdrawal.kernel_excess, '08ab')
+        self.assertEqual(withdrawal.broadcast_height, 1000)
+        self.assertIsNotNone(withdrawal.post_started)
+
+    def test_failed_finalize_is_aborted(self):
+        withdrawal = self.create_withdrawal()
+        self.wallet.finalize_tx.side_effect = Exception('invalid slate')
+        with self.assertRaises(FinalizationError):
+            self.finish(withdrawal)
+        self.wallet.post_tx.assert_not_called()
+        self.assert_status(withdrawal, 'awaiting transaction signature')
+        self.assertIsNone(withdrawal.post_started)
+
+    def test_queued_job_after_abort(self):
+        withdrawal = self.create_withdrawal()
+        self.make_stale()
+        self.assertEqual(recover_finalizing(self.wallet), 0)
+        self.assert_status(withdrawal, 'awaiting transaction signature')
+        # the job runs only after the sweeper aborted the transfer
+        with self.assertRaises(FinalizationError):
+            self.finish(withdrawal)
+        self.wallet.finalize_tx.assert_not_called()
+        self.wallet.post_tx.assert_not_called()
+
+    def test_post_timeout(self):
+        withdrawal = self.create_withdrawal()
+        self.wallet.post_tx.side_effect = Exception('timeout')
+        with self.assertRaises(FinalizationError):
+            self.finish(withdrawal)
+        self.assert_status(withdrawal, 'finalizing')
+        self.assertIsNotNone(withdrawal.post_started)
+        self.assertEqual(withdrawal.broadcast_height, 1000)
+        # the sweeper asks the wallet and posts the stored transaction again
+        self.make_stale()
+        self.wallet.post_tx.reset_mock(side_effect=True)
+        self.assertEqual(recover_finalizing(self.wallet), 1)
+        self.wallet.retrieve_txs.assert_called_with(tx_slate_id='a', refresh=False)
+        self.wallet.get_stored_tx.assert_called_once_with(slate_id='a')
+        self.wallet.post_tx.assert_called_once_with({'id': 'a', 'sta': 'S3'})
+        self.assert_status(withdrawal, 'awaiting confirmation')
+        self.assertEqual(withdrawal.kernel_excess, '08ab')
+        self.assertEqual(withdrawal.broadcast_height, 1000)
+        self.assert_not_unlocked()
+
+    def test_claimed_without_kernel_is_aborted(self):
+        withdrawal = self.create_withdrawal(post_started=timezone.now())
+        self.make_stale()
+        # the wallet never finalized it, so it couldn't have been posted
+        self.wallet.retrieve_txs.return_value = [{'kernel_excess': None}]
+        self.assertEqual(recover_finalizing(self.wallet), 0)
+        self.wallet.post_tx.assert_not_called()
+        self.assert_status(withdrawal, 'awaiting transaction signature')
+
+    def test_recent_is_left_alone(self):
+        withdrawal = self.create_withdrawal(post_started=timezone.now())
+        Withdrawal.objects.update(modified=timezone.now() - timedelta(days=1))
+        self.assertEqual(recover_finalizing(self.wallet), 0)
+        self.wallet.retrieve_txs.assert_not_called()
+        self.assert_status(withdrawal, 'finalizing')
+
+
+class FakeOwnerApi:
+    """Owner api of a wallet which can be restarted or break responses."""
+
+    def __init__(self):
+        self.restart()
+        self.calls = {}
+        # method -> {'Err': ...} result
+        self.errors = {}
+        # methods whose responses can't be decrypted
+        self.broken_responses = set()
+        # called after a method was run, before its response is encrypted
+        self.on_call = None
+
+    def restart(self):
+        self.secret = None
+        self.token = None
+
+    def handle(self, method, params):
+        if method == 'init_secure_api':
+            ecdh = ECDH(curve=SECP256k1)
+            ecdh.generate_private_key()
+            ecdh.load_received_public_key_bytes(bytes.fromhex(params['ecdh_pubkey']))
+            self.secret = ecdh.generate_sharedsecret_bytes().hex()
+            return {'result': {'Ok': ecdh.get_public_key().to_string('compressed').hex()}}
+        if self.secret is None:
+            return {'error': {'code': -32001, 'message': 'Encryption must be enabled'}}
+        secret = self.secret
+        try:
+            request = json.loads(decrypt(
+                secret, params['body_enc'], bytes.fromhex(params['nonce'])))
+        except ValueError:
+            return {'error': {'code': -32002, 'message': 'Decryption error'}}
+        response = {'jsonrpc': '2.0', 'id': 1, 'result': self.run(
+            request['method'], request['params'])}
+        if self.on_call is not None:
+            self.on_call(request['method'])
+        if request['method'] in self.broken_responses:
+            secret = os.urandom(32).hex()
+        nonce = os.urandom(12)
+        return {'result': {'Ok': {
+            'nonce': nonce.hex(),
+            'body_enc': encrypt(secret, json.dumps(response), nonce),
+        }}}
+
+    def run(self, method, params):
+        if method == 'open_wallet':
+            self.token = os.urandom(8).hex()
+            return {'Ok': self.token}
+        if params['token'] != self.token:
+            return {'Err': 'KeychainDoesntExist'}
+        self.calls[method] = self.calls.get(method, 0) + 1
+        if method in self.errors:
+            return self.errors[method]
+        return {'Ok': [True, []]}
+
+
+class FakeWalletV3(WalletV3):
+    owner_api = None
+
+    def post(self, method, params, timeout=None):
+        return check_response(
+            method, params, self.owner_api.handle(method, params))
+
+
+class FakeAsyncWalletV3(AsyncWalletV3):
+    owner_api = None
+
+    async def post(self, method, params, timeout=None):
+        return check_response(
+            method, params, self.owner_api.handle(method, params))
+
+
+class WalletSessionTest(TestCase):
+    """
+    Broken sessions are renewed and the call retried only if the wallet
+    rejected it before running it.
+    """
+
+    def setUp(self):
+        self.owner_api = FakeWalletV3.owner_api = FakeOwnerApi()
+        self.session = WalletSession(FakeWalletV3)
+        self.wallet_api = self.session.get_wallet_api()
+
+    def test_wallet_restart(self):
+        self.wallet_api.retrieve_txs(refresh=False)
+        self.owner_api.restart()
+        self.wallet_api.retrieve_txs(refresh=False)
+        self.assertEqual(self.owner_api.calls, {'retrieve_txs': 2})
+        self.assertEqual(self.session.handshakes, 2)
+
+    def test_wallet_closed(self):
+        # new token, eg. someone else opened the wallet
+        self.owner_api.token = 'other'
+        self.wallet_api.retrieve_txs(refresh=False)
+        self.assertEqual(self.owner_api.calls, {'retrieve_txs': 1})
+        self.assertEqual(self.session.handshakes, 2)
+
+    def test_response_error_is_not_retried(self):
+        self.owner_api.broken_responses.add('post_tx')
+        with self.assertRaises(WalletError):
+            self.wallet_api.post_tx({'id': 'a'})
+        self.assertEqual(self.owner_api.calls, {'post_tx': 1})
+        self.assertEqual(self.session.handshakes, 1)
+
+    def test_call_error_is_not_retried(self):
+        self.owner_api.errors['post_tx'] = {'Err': {'GenericError': 'token'}}
+        with self.assertRaises(WalletError):
+            self.wallet_api.post_tx({'id': 'a'})
+        self.assertEqual(self.owner_api.calls, {'post_tx': 1})
+        self.assertEqual(self.session.handshakes, 1)
+
+    def test_renewal_during_call(self):
+        # another thread renews the session while our call is running, its
+        # response is still encrypted with the secret the call was made with
+        def renew(method):
+            if method == 'post_tx':
+                self.owner_api.on_call = None
+                self.session.renew(self.wallet_api, self.session.generation)
+
+        self.owner_api.on_call = renew
+        self.wallet_api.post_tx({'id': 'a'})
+        self.assertEqual(self.owner_api.calls, {'post_tx': 1})
+        self.assertEqual(self.session.handshakes, 2)
+
+    def test_async(self):
+        FakeAsyncWalletV3.owner_api = self.owner_api
+        session = AsyncWalletSession(FakeAsyncWalletV3)
+
+        async def calls():
+            wallet_api = await session.get_wallet_api()
+            self.owner_api.restart()
+            await wallet_api.retrieve_txs(refresh=False)
+            self.owner_api.broken_responses.add('post_tx')
+            with self.assertRaises(WalletError):
+                await wallet_api.post_tx({'id': 'a'})
+
+        async_to_sync(calls)()
+        self.assertEqual(self.owner_api.calls, {'retrieve_txs': 1, 'post_tx': 1})
+        self.assertEqual(session.handshakes, 2)
+
+
+class SchedulerTest(TestCase):
+    """Scheduler registers all periodic tasks before it starts."""
+
+    def test_jobs(self):
+        with mock.patch.object(BlockingScheduler, 'start'), \
+                mock.patch.object(BlockingScheduler, 'add_job') as add_job:
+            call_command('run_scheduler', stdout=mock.Mock())
+        self.assertEqual([call.args[0].__name__ for call in add_job.call_args_list], [
+            'watch_tip',
+            'periodically_run_job',
+            'periodically_materialize_balances',
+            'periodically_reap_abandoned_transfers',
+            'periodically_recover_finalizing_transfers',
+        ])
+        for call in add_job.call_args_list:
+            self.assertEqual(call.args[1:], ('interval',))
+
+
+class BalanceCacheInvalidationTest(TestCase):
+    """Balance changes invalidate the cached balance list of their user."""
+
+    def setUp(self):
+        Currency.objects.create(name='Grin', symbol='GRIN')
+        self.user = User.objects.create(username='alice')
+        self.balance = self.user.balances.get()
+
+    def test_balance_save(self):
+        with mock.patch.object(balance_cache, 'invalidate') as invalidate:
+            self.balance.save()
+        invalidate.assert_called_once_with([self.user.pk])
+
+    def test_ledger_entry(self):
+        deposit = Deposit.objects.create(
+            balance=self.balance,
+            amount=10**9,
+            status='awaiting transaction signature',
+            tx_slate_id='a',
+        )
+        deposit.status = 'awaiting confirmation'
+        with mock.patch.object(balance_cache, 'invalidate') as invalidate:
+            deposit.save()
+        # pending entry changes the listed balance
+        invalidate.assert_called_once_with([self.user.pk])
+        with mock.patch.object(balance_cache, 'invalidate') as invalidate:
+            Balance.materialize()
+        self.assertEqual(list(invalidate.call_args[0][0]), [self.user.pk])
+
+
+@override_settings(READ_CACHE=dict(settings.READ_CACHE, ENABLED=False))
+class ConditionalListTest(TestCase):
+    """Unchanged lists are answered with 304 Not Modified."""
+
+    def setUp(self):
+        Currency.objects.create(name='Grin', symbol='GRIN')
+        self.user = User.objects.create(username='alice')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.balance = self.user.balances.get()
+        self.deposit = Deposit.objects.create(
+            balance=self.balance, amount=1, status='canceled', tx_slate_id='a')
+        self.settle()
+
+    def settle(self):
+        old = timezone.now() - timedelta(days=1)
+        Balance.objects.update(modified=old)
+        Deposit.objects.update(modified=old)
+
+    def assert_not_modified(self, url):
+        etag = self.client.get(url)['ETag']
+        # first request fills the permission and content type caches
+        self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['ETag'], etag)
+        # only the validators, rows are not read
+        self.assertEqual(
+            [query['sql'] for query in queries if 'COUNT' in query['sql']],
+            [query['sql'] for query in queries if 'SELECT' in query['sql']][-1:],
+        )
+        return etag
+
+    def test_balances(self):
+        etag = self.assert_not_modified('/api/balances/')
+        self.balance.amount = 10**9
+        self.balance.save()
+        self.settle()
+        response = self.client.get('/api/balances/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test_deposits(self):
+        etag = self.assert_not_modified('/api/deposits/')
+        Deposit.objects.create(
+            balance=self.balance, amount=1, status='canceled', tx_slate_id='b')
+        self.settle()
+        response = self.client.get('/api/deposits/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+
+    def test_last_modified(self):
+        last_modified = self.client.get('/api/withdrawals/')
+        self.assertNotIn('Last-Modified', last_modified)
+        last_modified = self.client.get('/api/deposits/')['Last-Modified']
+        response = self.client.get(
+            '/api/deposits/', HTTP_IF_MODIFIED_SINCE=last_modified)
+        self.assertEqual(response.status_code, 304)
+
+    def test_recent_change(self):
+        # a late commit could still change the list, no validators yet
+        self.deposit.save()
+        response = self.client.get('/api/deposits/')
+        self.assertNotIn('ETag', response)
+        self.assertIn('no-cache', response['Cache-Control'])
+
+
+class AsyncTransferPermissionTest(TestCase):
+    """Async transfer views require the same model permissions as DRF ones."""
+
+    def setUp(self):
+        Currency.objects.create(name='Grin', symbol='GRIN')
+        self.user = User.objects.create(username='alice')
+
+    def start_deposit(self, data):
+        request = APIRequestFactory().post(
+            '/api/deposits/start/', data, format='json')
+        force_authenticate(request, User.objects.get(pk=self.user.pk))
+        wallet_api = mock.Mock()
+        wallet_api.issue_invoice_tx = mock.AsyncMock(return_value={'id': 'a'})
+        wallet_api.create_slatepack_message = mock.AsyncMock(
+            return_value='BEGINSLATEPACK. ... ENDSLATEPACK.')
+        with mock.patch.object(async_views, 'Slot'), \
+                mock.patch.object(async_views.AsyncWalletV3, 'get_wallet_api',
+                                  mock.AsyncMock(return_value=wallet_api)):
+            return async_to_sync(async_views.start_deposit)(request)
+
+    def test_add_permission(self):
+        data = {'symbol': 'grin', 'address': 'grin1abc', 'amount': '1'}
+        response = self.start_deposit(data)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            json.loads(response.content), 'BEGINSLATEPACK. ... ENDSLATEPACK.')
+        self.assertTrue(Deposit.objects.filter(tx_slate_id='a').exists())
+        remove_perm('api.add_deposit', self.user)
+        self.assertEqual(self.start_deposit(data).status_code, 403)
+
+    def test_unsupported_symbol(self):
+        response = self.start_deposit({'address': 'grin1abc', 'amount': '1'})
+        self.assertEqual(response.status_code, 400)
+
+
+class UserTokenRevocationTest(TestCase):
+    """Revocation by user rejects older tokens, even from the same second."""
+
+    def setUp(self):
+        self.user = User.objects.create(username='alice')
+        stored = {}
+        connection = mock.Mock()
+        connection.set.side_effect = (
+            lambda key, value, ex: stored.__setitem__(key, str(value).encode()))
+        connection.mget.side_effect = lambda *keys: [stored.get(k) for k in keys]
+        patcher = mock.patch(
+            'backend.api.authentication.get_redis_connection',
+            return_value=connection,
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def get_token(self, now):
+        with mock.patch('time.time', return_value=now):
+            return ClaimsTokenObtainPairSerializer.get_token(self.user)
+
+    def test_same_second(self):
+        before = self.get_token(1000.2)
+        with mock.patch('time.time', return_value=1000.5):
+            revoke_user_tokens(self.user.pk)
+        after = self.get_token(1000.7)
+        self.assertTrue(is_revoked(before))
+        self.assertTrue(is_revoked(before.access_token))
+        self.assertFalse(is_revoked(after))
+        self.assertFalse(is_revoked(after.access_token))
+
+
+@mock.patch(
+    'backend.api.signals.receivers.transaction.on_commit', lambda func: func())
+@mock.patch('backend.api.signals.receivers.revoke_user_tokens')
+class PermissionChangeRevocationTest(TestCase):
+    """Permission changes revoke tokens, which carry user's permissions."""
+
+    def setUp(self):
+        self.user = User.objects.create(username='alice')
+        self.permission = Permission.objects.get(codename='add_deposit')
+        self.group = Group.objects.create(name='traders')
+
+    def assert_revoked(self, revoke, change):
+        revoke.reset_mock()
+        change()
+        revoke.assert_called_once_with(self.user.pk)
+
+    def test_user_permissions(self, revoke):
+        self.assert_revoked(
+            revoke, lambda: self.user.user_permissions.remove(self.permission))
+        self.assert_revoked(
+            revoke, lambda: self.permission.user_set.add(self.user))
+        self.assert_revoked(revoke, lambda: self.permission.user_set.clear())
+
+    def test_groups(self, revoke):
+        self.assert_revoked(revoke, lambda: self.user.groups.add(self.group))
+        self.assert_revoked(
+            revoke, lambda: self.group.permissions.add(self.permission))
+        self.assert_revoked(revoke, lambda: self.group.permissions.clear())
+        self.assert_revoked(revoke, lambda: self.group.user_set.remove(self.user))
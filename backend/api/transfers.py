@@ -0,0 +1,148 @@
+"""
+Database side of starting and finishing deposits and withdrawals, shared by
+the sync (DRF) and the async views. The views do the wallet calls.
+"""
+from django.core.exceptions import ValidationError
+from django.db import transaction
+from .helpers import format_grin, grin_to_nanogrin
+from .jobs import create_job
+from .models import Deposit, Withdrawal
+from .tasks import finish_transfer
+
+MIN_AMOUNT = grin_to_nanogrin('0.1')
+
+# slate state of a signed contract, exchange finalizes invoices on deposits and
+# payments on withdrawals
+SIGNED_STATES = {
+    Deposit: 'I2',
+    Withdrawal: 'S2',
+}
+
+
+class TransferError(Exception):
+    """Transfer can't be started or finished, message is for the user."""
+    pass
+
+
+def parse_start_data(data):
+    """Returns (user's wallet address, amount in nanogrin) of a start request."""
+    user_wallet_address = data.get('address')
+    amount = data.get('amount')
+    if not user_wallet_address or not amount:
+        raise TransferError('Invalid data')
+    # amounts are in nanogrin from here on
+    try:
+        amount = grin_to_nanogrin(amount)
+    except (ArithmeticError, ValueError):
+        raise TransferError('Invalid data')
+    if amount < MIN_AMOUNT:
+        raise TransferError('Minimum amount is {} grin'.format(
+            format_grin(MIN_AMOUNT)))
+    return user_wallet_address, amount
+
+
+def parse_finish_data(data):
+    """Returns the slatepack message of a finish request."""
+    try:
+        slatepack_msg = data['data']['slatepack_msg']
+    except (KeyError, TypeError):
+        raise TransferError('Invalid data')
+    if slatepack_msg is None:
+        raise TransferError('Invalid data')
+    return slatepack_msg
+
+
+def invoice_tx_args(amount):
+    """Wallet's issue_invoice_tx arguments of a deposit."""
+    return {
+        # NOTE: amount for api is in nanogrin, same as ours
+        'amount': str(amount),
+    }
+
+
+def send_tx_args(amount, user_wallet_address):
+    """Wallet's init_send_tx arguments of a withdrawal."""
+    return {
+        # NOTE: amount for api is in nanogrin, same as ours
+        'amount': str(amount),
+        # reorgs of 1 are normal, 2 rare, 3 seems safe
+        'minimum_confirmations': 3,
+        # selection_strategy_is_use_all is false because exchanges can't
+        # work with this set to true, as they would quickly run out of utxos
+        'selection_strategy_is_use_all': False,
+        # num_change_outputs is optional, but we should probably define it,
+        # we could even make it dependent on the amount
+        'num_change_outputs': 1,
+        # we want payment proof
+        'payment_proof_recipient_address': user_wallet_address,
+        # we want late-locking, otherwise user's can spam-lock exchange's
+        # utxos, when late-locking is default, we can remove this
+        'late_lock': False,
+        # max_outputs is required
+        'max_outputs': 500,
+    }
+
+
+def check_available_amount(user, amount):
+    """Raises TransferError if user's grin balance can't cover the amount."""
+    balance = user.balances.get(currency__symbol='GRIN')
+    # ledger entries which are not applied yet count too
+    available_amount, _ = balance.with_pending()
+    if amount > available_amount:
+        raise TransferError('Your balance only has {} grin'.format(
+            format_grin(available_amount)))
+
+
+def create_step1_transfer(model, user, amount, tx_slate_id):
+    """
+    Creates a transfer awaiting user's signature. Previous unfinished transfer
+    of this user is superseded by it, it is deleted and its transaction
+    canceled by the step-1 reaper.
+    """
+    return model.objects.create(
+        balance=user.balances.get(currency__symbol='GRIN'),
+        amount=amount,
+        confirmations=0,
+        status='awaiting transaction signature',
+        tx_slate_id=tx_slate_id,
+    )
+
+
+def contract_error(model):
+    return TransferError('Only the latest given {} contract is valid.'.format(
+        model._meta.verbose_name))
+
+
+def begin_finalization(model, user, slate):
+    """
+    Moves user's latest step-1 transfer matching the signed slate to
+    finalizing and starts the job which finalizes and posts it. Must be called
+    in a transaction, returns the job.
+    """
+    # only the latest step-1 transfer can be finished, older ones are
+    # superseded. Locked so that two concurrent finish requests can't both
+    # finish it and the reaper can't delete it meanwhile
+    transfer = model.objects.select_for_update(of=('self',)).filter(
+        status='awaiting transaction signature',
+        balance__currency__symbol='GRIN',
+        balance__user=user
+    ).order_by('-created', '-id').first()
+    if transfer is None or transfer.tx_slate_id != slate.get('id'):
+        raise contract_error(model)
+    if slate.get('sta') != SIGNED_STATES[model]:
+        raise TransferError('Invalid contract.')
+    # finalizing and posting is done by a job so that a slow wallet doesn't
+    # hold the request and database locks. Finalizing transfers can't be
+    # finished again and are not reaped
+    transfer.status = 'finalizing'
+    try:
+        # withdrawals lock the amount, it must still be available
+        transfer.save()
+    except ValidationError:
+        raise TransferError('Amount exceeds the available balance.')
+    model_name = model._meta.model_name
+    job = create_job(user, 'finish {}'.format(model_name))
+    # the job must see the committed status
+    transaction.on_commit(lambda: finish_transfer.send(
+        job['id'], model_name, transfer.pk, slate))
+    return job
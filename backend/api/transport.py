@@ -0,0 +1,111 @@
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+
+import asyncio
+import httpx
+import requests
+import threading
+import weakref
+
+
+class JsonRpcTransport:
+    """
+    HTTP transport for the wallet owner api and the node foreign api.
+
+    It keeps a pool of keep-alive connections, so we don't pay a TCP (and
+    possibly TLS) setup for each RPC, and applies a timeout to every request
+    which can be overridden per RPC method.
+    """
+
+    def __init__(self, url, auth):
+        transport_settings = settings.RPC_TRANSPORT
+        self.url = url
+        self.default_timeout = transport_settings['TIMEOUT']
+        self.method_timeouts = transport_settings['METHOD_TIMEOUTS']
+        self.session = requests.Session()
+        self.session.auth = auth
+        adapter = HTTPAdapter(
+            pool_connections=transport_settings['POOL_CONNECTIONS'],
+            pool_maxsize=transport_settings['POOL_MAXSIZE'],
+            # retrying is up to the caller, RPCs are not always idempotent
+            max_retries=0,
+        )
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def timeout_for(self, method):
+        return self.method_timeouts.get(method, self.default_timeout)
+
+    def post(self, payload, method=None, timeout=None):
+        """
+        Post the json payload. Timeout is taken from the settings of the given
+        method unless it's explicitly passed.
+        """
+        if timeout is None:
+            timeout = self.timeout_for(method)
+        return self.session.post(self.url, json=payload, timeout=timeout)
+
+    def close(self):
+        self.session.close()
+
+
+_transports = {}
+_transports_lock = threading.Lock()
+
+
+def get_transport(url, username, password):
+    """Returns the process-wide transport for the given url and credentials."""
+    key = (url, username, password)
+    with _transports_lock:
+        if key not in _transports:
+            _transports[key] = JsonRpcTransport(url, (username, password))
+        return _transports[key]
+
+
+class AsyncJsonRpcTransport:
+    """
+    Async version of JsonRpcTransport for the async api clients, it has the
+    same pooling and timeouts. It's bound to the event loop it's used in.
+    """
+
+    def __init__(self, url, auth):
+        transport_settings = settings.RPC_TRANSPORT
+        self.url = url
+        self.default_timeout = transport_settings['TIMEOUT']
+        self.method_timeouts = transport_settings['METHOD_TIMEOUTS']
+        self.client = httpx.AsyncClient(
+            auth=auth,
+            limits=httpx.Limits(
+                max_connections=transport_settings['ASYNC_MAX_CONNECTIONS'],
+                max_keepalive_connections=transport_settings['POOL_MAXSIZE'],
+            ),
+        )
+
+    def timeout_for(self, method):
+        return self.method_timeouts.get(method, self.default_timeout)
+
+    async def post(self, payload, method=None, timeout=None):
+        """Same as JsonRpcTransport.post, returns a httpx response."""
+        if timeout is None:
+            timeout = self.timeout_for(method)
+        if isinstance(timeout, tuple):
+            # requests style (connect, read) timeout
+            connect, read = timeout
+            timeout = httpx.Timeout(read, connect=connect)
+        return await self.client.post(self.url, json=payload, timeout=timeout)
+
+    async def close(self):
+        await self.client.aclose()
+
+
+# event loop -> {(url, username, password): transport}
+_async_transports = weakref.WeakKeyDictionary()
+
+
+def get_async_transport(url, username, password):
+    """Returns the async transport of the running event loop."""
+    transports = _async_transports.setdefault(asyncio.get_running_loop(), {})
+    key = (url, username, password)
+    if key not in transports:
+        transports[key] = AsyncJsonRpcTransport(url, (username, password))
+    return transports[key]
@@ -3,23 +3,57 @@ from django.db import transaction
 from django.db.models import Q
 from django.views.generic import TemplateView
 from django.views.decorators.cache import never_cache
-from rest_framework import viewsets, generics, status
+from rest_framework import mixins, viewsets, generics, status
 from rest_framework.decorators import action
-from rest_framework.exceptions import APIException
+from rest_framework.exceptions import APIException, NotFound, ValidationError
 from rest_framework.permissions import IsAdminUser, IsAuthenticated, AllowAny
 from rest_framework.response import Response
-from decimal import Decimal
+from rest_framework.reverse import reverse
+from rest_framework.views import APIView
+from rest_framework_simplejwt.exceptions import InvalidToken, TokenError
+from rest_framework_simplejwt.tokens import RefreshToken
+from rest_framework_simplejwt.views import TokenObtainPairView, TokenRefreshView
 
 from .serializers import (
+    ApiKeySerializer,
+    CheckedTokenRefreshSerializer,
+    ClaimsTokenObtainPairSerializer,
     UserSerializer,
     BalanceSerializer,
     CurrencySerializer,
     DepositSerializer,
     WithdrawalSerializer,
 )
-from .models import Balance, Currency, Deposit, Withdrawal
-from .mixins import AllowAnyRetrieveAndListMixin, CustomModelViewSet
+from .admission import admitted, get_metrics
+from .authentication import create_api_key, forget_api_key, revoke_token
+from .caching import balance_cache, currency_cache
+from .caching import get_metrics as get_cache_metrics
+from .changes import InvalidCursor, get_changes
+from .conditional import get_validators, not_modified, set_validators
+from .helpers import format_grin
+from .idempotency import idempotent
+from .jobs import get_job
+from .models import ApiKey, Balance, Currency, Deposit, LedgerEntry, Withdrawal
+from .mixins import (
+    AllowAnyRetrieveAndListMixin,
+    ConditionalListMixin,
+    CustomModelViewSet,
+    DefaultMixin,
+    ValuesListMixin,
+)
+from .pagination import HistoryCursorPagination
 from .permissions import ObjectPermissions
+from .transfers import (
+    TransferError,
+    begin_finalization,
+    check_available_amount,
+    contract_error,
+    create_step1_transfer,
+    invoice_tx_args,
+    parse_finish_data,
+    parse_start_data,
+    send_tx_args,
+)
 from .wallet import WalletV3, WalletError
 
 import logging
@@ -31,16 +65,149 @@ logger = logging.getLogger(__name__)
 index_view = never_cache(TemplateView.as_view(template_name='index.html'))
 
 
+def error_response(error):
+    return Response(
+        data={'detail': str(error)},
+        status=status.HTTP_400_BAD_REQUEST
+    )
+
+
+def job_response(job, request):
+    """202 response of a started job, Location is where to poll for it."""
+    return Response(
+        data=job,
+        status=status.HTTP_202_ACCEPTED,
+        headers={'Location': reverse(
+            'job-detail', args=[job['id']], request=request)},
+    )
+
+
 class UserCreate(generics.CreateAPIView):
     queryset = User.objects.all()
     serializer_class = UserSerializer
     permission_classes = (AllowAny, )
 
 
-class BalanceViewSet(CustomModelViewSet):
+class ClaimsTokenObtainPairView(TokenObtainPairView):
+    serializer_class = ClaimsTokenObtainPairSerializer
+
+
+class CheckedTokenRefreshView(TokenRefreshView):
+    serializer_class = CheckedTokenRefreshSerializer
+
+
+class TokenRevokeView(APIView):
+    """
+    API endpoint for logging out, revokes the access token of the request and
+    the given refresh token.
+    """
+    permission_classes = (IsAuthenticated, )
+
+    def post(self, request):
+        refresh = request.data.get('refresh')
+        try:
+            refresh = RefreshToken(refresh) if refresh else None
+        except TokenError as e:
+            raise InvalidToken(e.args[0])
+        if refresh is not None:
+            if refresh['user_id'] != request.user.pk:
+                raise InvalidToken('Token belongs to another user')
+            revoke_token(refresh)
+        # API key and session requests have no token to revoke
+        if hasattr(request.auth, 'payload'):
+            revoke_token(request.auth)
+        return Response(status=status.HTTP_204_NO_CONTENT)
+
+
+class ApiKeyViewSet(
+    DefaultMixin,
+    mixins.CreateModelMixin,
+    mixins.ListModelMixin,
+    mixins.DestroyModelMixin,
+    viewsets.GenericViewSet
+):
+    """
+    API endpoint for user's API keys. The key is returned only when it's
+    created, deleting a key revokes it.
+    """
+    queryset = ApiKey.objects.all()
+    serializer_class = ApiKeySerializer
+    owner_field = 'user'
+    permission_classes = (IsAuthenticated, )
+
+    def create(self, request):
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        api_key, key = create_api_key(
+            request.user, serializer.validated_data.get('name', ''))
+        data = self.get_serializer(api_key).data
+        data['key'] = key
+        return Response(data=data, status=status.HTTP_201_CREATED)
+
+    def perform_destroy(self, instance):
+        instance.delete()
+        forget_api_key(instance.key_id)
+
+
+class BalanceViewSet(ConditionalListMixin, ValuesListMixin, CustomModelViewSet):
     """API endpoint for getting balances"""
-    queryset = Balance.objects.all()
+    queryset = Balance.objects.select_related('currency')
     serializer_class = BalanceSerializer
+    owner_field = 'user'
+
+    def materialize_pending(self):
+        # amounts are a snapshot of the ledger, bring user's balances up to
+        # date if they have entries which are not applied yet
+        pending_balance_ids = set(LedgerEntry.objects.filter(
+            applied=False,
+            balance__user=self.request.user
+        ).values_list('balance_id', flat=True))
+        if pending_balance_ids:
+            Balance.materialize(pending_balance_ids)
+
+    def get_queryset(self):
+        # list materializes only when it isn't cached
+        if self.action != 'list':
+            self.materialize_pending()
+        return super().get_queryset()
+
+    def list(self, request, *args, **kwargs):
+        # superusers list everyone's balances and filtered lists vary, only the
+        # plain list of user's own balances is cached
+        if (
+            not balance_cache.enabled or
+            request.user.is_superuser or
+            request.query_params
+        ):
+            return self.list_materialized(request, *args, **kwargs)
+        # validators are cached with the list, a poll which hits the cache
+        # doesn't touch the db
+        listed = balance_cache.get(
+            request.user.pk,
+            lambda: self.load_list(request, *args, **kwargs),
+        )
+        etag, last_modified = listed['etag'], listed['last_modified']
+        response = not_modified(request, etag, last_modified)
+        if response is None:
+            response = Response(listed['data'])
+        return set_validators(response, etag, last_modified)
+
+    def list_materialized(self, request, *args, **kwargs):
+        self.materialize_pending()
+        return super().list(request, *args, **kwargs)
+
+    def load_list(self, request, *args, **kwargs):
+        """User's materialized balances with their validators."""
+        self.materialize_pending()
+        # before the rows are read, see ConditionalListMixin
+        etag, last_modified = get_validators(
+            self.filter_queryset(self.get_queryset()))
+        return {
+            'etag': etag,
+            'last_modified': last_modified,
+            'data': super(ConditionalListMixin, self).list(
+                request, *args, **kwargs).data,
+        }
 
 
 class CurrencyViewSet(AllowAnyRetrieveAndListMixin, CustomModelViewSet):
@@ -48,13 +215,35 @@ class CurrencyViewSet(AllowAnyRetrieveAndListMixin, CustomModelViewSet):
     queryset = Currency.objects.all()
     serializer_class = CurrencySerializer
 
+    def list(self, request, *args, **kwargs):
+        if request.query_params:
+            return super().list(request, *args, **kwargs)
+        return Response(currency_cache.get(
+            'list',
+            lambda: super(CurrencyViewSet, self).list(
+                request, *args, **kwargs).data,
+        ))
+
+    def retrieve(self, request, *args, **kwargs):
+        return Response(currency_cache.get(
+            kwargs[self.lookup_field],
+            lambda: super(CurrencyViewSet, self).retrieve(
+                request, *args, **kwargs).data,
+        ))
 
-class DepositViewSet(CustomModelViewSet):
+
+class DepositViewSet(ConditionalListMixin, ValuesListMixin, CustomModelViewSet):
     """API endpoint for getting deposits"""
-    queryset = Deposit.objects.filter(~Q(status="awaiting transaction signature"))
+    queryset = Deposit.objects.filter(
+        ~Q(status="awaiting transaction signature")
+    ).select_related('balance__currency')
     serializer_class = DepositSerializer
+    owner_field = 'balance__user'
+    pagination_class = HistoryCursorPagination
 
     @transaction.atomic
+    @idempotent
+    @admitted
     @action(
         detail=False,
         methods=['post'],
@@ -69,20 +258,10 @@ class DepositViewSet(CustomModelViewSet):
             raise APIException('Deposit not supported')
 
     def start_deposit_grin(self, request):
-        user_wallet_address = request.data.pop('address', None)
-        amount = request.data.pop('amount')
-        if not user_wallet_address or not amount:
-            return Response(
-                data={'detail': 'Invalid data'},
-                status=status.HTTP_400_BAD_REQUEST
-            )
-        amount = Decimal(str(amount))
-        min_amount = Decimal('0.1')
-        if amount < min_amount:
-            return Response(
-                data={'detail': 'Minimum amount is {0:f} grin'.format(min_amount)},
-                status=status.HTTP_400_BAD_REQUEST
-            )
+        try:
+            user_wallet_address, amount = parse_start_data(request.data)
+        except TransferError as e:
+            return error_response(e)
         wallet_api = WalletV3.get_wallet_api()
         # exchange has more control if it finalizes, so we need to create a RSR
         # when we do a deposit.
@@ -91,15 +270,13 @@ class DepositViewSet(CustomModelViewSet):
         # eg: late_lock etc ('init_send_tx' has that already), although in the
         # future late_lock should probably be the default (and only) way
         try:
-            versioned_slate = wallet_api.issue_invoice_tx({
-                # NOTE: amount for api is in nanogrin, that's why we multiply
-                'amount': str(int(amount * Decimal('1000000000'))),
-            })
+            versioned_slate = wallet_api.issue_invoice_tx(
+                invoice_tx_args(amount))
         except WalletError as e:
             logger.error('issue_invoice_tx failed, user: {}, amount: {}'.format(
-                request.user.username, amount))
+                request.user.username, format_grin(amount)))
             raise APIException('Failed to create an invoice')
-            
+
         # versioned_slate data is something like: {
         #   "amt": "6000000000",
         #   "id": "0436430c-2b02-624c-2032-570501212b00",
@@ -112,34 +289,8 @@ class DepositViewSet(CustomModelViewSet):
         #   "sta": "I1",
         #   "ver": "4:2"
         # }
-
-        # delete any existing deposit instances for this user for grin
-        # NOTE: we could just change its status to canceled or smth
-        existing_step1_deposit = Deposit.objects.filter(
-            status="awaiting transaction signature",
-            balance__currency__symbol='GRIN',
-            balance__user=request.user
-        ).first()
-        if existing_step1_deposit:
-            # cancel the transaction of previous unfinished deposit
-            try:
-                wallet_api.cancel_tx(tx_slate_id=existing_step1_deposit.tx_slate_id)
-            except Exception as e:
-                # who knows why this can fail, maybe they've manually deleted it
-                # before
-                pass
-            # delete the instance
-            existing_step1_deposit.delete()
-        # create a deposit instance
-        balance = self.request.user.balances.get(
-            currency__symbol='GRIN')
-        deposit = Deposit.objects.create(
-            balance=balance,
-            amount=amount,
-            confirmations=0,
-            status='awaiting transaction signature',
-            tx_slate_id=versioned_slate['id'],
-        )
+        create_step1_transfer(
+            Deposit, request.user, amount, versioned_slate['id'])
         # now we create a slatepack message from the slate
         slatepack_message = wallet_api.create_slatepack_message(
             versioned_slate,
@@ -154,6 +305,8 @@ class DepositViewSet(CustomModelViewSet):
         )
 
     @transaction.atomic
+    @idempotent
+    @admitted
     @action(
         detail=False,
         methods=['post'],
@@ -169,60 +322,28 @@ class DepositViewSet(CustomModelViewSet):
 
     def finish_deposit_grin(self, request):
         try:
-            slatepack_msg = request.data.pop('data')['slatepack_msg']
-            if slatepack_msg is None:
-                raise Exception()
-        except:
-            return Response(
-                data={'detail': 'Invalid data'},
-                status=status.HTTP_400_BAD_REQUEST
-            )
+            slatepack_msg = parse_finish_data(request.data)
+        except TransferError as e:
+            return error_response(e)
         wallet_api = WalletV3.get_wallet_api()
         # decode slatepack message and find the matching deposit
         # NOTE: if deposit exists then tx in db for it also exists, unless db
         # is corrupted
         try:
             slate = wallet_api.slate_from_slatepack_message(slatepack_msg, [0])
-            deposit = Deposit.objects.get(
-                tx_slate_id=slate['id'],
-                status="awaiting transaction signature",
-                balance__currency__symbol='GRIN',
-                balance__user=request.user
-            )
-        except:
-            return Response(
-                data={'detail': 'Only the latest given deposit contract is valid.'},
-                status=status.HTTP_400_BAD_REQUEST
-            )
-        # we will call finalize, we want to finalize invoice, not payment
-        if slate['sta'] != 'I2':
-            return Response(
-                data={'detail': 'Invalid contract.'},
-                status=status.HTTP_400_BAD_REQUEST
-            )
+        except Exception:
+            return error_response(contract_error(Deposit))
         try:
-            # finalize tx and push it
-            final_slate = wallet_api.finalize_tx(slate)
-            wallet_api.post_tx(final_slate)
-        except Exception as e:
-            logger.exception('Failed to finalize or post the transaction')
-            raise APIException('Something went wrong')
-        # update the deposit
-        tx = wallet_api.retrieve_txs(
-            tx_slate_id=final_slate['id'], refresh=False)[0]
-        deposit.status = 'awaiting confirmation'
-        deposit.kernel_excess = tx['kernel_excess']
-        deposit.save()
-        return Response(
-            data=DepositSerializer(deposit).data,
-            status=status.HTTP_200_OK
-        )
+            job = begin_finalization(Deposit, request.user, slate)
+        except TransferError as e:
+            return error_response(e)
+        return job_response(job, request)
 
     def get_permissions(self):
         """
         Add/delete/update requests require isAdminUser, list/retrieve/ requests
-        require view_deposit object permission, start_deposit/finish_deposit
-        require only IsAuthenticated permission.
+        only see user's own deposits, start_deposit/finish_deposit require
+        only IsAuthenticated permission.
         """
         permission_classes = [IsAuthenticated]
         if self.action not in ['list', 'retrieve']:
@@ -232,13 +353,18 @@ class DepositViewSet(CustomModelViewSet):
         return [permission() for permission in permission_classes]
 
 
-class WithdrawalViewSet(CustomModelViewSet):
+class WithdrawalViewSet(ConditionalListMixin, ValuesListMixin, CustomModelViewSet):
     """API endpoint for getting withdrawals"""
     queryset = Withdrawal.objects.filter(
-        ~Q(status="awaiting transaction signature"))
+        ~Q(status="awaiting transaction signature")
+    ).select_related('balance__currency')
     serializer_class = WithdrawalSerializer
+    owner_field = 'balance__user'
+    pagination_class = HistoryCursorPagination
 
     @transaction.atomic
+    @idempotent
+    @admitted
     @action(
         detail=False,
         methods=['post'],
@@ -253,52 +379,17 @@ class WithdrawalViewSet(CustomModelViewSet):
             raise APIException('Withdrawal not supported')
 
     def start_withdrawal_grin(self, request):
-        user_wallet_address = request.data.pop('address', None)
-        amount = request.data.pop('amount')
-        if not user_wallet_address or not amount:
-            return Response(
-                data={'detail': 'Invalid data'},
-                status=status.HTTP_400_BAD_REQUEST
-            )
-        amount = Decimal(str(amount))
-        min_amount = Decimal('0.1')
-        if amount < min_amount:
-            return Response(
-                data={'detail': 'Minimum amount is {0:f} grin'.format(min_amount)},
-                status=status.HTTP_400_BAD_REQUEST
-            )
-        balance = request.user.balances.get(currency__symbol='GRIN')
-        if amount > balance.amount:
-            return Response(
-                data={
-                    'detail': "Your balance only has {0:f} grin".format(
-                        balance.amount)
-                },
-                status=status.HTTP_400_BAD_REQUEST
-            )
+        try:
+            user_wallet_address, amount = parse_start_data(request.data)
+            check_available_amount(request.user, amount)
+        except TransferError as e:
+            return error_response(e)
         wallet_api = WalletV3.get_wallet_api()
         # exchange has more control if it finalizes, so we need to create a SRS
         # when we do a withdrawal. We also want to use late-locking for obvious
         # reasons
-        versioned_slate = wallet_api.init_send_tx({
-            # NOTE: amount for api is in nanogrin, that's why we multiply
-            'amount': str(int(amount * Decimal('1000000000'))),
-            # reorgs of 1 are normal, 2 rare, 3 seems safe
-            'minimum_confirmations': 3,
-            # selection_strategy_is_use_all is false because exchanges can't
-            # work with this set to true, as they would quickly run out of utxos
-            'selection_strategy_is_use_all': False,
-            # num_change_outputs is optional, but we should probably define it,
-            # we could even make it dependent on the amount
-            'num_change_outputs': 1,
-            # we want payment proof
-            'payment_proof_recipient_address': user_wallet_address,
-            # we want late-locking, otherwise user's can spam-lock exchange's
-            # utxos, when late-locking is default, we can remove this
-            'late_lock': False,
-            # max_outputs is required
-            'max_outputs': 500,
-        })
+        versioned_slate = wallet_api.init_send_tx(
+            send_tx_args(amount, user_wallet_address))
         # versioned_slate data is something like: {
         #   'amt': '100000000',
         #   'fee': '23500000',
@@ -316,32 +407,8 @@ class WithdrawalViewSet(CustomModelViewSet):
         #   'sta': 'S1',
         #   'ver': '4:3'
         # }
-        # delete any existing withdrawal instances for this user for grin
-        existing_step1_withdrawal = Withdrawal.objects.filter(
-            status="awaiting transaction signature",
-            balance__currency__symbol='GRIN',
-            balance__user=request.user
-        ).first()
-        if existing_step1_withdrawal:
-            # cancel the transaction of previous unfinished withdrawal
-            try:
-                wallet_api.cancel_tx(tx_slate_id=existing_step1_withdrawal.tx_slate_id)
-            except Exception as e:
-                # who knows why this can fail, maybe they've manually deleted it
-                # before
-                pass
-            # delete the instance, this will also unlock the locked amount
-            existing_step1_withdrawal.delete()
-        # create a withdrawal instance
-        balance = self.request.user.balances.get(
-            currency__symbol='GRIN')
-        withdrawal = Withdrawal.objects.create(
-            balance=balance,
-            amount=amount,
-            confirmations=0,
-            status='awaiting transaction signature',
-            tx_slate_id=versioned_slate['id'],
-        )
+        create_step1_transfer(
+            Withdrawal, request.user, amount, versioned_slate['id'])
         # now we create a slatepack message from the slate
         slatepack_message = wallet_api.create_slatepack_message(
             versioned_slate,
@@ -354,6 +421,8 @@ class WithdrawalViewSet(CustomModelViewSet):
         )
 
     @transaction.atomic
+    @idempotent
+    @admitted
     @action(
         detail=False,
         methods=['post'],
@@ -369,58 +438,26 @@ class WithdrawalViewSet(CustomModelViewSet):
 
     def finish_withdrawal_grin(self, request):
         try:
-            slatepack_msg = request.data.pop('data')['slatepack_msg']
-            if slatepack_msg is None:
-                raise Exception()
-        except:
-            return Response(
-                data={'detail': 'Invalid data'},
-                status=status.HTTP_400_BAD_REQUEST
-            )
+            slatepack_msg = parse_finish_data(request.data)
+        except TransferError as e:
+            return error_response(e)
         wallet_api = WalletV3.get_wallet_api()
         # decode slatepack message and find the matching withdrawal
         # NOTE: if withdrawal exists then tx in db for it also exists
         try:
             slate = wallet_api.slate_from_slatepack_message(slatepack_msg, [0])
-            withdrawal = Withdrawal.objects.get(
-                tx_slate_id=slate['id'],
-                status="awaiting transaction signature",
-                balance__currency__symbol='GRIN',
-                balance__user=request.user
-            )
-        except:
-            return Response(
-                data={'detail': 'Only the latest given Withdrawal contract is valid.'},
-                status=status.HTTP_400_BAD_REQUEST
-            )
-        # we will call finalize, we want to finalize payment, not invoice
-        if slate['sta'] != 'S2':
-            return Response(
-                data={'detail': 'Invalid contract.'},
-                status=status.HTTP_400_BAD_REQUEST
-            )
+        except Exception:
+            return error_response(contract_error(Withdrawal))
         try:
-            # finalize tx and push it
-            final_slate = wallet_api.finalize_tx(slate)
-            wallet_api.post_tx(final_slate)
-        except Exception as e:
-            logger.exception('Failed to finalize or post the transaction')
-            raise APIException('Something went wrong')
-        # update the withdrawal
-        tx = wallet_api.retrieve_txs(
-            tx_slate_id=final_slate['id'], refresh=False)[0]
-        withdrawal.status = 'awaiting confirmation'
-        withdrawal.kernel_excess = tx['kernel_excess']
-        withdrawal.save()
-        return Response(
-            data=WithdrawalSerializer(withdrawal).data,
-            status=status.HTTP_200_OK
-        )
+            job = begin_finalization(Withdrawal, request.user, slate)
+        except TransferError as e:
+            return error_response(e)
+        return job_response(job, request)
 
     def get_permissions(self):
         """
         Add/delete/update requests require isAdminUser, list/retrieve/ requests
-        require view_withdrawal object permission, start_withdrawal and
+        only see user's own withdrawals, start_withdrawal and
         finish_withdrawal require only IsAuthenticated permission.
         """
         permission_classes = [IsAuthenticated]
@@ -429,3 +466,45 @@ class WithdrawalViewSet(CustomModelViewSet):
         if self.action in ['destroy', 'create', 'update', 'partial_update']:
             permission_classes.append(IsAdminUser)
         return [permission() for permission in permission_classes]
+
+
+class JobView(APIView):
+    """API endpoint for polling the status of user's job, eg. finish deposit"""
+    permission_classes = (IsAuthenticated, )
+
+    def get(self, request, job_id):
+        job = get_job(job_id)
+        if job is None or job['user'] != request.user.pk:
+            raise NotFound()
+        return Response(data=job)
+
+
+class AdmissionMetricsView(APIView):
+    """API endpoint for admins with wallet admission metrics"""
+    permission_classes = (IsAdminUser, )
+
+    def get(self, request):
+        return Response(data=get_metrics())
+
+
+class CacheMetricsView(APIView):
+    """API endpoint for admins with hits and misses of the read-through cache"""
+    permission_classes = (IsAdminUser, )
+
+    def get(self, request):
+        return Response(data=get_cache_metrics())
+
+
+class ChangesView(APIView):
+    """
+    API endpoint for syncing user's balances, deposits and withdrawals changed
+    since the cursor of the previous sync, see get_changes
+    """
+    permission_classes = (IsAuthenticated, )
+
+    def get(self, request):
+        try:
+            changes = get_changes(request.user, request.query_params.get('since'))
+        except InvalidCursor as e:
+            raise ValidationError({'since': [str(e)]})
+        return Response(data=changes)
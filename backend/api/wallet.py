@@ -1,11 +1,16 @@
 from Cryptodome.Cipher import AES
 from ecdsa import ECDH, SECP256k1
-from requests.auth import HTTPBasicAuth
 from django.conf import settings
+from .transport import get_async_transport, get_transport
+import asyncio
 import base64
 import json
+import logging
 import os
-import requests
+import threading
+import weakref
+
+logger = logging.getLogger(__name__)
 
 
 def encrypt(key, msg, nonce):
@@ -16,14 +21,39 @@ def encrypt(key, msg, nonce):
     return base64.b64encode(ciphertext + auth_tag).decode()
 
 def decrypt(key, data, nonce):
+    '''raises ValueError if the auth tag doesn't match (eg. wrong key)'''
     data = base64.b64decode(data)
     ciphertext = data[:-16]
     auth_tag = data[-16:]
     aesCipher = AES.new(bytes.fromhex(key), AES.MODE_GCM, nonce=nonce)
-    plaintext = aesCipher.decrypt(ciphertext)
+    plaintext = aesCipher.decrypt_and_verify(ciphertext, auth_tag)
     return plaintext.decode()
 
 
+def rpc_payload(method, params):
+    return {
+        'jsonrpc': '2.0',
+        'id': 1,
+        'method': method,
+        'params': params
+    }
+
+
+def check_response(method, params, response_json):
+    """Raises WalletError if the response is an error, returns it otherwise."""
+    if "error" in response_json:
+        # One version of a wallet error
+        raise WalletError(method, params, response_json["error"]["code"], response_json["error"]["message"])
+    result = response_json.get("result")
+    if isinstance(result, dict) and "Err" in result:
+        # Another version of a wallet error, the code is the error's variant
+        # (eg. {"Err": "KeychainDoesntExist"})
+        error = result["Err"]
+        code = next(iter(error), None) if isinstance(error, dict) else error
+        raise WalletError(method, params, code, error)
+    return response_json
+
+
 # Exception class to hold wallet call error data
 class WalletError(Exception):
     def __init__(self, method, params, code, reason):
@@ -36,80 +66,210 @@ class WalletError(Exception):
     def __str__(self):
         return f'Calling {self.method} with params {self.params} failed with error code {self.code} because: {self.reason}'
 
+    def is_session_error(self):
+        """
+        True if the wallet rejected the request before running it because our
+        shared secret or wallet token is no longer valid (eg. the wallet was
+        restarted), in which case the session needs to be re-keyed and the
+        wallet re-opened. Only these errors are safe to retry, the call
+        itself might not be idempotent.
+        """
+        return self.code in SESSION_ERROR_CODES
+
+
+# codes of wallet errors which mean the request was rejected because of a
+# broken secure session
+SESSION_ERROR_CODES = (
+    # encrypted_request_v3 without init_secure_api
+    -32001,
+    # the wallet failed to decrypt the request
+    -32002,
+    # the wallet is not open, so the token is not valid
+    'KeychainDoesntExist',
+)
+
+
+class WalletSession:
+    """
+    Process-wide, thread-safe holder of an initialized and opened owner api.
+
+    The ECDH handshake (init_secure_api) and open_wallet are done only once,
+    the shared secret and the token are then reused by every caller in the
+    process. When the wallet rejects them the session is re-keyed and the
+    wallet re-opened.
+    """
+
+    def __init__(self, wallet_class, wallet_name='default'):
+        self.wallet_class = wallet_class
+        self.wallet_name = wallet_name
+        self._lock = threading.Lock()
+        self._wallet_api = None
+        # incremented on every handshake, used to detect that some other
+        # thread has already re-keyed the session
+        self.generation = 0
+        self.handshakes = 0
+        self.handshakes_saved = 0
+
+    def get_wallet_api(self):
+        with self._lock:
+            if self._wallet_api is None:
+                wallet_api = self.wallet_class(session=self)
+                self._handshake(wallet_api)
+                self._wallet_api = wallet_api
+            else:
+                self.handshakes_saved += 1
+            return self._wallet_api
+
+    def renew(self, wallet_api, generation):
+        """
+        Re-key and re-open the wallet, unless some other thread has already
+        done it since the failed call was made with the given generation.
+        """
+        with self._lock:
+            if generation == self.generation:
+                logger.info('Renewing owner api session for wallet {}'.format(
+                    self.wallet_name))
+                self._handshake(wallet_api)
+
+    def _handshake(self, wallet_api):
+        # we need a new ECDH key, the old shared secret is not valid anymore
+        wallet_api.generate_key()
+        wallet_api.init_secure_api()
+        wallet_api.open_wallet(self.wallet_name)
+        self.generation += 1
+        self.handshakes += 1
+
+    def credentials(self, wallet_api):
+        """
+        Returns (generation, shared secret, token) of the session, read
+        together so that a concurrent renewal can't mix the old and new ones.
+        """
+        with self._lock:
+            return self.generation, wallet_api.share_secret, wallet_api.token
+
+    def stats(self):
+        return {
+            'wallet_name': self.wallet_name,
+            'handshakes': self.handshakes,
+            'handshakes_saved': self.handshakes_saved,
+        }
+
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+
+def with_token(params, token):
+    return dict(params, token=token) if 'token' in params else params
+
+
+def get_session(wallet_class, wallet_name='default'):
+    """Returns the process-wide session for the given wallet."""
+    with _sessions_lock:
+        key = (wallet_class, wallet_name)
+        if key not in _sessions:
+            _sessions[key] = WalletSession(wallet_class, wallet_name)
+        return _sessions[key]
+
+
+def get_session_stats():
+    with _sessions_lock:
+        return [session.stats() for session in _sessions.values()]
+
 
 # Grin Wallet Owner API V3
 class WalletV3:
-    def __init__(self):
+    def __init__(self, session=None):
         wallet_settings = settings.WALLET_API
         self.api_url = wallet_settings['URL']
         self.api_user = wallet_settings['USERNAME']
         self.owner_api_secret = wallet_settings['OWNER_API_SECRET']
-        # get random point on secp256k1, will be used to derive share_secret
-        # from the returned secret
-        self.ecdh = ECDH(curve=SECP256k1)
-        self.public_key = self.ecdh.generate_private_key().to_string('compressed').hex()
+        self.transport = get_transport(
+            self.api_url, self.api_user, self.owner_api_secret)
+        self.generate_key()
         # share_secret is ECDH shared secret, we calculate it when we initialize
         # secure api
         self.share_secret = ''
         # when you open a wallet, you get a token which you need to pass with
         # each call
         self.token = ''
+        # session which owns this instance, None for standalone instances
+        self.session = session
+
+    def generate_key(self):
+        # get random point on secp256k1, will be used to derive share_secret
+        # from the returned secret
+        self.ecdh = ECDH(curve=SECP256k1)
+        self.public_key = self.ecdh.generate_private_key().to_string('compressed').hex()
 
     @classmethod
     def get_wallet_api(cls, wallet_name='default'):
-        # initialize wallet api, that's basically WalletV3()
-        wallet_api = cls()
-        # call init_secure_api to get the shared key
-        wallet_api.init_secure_api()
-        # we open the wallet so we get the token to make api calls on that wallet
-        wallet_api.open_wallet(wallet_name)
-        return wallet_api
-
-    def post(self, method, params):
-        payload = {
-            'jsonrpc': '2.0',
-            'id': 1,
-            'method': method,
-            'params': params
-        }
-        response = requests.post(
-                self.api_url, json=payload, 
-                auth=(self.api_user, self.owner_api_secret))
+        """
+        Returns the process-wide wallet api with an already initialized secure
+        api and an opened wallet. The handshake is done only on the first call
+        (and whenever the wallet invalidates the session).
+        """
+        return get_session(cls, wallet_name).get_wallet_api()
+
+    def post(self, method, params, timeout=None):
+        response = self.transport.post(
+            rpc_payload(method, params), method, timeout=timeout)
         if response.status_code >= 300 or response.status_code < 200:
             # Requests-level error
             raise WalletError(method, params, response.status_code, response.reason)
-        response_json = response.json()
-        if "error" in response_json:
-            # One version of a wallet error
-            raise WalletError(method, params, response_json["error"]["code"], response_json["error"]["message"])
-        if "Err" in response_json:
-            # Another version of a wallet error
-            raise WalletError(method, params, None, response_json["result"]["Err"])
-        return response_json
+        return check_response(method, params, response.json())
 
     def post_encrypted(self, method, params):
-        payload = {
-            'jsonrpc': '2.0',
-            'id': 1,
-            'method': method,
-            'params': params
-        }
+        session = self.session
+        # open_wallet is part of the handshake, we can't renew the session
+        # in the middle of it
+        if session is None or method == 'open_wallet':
+            return self._post_encrypted(method, params, self.share_secret)
+        generation, share_secret, token = session.credentials(self)
+        try:
+            return self._post_encrypted(
+                method, with_token(params, token), share_secret)
+        except WalletError as e:
+            if not e.is_session_error():
+                raise
+            session.renew(self, generation)
+        _, share_secret, token = session.credentials(self)
+        return self._post_encrypted(method, with_token(params, token), share_secret)
+
+    def _post_encrypted(self, method, params, share_secret):
+        encrypted_params = self.encrypt_request(method, params, share_secret)
+        # timeout depends on the wrapped method, eg. scan takes much longer
+        # than retrieve_txs
+        resp = self.post('encrypted_request_v3', encrypted_params,
+                         timeout=self.transport.timeout_for(method))
+        return self.decrypt_response(method, params, resp, share_secret)
+
+    def encrypt_request(self, method, params, share_secret):
+        """Returns params of encrypted_request_v3 which wraps the given call."""
         nonce = os.urandom(12)
-        encrypted = encrypt(self.share_secret, json.dumps(payload), nonce)
-        resp = self.post('encrypted_request_v3', {
+        encrypted = encrypt(
+            share_secret, json.dumps(rpc_payload(method, params)), nonce)
+        return {
             'nonce': nonce.hex(),
             'body_enc': encrypted
-        })
+        }
+
+    def decrypt_response(self, method, params, resp, share_secret):
+        """Decrypts and checks the response of encrypted_request_v3."""
         nonce2 = bytes.fromhex(resp['result']['Ok']['nonce'])
         encrypted2 = resp['result']['Ok']['body_enc']
-        response_json = json.loads(decrypt(self.share_secret, encrypted2, nonce2))
-        if "error" in response_json:
-            # One version of a wallet error
-            raise WalletError(method, params, response_json["error"]["code"], response_json["error"]["message"])
-        if "Err" in response_json:
-            # Another version of a wallet error
-            raise WalletError(method, params, None, response_json["result"]["Err"])
-        return response_json
+        try:
+            response_json = json.loads(decrypt(share_secret, encrypted2, nonce2))
+        except ValueError:
+            raise WalletError(method, params, None, 'Failed to decrypt the response')
+        return check_response(method, params, response_json)
+
+    def shared_secret_from(self, resp):
+        """Calculates shared ECDH secret from the init_secure_api response."""
+        remote_pubkey = resp['result']['Ok']
+        self.ecdh.load_received_public_key_bytes(bytes.fromhex(remote_pubkey))
+        self.share_secret = self.ecdh.generate_sharedsecret_bytes().hex()
+        return self.share_secret
 
     ##
     # The API: https://docs.rs/grin_wallet_api/5.0.1/grin_wallet_api/trait.OwnerRpc.html
@@ -117,11 +277,8 @@ class WalletV3:
     # https://docs.rs/grin_wallet_api/5.0.1/grin_wallet_api/trait.OwnerRpc.html#tymethod.init_secure_api
     def init_secure_api(self):
         resp = self.post('init_secure_api', {'ecdh_pubkey': self.public_key})
-        remote_pubkey = resp['result']['Ok']
         # calculate shared ECDH secret based on the returned pubkey
-        self.ecdh.load_received_public_key_bytes(bytes.fromhex(remote_pubkey))
-        self.share_secret = self.ecdh.generate_sharedsecret_bytes().hex()
-        return self.share_secret
+        return self.shared_secret_from(resp)
 
     # https://docs.rs/grin_wallet_api/5.0.1/grin_wallet_api/trait.OwnerRpc.html#tymethod.open_wallet
     def open_wallet(self, name='default'):
@@ -452,3 +609,190 @@ class WalletV3:
         }
         resp = self.post_encrypted('create_wallet', params)
         return resp["result"]["Ok"]
+
+
+class AsyncWalletSession(WalletSession):
+    """
+    Async version of WalletSession, shared by the coroutines of one event
+    loop. The handshake is awaited under an asyncio lock.
+    """
+
+    def __init__(self, wallet_class, wallet_name='default'):
+        super().__init__(wallet_class, wallet_name)
+        self._lock = asyncio.Lock()
+
+    async def get_wallet_api(self):
+        async with self._lock:
+            if self._wallet_api is None:
+                wallet_api = self.wallet_class(session=self)
+                await self._handshake(wallet_api)
+                self._wallet_api = wallet_api
+            else:
+                self.handshakes_saved += 1
+            return self._wallet_api
+
+    async def renew(self, wallet_api, generation):
+        async with self._lock:
+            if generation == self.generation:
+                logger.info('Renewing async owner api session for wallet {}'.format(
+                    self.wallet_name))
+                await self._handshake(wallet_api)
+
+    async def credentials(self, wallet_api):
+        async with self._lock:
+            return self.generation, wallet_api.share_secret, wallet_api.token
+
+    async def _handshake(self, wallet_api):
+        wallet_api.generate_key()
+        await wallet_api.init_secure_api()
+        await wallet_api.open_wallet(self.wallet_name)
+        self.generation += 1
+        self.handshakes += 1
+
+
+# event loop -> {(wallet_class, wallet_name): session}
+_async_sessions = weakref.WeakKeyDictionary()
+
+
+def get_async_session(wallet_class, wallet_name='default'):
+    """Returns the session of the running event loop for the given wallet."""
+    sessions = _async_sessions.setdefault(asyncio.get_running_loop(), {})
+    key = (wallet_class, wallet_name)
+    if key not in sessions:
+        sessions[key] = AsyncWalletSession(wallet_class, wallet_name)
+    return sessions[key]
+
+
+class AsyncWalletV3(WalletV3):
+    """
+    Async version of WalletV3 for async views. Requests are encrypted and
+    sessions renewed the same way, only the calls used by the deposit and
+    withdrawal views are available.
+    """
+
+    def __init__(self, session=None):
+        super().__init__(session=session)
+        self.transport = get_async_transport(
+            self.api_url, self.api_user, self.owner_api_secret)
+
+    @classmethod
+    async def get_wallet_api(cls, wallet_name='default'):
+        return await get_async_session(cls, wallet_name).get_wallet_api()
+
+    async def post(self, method, params, timeout=None):
+        response = await self.transport.post(
+            rpc_payload(method, params), method, timeout=timeout)
+        if response.status_code >= 300 or response.status_code < 200:
+            # Requests-level error
+            raise WalletError(
+                method, params, response.status_code, response.reason_phrase)
+        return check_response(method, params, response.json())
+
+    async def post_encrypted(self, method, params):
+        session = self.session
+        if session is None or method == 'open_wallet':
+            return await self._post_encrypted(method, params, self.share_secret)
+        generation, share_secret, token = await session.credentials(self)
+        try:
+            return await self._post_encrypted(
+                method, with_token(params, token), share_secret)
+        except WalletError as e:
+            if not e.is_session_error():
+                raise
+            await session.renew(self, generation)
+        _, share_secret, token = await session.credentials(self)
+        return await self._post_encrypted(
+            method, with_token(params, token), share_secret)
+
+    async def _post_encrypted(self, method, params, share_secret):
+        encrypted_params = self.encrypt_request(method, params, share_secret)
+        resp = await self.post('encrypted_request_v3', encrypted_params,
+                               timeout=self.transport.timeout_for(method))
+        return self.decrypt_response(method, params, resp, share_secret)
+
+    async def init_secure_api(self):
+        resp = await self.post('init_secure_api', {'ecdh_pubkey': self.public_key})
+        return self.shared_secret_from(resp)
+
+    async def open_wallet(self, name='default'):
+        params = {
+            'name': name,
+            'password': settings.WALLET_API['PASSWORD'],
+        }
+        resp = await self.post_encrypted('open_wallet', params)
+        self.token = resp['result']['Ok']
+        return self.token
+
+    async def retrieve_txs(self, tx_id=None, tx_slate_id=None, refresh=True):
+        params = {
+            'token': self.token,
+            'refresh_from_node': refresh,
+            'tx_id': tx_id,
+            'tx_slate_id': tx_slate_id,
+        }
+        resp = await self.post_encrypted('retrieve_txs', params)
+        if refresh and not resp["result"]["Ok"][0]:
+            # We requested refresh but data was not successfully refreshed
+            raise WalletError("retrieve_outputs", params, None, "Failed to refresh data from the node")
+        return resp["result"]["Ok"][1]
+
+    async def cancel_tx(self, tx_id=None, tx_slate_id=None, refresh=True):
+        params = {
+            'token': self.token,
+            'tx_id': tx_id,
+            'tx_slate_id': tx_slate_id,
+        }
+        await self.post_encrypted('cancel_tx', params)
+        return True
+
+    async def finalize_tx(self, slate):
+        params = {
+            'token': self.token,
+            'slate': slate,
+        }
+        resp = await self.post_encrypted('finalize_tx', params)
+        return resp["result"]["Ok"]
+
+    async def init_send_tx(self, args):
+        params = {
+            'token': self.token,
+            'args': args,
+        }
+        resp = await self.post_encrypted('init_send_tx', params)
+        return resp["result"]["Ok"]
+
+    async def issue_invoice_tx(self, args):
+        params = {
+            'token': self.token,
+            'args': args,
+        }
+        resp = await self.post_encrypted('issue_invoice_tx', params)
+        return resp["result"]["Ok"]
+
+    async def post_tx(self, slate, fluff=False):
+        params = {
+            'token': self.token,
+            'slate': slate,
+            'fluff': fluff,
+        }
+        resp = await self.post_encrypted('post_tx', params)
+        return resp["result"]["Ok"]
+
+    async def create_slatepack_message(self, slate, recipients, sender_index=None):
+        params = {
+            'token': self.token,
+            'slate': slate,
+            'recipients': recipients,
+            'sender_index': sender_index,
+        }
+        resp = await self.post_encrypted('create_slatepack_message', params)
+        return resp["result"]["Ok"]
+
+    async def slate_from_slatepack_message(self, message, secret_indices):
+        params = {
+            'token': self.token,
+            'message': message,
+            'secret_indices': secret_indices,
+        }
+        resp = await self.post_encrypted('slate_from_slatepack_message', params)
+        return resp["result"]["Ok"]
@@ -0,0 +1,26 @@
+"""
+ASGI config for project project.
+
+It exposes the ASGI callable as a module-level variable named ``application``.
+Async views (see ASYNC_TRANSFER_VIEWS) and the event stream at /api/events/
+need it, eg. ``uvicorn backend.asgi:application``.
+
+For more information on this file, see
+https://docs.djangoproject.com/en/3.1/howto/deployment/asgi/
+"""
+
+import os
+
+from django.core.asgi import get_asgi_application
+
+# This will set production as default, but we must still set it with an
+# ENV on heroku to ensure that the migrate command runs agains the correct DB
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'backend.settings.prod')
+
+django_application = get_asgi_application()
+
+# imported once django is set up
+from backend.api.sse import with_event_stream  # noqa: E402
+
+# /api/events/ is served by the event stream, the rest by django
+application = with_event_stream(django_application)
@@ -31,6 +31,100 @@ env.read_env(env_file)
 # however i see no reason for such case
 REQUIRED_CONFIRMATIONS = 10
 
+# follows the chain to update confirmations of deposits and withdrawals
+BLOCK_FOLLOWER = {
+    # max number of new blocks processed in a single run, the rest is
+    # processed in the next runs
+    'MAX_BLOCKS_PER_RUN': 1440,
+    # how many blocks we go back when a block doesn't build on the last
+    # processed one
+    'REORG_DEPTH': REQUIRED_CONFIRMATIONS,
+}
+
+# balance amounts are a snapshot of applied ledger entries
+LEDGER = {
+    # max number of balances updated by a single batch materialization
+    'MATERIALIZE_BATCH_SIZE': 1000,
+    # how often the scheduler applies pending entries to balances
+    'MATERIALIZE_INTERVAL_SECONDS': 60,
+}
+
+# scheduler checks the chain tip and updates confirmations only on a change
+TIP_WATCHER = {
+    'INTERVAL_SECONDS': env.int('TIP_WATCHER_INTERVAL_SECONDS', default=5),
+    # confirmations are also updated periodically, regardless of the tip
+    'FALLBACK_INTERVAL_MINUTES': 10,
+}
+
+# step-1 deposits and withdrawals which were never finished are deleted and
+# their wallet transactions canceled in the background
+STEP1_REAPER = {
+    # unfinished step-1 transfers older than this are abandoned. Transfers
+    # superseded by a newer step-1 transfer of the same balance are reaped
+    # right away
+    'TTL_MINUTES': env.int('STEP1_TTL_MINUTES', default=60),
+    # number of transfers deleted at once
+    'BATCH_SIZE': 100,
+    # number of concurrent cancel_tx calls
+    'WALLET_WORKERS': 4,
+    'INTERVAL_MINUTES': 5,
+}
+
+# finalizing and posting of signed transactions is done by jobs, the client
+# polls for their result
+FINISH_JOBS = {
+    # how long a job's status is kept
+    'TTL_SECONDS': 60 * 60,
+}
+
+# finalizing transfers whose finish job died or failed to post are moved to
+# awaiting confirmation if their transaction might have been posted,
+# otherwise back to step-1, see recover_finalizing
+FINALIZE_SWEEPER = {
+    # finalizing transfers not modified or claimed by a finish job for this
+    # long are stale, it should be longer than the slowest finish job
+    'STALE_MINUTES': env.int('FINALIZE_STALE_MINUTES', default=15),
+    'INTERVAL_MINUTES': 5,
+}
+
+# responses of deposit and withdrawal start/finish requests with an
+# Idempotency-Key header are kept so that a retried request gets the same one
+IDEMPOTENCY = {
+    # how long a successful response is kept
+    'TTL_SECONDS': env.int('IDEMPOTENCY_TTL_SECONDS', default=24 * 60 * 60),
+    # how long a key is reserved by a running request, should be longer than
+    # the slowest wallet calls of a request
+    'LOCK_SECONDS': 2 * 60,
+    'MAX_KEY_LENGTH': 255,
+}
+
+# concurrency limits of deposit and withdrawal start/finish requests, which
+# all call the wallet, shared by the workers through redis
+ADMISSION = {
+    # requests in flight at once, about what the wallet can handle
+    'GLOBAL_LIMIT': env.int('ADMISSION_GLOBAL_LIMIT', default=20),
+    # requests in flight at once per user
+    'USER_LIMIT': env.int('ADMISSION_USER_LIMIT', default=2),
+    # slot of a crashed worker is freed after this, should be longer than
+    # the slowest request
+    'LEASE_SECONDS': 2 * 60,
+    # Retry-After of rejected requests
+    'RETRY_AFTER_SECONDS': 1,
+}
+
+# server-sent events of deposits, withdrawals and balances at /api/events/
+EVENT_STREAM = {
+    # comment sent when there are no events, so that proxies keep the
+    # connection open
+    'HEARTBEAT_SECONDS': 15,
+    # events waiting for a slow client, newer ones are dropped
+    'QUEUE_SIZE': 100,
+}
+
+# route deposit and withdrawal start/finish actions to async views, which only
+# help when the app is served by backend/asgi.py (eg. uvicorn) instead of WSGI
+ASYNC_TRANSFER_VIEWS = env.bool('ASYNC_TRANSFER_VIEWS', default=False)
+
 WALLET_API = {
     'URL': env('WALLET_API_URL'),
     # default username is 'grin'
@@ -46,6 +140,31 @@ NODE_API = {
     'URL': env('NODE_API_URL'),
     'USERNAME': env('NODE_API_USERNAME'),
     'FOREIGN_API_SECRET': env('NODE_FOREIGN_API_SECRET'),
+    # max number of calls sent in a single JSON-RPC batch request
+    'BATCH_SIZE': env.int('NODE_API_BATCH_SIZE', default=100),
+}
+
+# http transport used by both wallet and node api clients
+RPC_TRANSPORT = {
+    # number of hosts we keep a pool for (wallet, node)
+    'POOL_CONNECTIONS': 2,
+    # max keep-alive connections per host, should be at least the number of
+    # threads which call the apis concurrently
+    'POOL_MAXSIZE': env.int('RPC_POOL_MAXSIZE', default=10),
+    # max connections per host of the async transport, one event loop can
+    # have many more calls in flight than a thread pool
+    'ASYNC_MAX_CONNECTIONS': env.int('RPC_ASYNC_MAX_CONNECTIONS', default=100),
+    # (connect, read) timeout in seconds
+    'TIMEOUT': (3.05, 30),
+    # per RPC method timeouts, for encrypted wallet calls this is the method
+    # inside the encrypted request
+    'METHOD_TIMEOUTS': {
+        'scan': (3.05, 600),
+        'retrieve_txs': (3.05, 60),
+        'retrieve_outputs': (3.05, 60),
+        'retrieve_summary_info': (3.05, 60),
+        'get_tip': (3.05, 5),
+    },
 }
 
 
@@ -186,18 +305,49 @@ REST_FRAMEWORK = {
         'rest_framework.permissions.IsAuthenticated',
         'backend.api.permissions.ObjectPermissions',
     ),
+    # no basic authentication, it hashes the password on every request
     'DEFAULT_AUTHENTICATION_CLASSES': (
-        'rest_framework_simplejwt.authentication.JWTAuthentication',
+        'backend.api.authentication.ClaimsJWTAuthentication',
+        'backend.api.authentication.ApiKeyAuthentication',
         'rest_framework.authentication.SessionAuthentication',
-        'rest_framework.authentication.BasicAuthentication',
     ),
 }
 
+# deposit and withdrawal history, max page size limits what ?page_size= can ask
+HISTORY_PAGINATION = {
+    'PAGE_SIZE': env.int('HISTORY_PAGE_SIZE', default=50),
+    'MAX_PAGE_SIZE': env.int('HISTORY_MAX_PAGE_SIZE', default=200),
+}
+
+# read-through cache of currencies and balance lists, see api/caching.py
+READ_CACHE = {
+    'ENABLED': env.bool('READ_CACHE_ENABLED', default=True),
+    # entries are invalidated on change, ttl only bounds the damage of a
+    # missed invalidation
+    'CURRENCIES_SECONDS': 60 * 60,
+    'BALANCES_SECONDS': 10 * 60,
+}
+
+# delta sync of user's rows, see api/changes.py
+CHANGES = {
+    # rows of each type per response, rows modified at the same moment can
+    # make it a bit larger
+    'PAGE_SIZE': env.int('CHANGES_PAGE_SIZE', default=500),
+    # the cursor stays this far behind now, should be longer than the slowest
+    # transaction which modifies synced rows
+    'SETTLE_SECONDS': env.int('CHANGES_SETTLE_SECONDS', default=60),
+}
+
 # JWT
 SIMPLE_JWT = {
     'ACCESS_TOKEN_LIFETIME': timedelta(hours=8),
 }
 
+API_KEYS = {
+    # how long API key digests and their user's claims are cached in redis
+    'CACHE_SECONDS': 5 * 60,
+}
+
 
 # Internationalization
 # https://docs.djangoproject.com/en/2.1/topics/i18n/
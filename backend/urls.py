@@ -4,25 +4,32 @@ The `urlpatterns` list routes URLs to views. For more information please see:
     https://docs.djangoproject.com/en/2.1/topics/http/urls/
 """
 
+from django.conf import settings
 from django.contrib import admin
 from django.urls import path, include
 from rest_framework import routers
-from rest_framework_simplejwt.views import (
-    TokenObtainPairView,
-    TokenRefreshView,
-)
 
+from .api import async_views
 from .api.views import (
     index_view,
     UserCreate,
+    ClaimsTokenObtainPairView,
+    CheckedTokenRefreshView,
+    TokenRevokeView,
+    ApiKeyViewSet,
     BalanceViewSet,
     CurrencyViewSet,
     DepositViewSet,
     WithdrawalViewSet,
+    JobView,
+    AdmissionMetricsView,
+    CacheMetricsView,
+    ChangesView,
 )
 
 router = routers.DefaultRouter()
 
+router.register('account/api-keys', ApiKeyViewSet)
 router.register('balances', BalanceViewSet)
 router.register('currencies', CurrencyViewSet)
 router.register('deposits', DepositViewSet)
@@ -33,10 +40,32 @@ urlpatterns = [
     # register
     path('api/account/register/', UserCreate.as_view()),
     # login
-    path('api/account/token/', TokenObtainPairView.as_view(), name='token_obtain_pair'),
-    path('api/account/token/refresh/', TokenRefreshView.as_view(), name='token_refresh'),
+    path('api/account/token/', ClaimsTokenObtainPairView.as_view(), name='token_obtain_pair'),
+    path('api/account/token/refresh/', CheckedTokenRefreshView.as_view(), name='token_refresh'),
+    # logout
+    path('api/account/token/revoke/', TokenRevokeView.as_view(), name='token_revoke'),
     # admin
     path('api/admin/', admin.site.urls),
+    # status of background jobs, eg. finishing a deposit
+    path('api/jobs/<str:job_id>/', JobView.as_view(), name='job-detail'),
+    # requests in flight to the wallet and rejected requests, for admins
+    path('api/admission/', AdmissionMetricsView.as_view(), name='admission-metrics'),
+    # hit rates of the read-through cache, for admins
+    path('api/cache/', CacheMetricsView.as_view(), name='cache-metrics'),
+    # user's rows changed since a cursor, for clients which keep a copy
+    path('api/changes/', ChangesView.as_view(), name='changes'),
+]
+
+if settings.ASYNC_TRANSFER_VIEWS:
+    # must come before the router, which has the same paths
+    urlpatterns += [
+        path('api/deposits/start/', async_views.start_deposit),
+        path('api/deposits/finish/', async_views.finish_deposit),
+        path('api/withdrawals/start/', async_views.start_withdrawal),
+        path('api/withdrawals/finish/', async_views.finish_withdrawal),
+    ]
+
+urlpatterns += [
     # router
     path('api/', include(router.urls)),
 ]
@@ -54,6 +54,13 @@ const refreshToken = () => {
 };
 
 const logoutUser = () => {
+  const refresh = window.localStorage.getItem(REFRESH_TOKEN);
+  if (refresh) {
+    // revoke both tokens on the server, logout doesn't wait for it
+    defaultApi.post('/api/account/token/revoke/', { refresh }, {
+      headers: { Authorization: api.defaults.headers.Authorization },
+    }).catch(() => {});
+  }
   // remove both tokens and remove jwt header
   window.localStorage.removeItem(ACCESS_TOKEN);
   window.localStorage.removeItem(REFRESH_TOKEN);
@@ -1,6 +1,19 @@
 import { api } from '@/services/auth'
 import { Decimal } from 'decimal.js';
 
+// history is paginated, newest first. Resolves with the page's items and the
+// url of the next (older) page, null on the last page
+const fetchHistoryPage = (url) => {
+  return api.get(url)
+    .then(response => {
+      const items = response.data.results;
+      for (const item of items) {
+        item.amount = new Decimal(item.amount);
+      }
+      return { items, next: response.data.next };
+    })
+}
+
 export default {
   fetchBalances() {
     return api.get(`/api/balances/`)
@@ -13,24 +26,11 @@ export default {
         return balances;
       })
   },
-  fetchDeposits() {
-    return api.get(`/api/deposits/`)
-      .then(response => {
-        const deposits = response.data;
-        for (const deposit of deposits) {
-          deposit.amount = new Decimal(deposit.amount);
-        }
-        return deposits;
-      })
+  // first page, or the page at the given next url
+  fetchDeposits(next) {
+    return fetchHistoryPage(next || `/api/deposits/`)
   },
-  fetchWithdrawals() {
-    return api.get(`/api/withdrawals/`)
-      .then(response => {
-        const withdrawals = response.data;
-        for (const withdrawal of withdrawals) {
-          withdrawal.amount = new Decimal(withdrawal.amount);
-        }
-        return withdrawals;
-      })
+  fetchWithdrawals(next) {
+    return fetchHistoryPage(next || `/api/withdrawals/`)
   },
 }
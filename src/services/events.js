@@ -0,0 +1,15 @@
+import { BACKEND_URL, ACCESS_TOKEN } from '@/services/auth'
+
+// server pushes changes of user's deposits, withdrawals and balances, the
+// stream is only available when the backend is served through ASGI
+const subscribeToEvents = (onEvent) => {
+  const token = window.localStorage.getItem(ACCESS_TOKEN);
+  const source = new EventSource(
+    `${BACKEND_URL}/api/events/?token=${encodeURIComponent(token)}`);
+  source.onmessage = (message) => onEvent(JSON.parse(message.data));
+  return source;
+};
+
+export {
+  subscribeToEvents,
+};
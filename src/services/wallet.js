@@ -1,28 +1,56 @@
 import { api } from '@/services/auth'
 
+const JOB_POLL_INTERVAL = 1000;
+
+// resolves with the job's result once it's done, rejects if it failed
+function waitForJob(job) {
+  return new Promise((resolve, reject) => {
+    const poll = () => {
+      api.get(`/api/jobs/${job.id}/`)
+        .then(response => {
+          const current = response.data;
+          if (current.status === 'pending') {
+            setTimeout(poll, JOB_POLL_INTERVAL);
+          } else if (current.status === 'done') {
+            resolve(current.result);
+          } else {
+            // same shape as a failed request, callers read response.data
+            reject({ response: { data: current } });
+          }
+        })
+        .catch(reject);
+    };
+    poll();
+  });
+}
+
 export default {
   startDeposit(symbol, address, amount, message) {
     return api.post(`/api/deposits/start/`, {symbol, address, amount, message})
       .then(response => response.data)
   },
   finishDeposit(symbol, data) {
+    // finalization is done by a job on the server
     return api.post(`/api/deposits/finish/`, {symbol, data})
-      .then(response => response.data)
+      .then(response => waitForJob(response.data))
   },
   startWithdrawal(symbol, address, amount, message) {
     return api.post(`/api/withdrawals/start/`, {symbol, address, amount, message})
       .then(response => response.data)
   },
   finishWithdrawal(symbol, data) {
+    // finalization is done by a job on the server
     return api.post(`/api/withdrawals/finish/`, {symbol, data})
-      .then(response => response.data)
+      .then(response => waitForJob(response.data))
   },
-  fetchDeposits() {
-    return api.get(`/api/deposits/`)
+  // history is paginated, resolves with {next, previous, results} of the
+  // first page or of the page at the given next url
+  fetchDeposits(next) {
+    return api.get(next || `/api/deposits/`)
       .then(response => response.data)
   },
-  fetchWithdrawals() {
-    return api.get(`/api/withdrawals/`)
+  fetchWithdrawals(next) {
+    return api.get(next || `/api/withdrawals/`)
       .then(response => response.data)
   },
 }
@@ -1,5 +1,32 @@
 import balanceService from '../../services/balance'
 
+// copies pushed fields to the item with the same id, if it's loaded
+const updateItem = (items, data) => {
+  const item = (items || []).find(item => item.id === data.id);
+  if (item) {
+    Object.assign(item, data);
+  }
+}
+
+// refreshed first page replaces the newest items, older pages loaded before
+// are kept
+const mergeFirstPage = (items, next, page) => {
+  const ids = new Set(page.items.map(item => item.id));
+  const last = page.items[page.items.length - 1];
+  const older = (items || []).filter(
+    item => !ids.has(item.id) && last && item.created < last.created);
+  return {
+    items: page.items.concat(older),
+    next: older.length ? next : page.next,
+  };
+}
+
+// items already loaded (eg. pushed to a newer page meanwhile) are skipped
+const appendPage = (items, page) => {
+  const ids = new Set(items.map(item => item.id));
+  return items.concat(page.items.filter(item => !ids.has(item.id)));
+}
+
 const state = {
   balances: null,
   logos: {
@@ -8,6 +35,9 @@ const state = {
   },
   deposits: null,
   withdrawals: null,
+  // urls of the next (older) history pages, null when all are loaded
+  depositsNext: null,
+  withdrawalsNext: null,
 }
 
 const getters = {
@@ -20,6 +50,12 @@ const getters = {
   withdrawals: state => {
     return state.withdrawals
   },
+  depositsNext: state => {
+    return state.depositsNext
+  },
+  withdrawalsNext: state => {
+    return state.withdrawalsNext
+  },
 }
 
 const actions = {
@@ -31,14 +67,26 @@ const actions = {
   },
   getDeposits ({ commit }) {
     return balanceService.fetchDeposits()
-      .then(deposits => {
-        commit('setDeposits', deposits)
+      .then(page => {
+        commit('setDepositsPage', page)
+      })
+  },
+  getMoreDeposits ({ commit, state }) {
+    return balanceService.fetchDeposits(state.depositsNext)
+      .then(page => {
+        commit('addDepositsPage', page)
       })
   },
   getWithdrawals ({ commit }) {
-    balanceService.fetchWithdrawals()
-      .then(withdrawals => {
-        commit('setWithdrawals', withdrawals)
+    return balanceService.fetchWithdrawals()
+      .then(page => {
+        commit('setWithdrawalsPage', page)
+      })
+  },
+  getMoreWithdrawals ({ commit, state }) {
+    return balanceService.fetchWithdrawals(state.withdrawalsNext)
+      .then(page => {
+        commit('addWithdrawalsPage', page)
       })
   },
 }
@@ -47,17 +95,41 @@ const mutations = {
   setBalances (state, balances) {
     state.balances = balances
   },
-  setDeposits (state, deposits) {
-    state.deposits = deposits
+  setDepositsPage (state, page) {
+    const { items, next } = mergeFirstPage(
+      state.deposits, state.depositsNext, page)
+    state.deposits = items
+    state.depositsNext = next
+  },
+  addDepositsPage (state, page) {
+    state.deposits = appendPage(state.deposits || [], page)
+    state.depositsNext = page.next
   },
   addDeposit (state, deposit) {
-    state.deposits.push(deposit)
+    state.deposits.unshift(deposit)
   },
-  setWithdrawals (state, withdrawals) {
-    state.withdrawals = withdrawals
+  setWithdrawalsPage (state, page) {
+    const { items, next } = mergeFirstPage(
+      state.withdrawals, state.withdrawalsNext, page)
+    state.withdrawals = items
+    state.withdrawalsNext = next
+  },
+  addWithdrawalsPage (state, page) {
+    state.withdrawals = appendPage(state.withdrawals || [], page)
+    state.withdrawalsNext = page.next
   },
   addWithdrawal (state, withdrawal) {
-    state.withdrawals.push(withdrawal)
+    state.withdrawals.unshift(withdrawal)
+  },
+  // pushed events, see services/events.js
+  updateDeposit (state, data) {
+    updateItem(state.deposits, data)
+  },
+  updateWithdrawal (state, data) {
+    updateItem(state.withdrawals, data)
+  },
+  updateBalance (state, data) {
+    updateItem(state.balances, data)
   },
 }
 